@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地情感分類（繁體中文）
+以情感詞典 + 否定 / 程度 / 轉折規則抽出特徵，再以小型線性模型一次對整批文本
+計算三類機率；可信度達門檻的文本直接採用本地結果，其餘才送往 API
+"""
+
+import os
+import sys
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AI_02'))
+from gazetteer import AhoCorasick
+
+SENTIMENTS = ['正面', '負面', '中性']
+POSITIVE, NEGATIVE, NEUTRAL = range(3)
+
+# 詞條 -> 權重
+POSITIVE_WORDS = {
+    '棒': 2.0, '讚': 2.0, '喜歡': 2.0, '愛': 2.0, '滿意': 2.0, '愉快': 2.0, '開心': 2.0,
+    '高興': 2.0, '推薦': 2.0, '感謝': 1.5, '謝謝': 1.5, '優秀': 2.0, '不錯': 1.5, '完美': 2.5,
+    '精彩': 2.0, '厲害': 2.0, '值得': 1.5, '舒服': 1.5, '方便': 1.0, '解決': 1.0, '幸福': 2.0,
+    '很好': 2.0, '真好': 2.0, '太好': 2.0, '好棒': 2.5, '好用': 2.0, '好吃': 2.0, '美好': 2.0,
+    '良好': 1.5, '好評': 2.0, '驚喜': 2.0, '感動': 2.0, '貼心': 2.0, '划算': 1.5, '期待': 1.0
+}
+NEGATIVE_WORDS = {
+    '差': 2.0, '糟': 2.0, '爛': 2.5, '失望': 2.5, '不滿': 2.5, '不滿意': 2.5, '討厭': 2.5,
+    '生氣': 2.0, '難過': 2.0, '傷心': 2.0, '貴': 1.0, '不值': 2.0, '慢': 1.0, '麻煩': 1.5,
+    '抱怨': 2.0, '垃圾': 2.5, '後悔': 2.5, '可惜': 1.5, '痛苦': 2.0, '噁心': 2.5, '無聊': 1.5,
+    '故障': 2.0, '壞': 2.0, '難用': 2.5, '難吃': 2.5, '不舒服': 2.0, '擔心': 1.5, '憤怒': 2.5,
+    '騙': 2.5, '退貨': 1.5, '浪費': 2.0
+}
+NEUTRAL_CUES = {
+    '還算': 1.0, '普通': 1.5, '一般': 1.0, '還可以': 1.5, '尚可': 1.5, '沒有特別': 2.0,
+    '中規中矩': 2.0, '還行': 1.5, '可以接受': 1.0, '不好不壞': 2.5, '見仁見智': 2.0
+}
+NEGATIONS = ['不', '沒', '沒有', '別', '未', '無', '並不', '毫不', '不太', '不是']
+INTENSIFIERS = ['很', '非常', '太', '超', '真', '真的', '十分', '特別', '極', '最', '完全', '好', '相當']
+CONTRASTS = ['但', '但是', '不過', '可是', '然而', '只是']
+
+# 否定、程度詞需在詞條前幾個字元內才生效
+MODIFIER_WINDOW = 3
+NEGATION_FACTOR = 0.8
+INTENSIFIER_FACTOR = 1.5
+# 轉折詞之後的子句通常才是重點
+BEFORE_CONTRAST_FACTOR = 0.5
+AFTER_CONTRAST_FACTOR = 1.5
+EXCLAMATION_FACTOR = 1.2
+
+# 特徵 [正面分數, 負面分數, 中性分數, 1] -> 三類 logit
+DEFAULT_WEIGHTS = np.array([
+    [1.5, -1.0, -0.5],
+    [-1.0, 1.5, -0.5],
+    [-0.5, -0.5, 1.5],
+    [0.0, 0.0, 1.0]
+])
+
+DEFAULT_THRESHOLD = 0.85
+
+def _longest_spans(automaton: AhoCorasick, text: str) -> List[Tuple[int, int]]:
+    """最左、最長、不重疊的比對位置"""
+    spans, position = [], 0
+    for start, end in sorted(automaton.iter_matches(text), key=lambda span: (span[0], -span[1])):
+        if start >= position:
+            spans.append((start, end))
+            position = end
+    return spans
+
+def _preceded_by(text: str, start: int, words: Sequence[str]) -> bool:
+    window = text[max(0, start - MODIFIER_WINDOW):start]
+    return any(word in window for word in words)
+
+class LexiconSentimentClassifier:
+    """詞典 + 規則特徵的線性情感分類器"""
+
+    def __init__(self, weights: np.ndarray = None):
+        self.weights = DEFAULT_WEIGHTS if weights is None else np.asarray(weights, dtype=float)
+        self.terms: Dict[str, Tuple[int, float]] = {}
+        for words, polarity in ((NEUTRAL_CUES, NEUTRAL), (POSITIVE_WORDS, POSITIVE),
+                                (NEGATIVE_WORDS, NEGATIVE)):
+            for word, weight in words.items():
+                self.terms[word] = (polarity, weight)
+        self._terms = AhoCorasick(self.terms)
+        self._contrasts = AhoCorasick(CONTRASTS)
+
+    def _matches(self, text: str):
+        """產生 (類別, 權重) 的比對結果（已套用否定、程度與轉折規則）"""
+        contrast_at = max((end for _, end in self._contrasts.iter_matches(text)), default=None)
+        exclaim = EXCLAMATION_FACTOR if ('!' in text or '！' in text) else 1.0
+        for start, end in _longest_spans(self._terms, text):
+            polarity, weight = self.terms[text[start:end]]
+            if polarity != NEUTRAL:
+                if _preceded_by(text, start, NEGATIONS):
+                    polarity = NEGATIVE if polarity == POSITIVE else POSITIVE
+                    weight *= NEGATION_FACTOR
+                if _preceded_by(text, start, INTENSIFIERS):
+                    weight *= INTENSIFIER_FACTOR
+                weight *= exclaim
+            if contrast_at is not None:
+                weight *= AFTER_CONTRAST_FACTOR if start >= contrast_at else BEFORE_CONTRAST_FACTOR
+            yield polarity, weight
+
+    def features(self, texts: Sequence[str]) -> np.ndarray:
+        """整批文本的特徵矩陣（n × 4）"""
+        rows, columns, values = [], [], []
+        for i, text in enumerate(texts):
+            for polarity, weight in self._matches(text):
+                rows.append(i)
+                columns.append(polarity)
+                values.append(weight)
+        features = np.zeros((len(texts), 4))
+        np.add.at(features, (np.array(rows, dtype=int), np.array(columns, dtype=int)), values)
+        features[:, 3] = 1.0
+        return features
+
+    def predict_proba(self, texts: Sequence[str]) -> np.ndarray:
+        """整批文本的三類機率（n × 3，欄位順序同 SENTIMENTS）"""
+        logits = self.features(texts) @ self.weights
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def classify(self, texts: Sequence[str]) -> List[Dict[str, Any]]:
+        """回傳與 API 相同格式的 {"sentiment", "confidence"} 結果"""
+        probabilities = self.predict_proba(texts)
+        labels = probabilities.argmax(axis=1)
+        return [{"sentiment": SENTIMENTS[label], "confidence": round(float(probabilities[i, label]), 4)}
+                for i, label in enumerate(labels)]
+
+def tune_threshold(classifier: LexiconSentimentClassifier, texts: Sequence[str],
+                   labels: Sequence[str], target_accuracy: float = 0.95,
+                   candidates: np.ndarray = None) -> Dict[str, Any]:
+    """
+    以 API 標註選擇門檻：在本地採用的文本準確率 >= target_accuracy 的前提下，
+    取可在本地處理最多文本的最低門檻；沒有門檻能達標時門檻為 1.01（全部送往 API）
+    """
+    if candidates is None:
+        candidates = np.round(np.arange(0.50, 1.00, 0.01), 2)
+    probabilities = classifier.predict_proba(texts)
+    predicted = probabilities.argmax(axis=1)
+    confidence = probabilities.max(axis=1)
+    expected = np.array([SENTIMENTS.index(label) if label in SENTIMENTS else -1 for label in labels])
+    correct = predicted == expected
+
+    accepted = confidence[None, :] >= candidates[:, None]
+    counts = accepted.sum(axis=1)
+    accuracy = np.divide((accepted & correct[None, :]).sum(axis=1), counts,
+                         out=np.zeros(len(candidates)), where=counts > 0)
+    feasible = np.flatnonzero((accuracy >= target_accuracy) & (counts > 0))
+
+    if len(feasible) == 0:
+        return {'threshold': 1.01, 'coverage': 0.0, 'accuracy': None, 'samples': len(texts)}
+    best = feasible[0]
+    return {
+        'threshold': float(candidates[best]),
+        'coverage': float(counts[best] / len(texts)),
+        'accuracy': float(accuracy[best]),
+        'samples': len(texts)
+    }
+
+class SentimentCascade:
+    """
+    本地優先的情感分類：可信度 >= threshold 的文本採用本地結果，其餘升級到 API
+
+    累計本地處理與升級的數量以計算升級率
+    """
+
+    def __init__(self, classifier: LexiconSentimentClassifier = None,
+                 threshold: float = DEFAULT_THRESHOLD):
+        self.classifier = classifier or LexiconSentimentClassifier()
+        self.threshold = threshold
+        self.local = 0
+        self.escalated = 0
+
+    def split(self, texts: Sequence[str]) -> Tuple[Dict[int, Dict[str, Any]], List[int]]:
+        """回傳 ({位置: 本地結果}, 需要送往 API 的位置)"""
+        if not texts:
+            return {}, []
+        results = self.classifier.classify(texts)
+        local = {i: result for i, result in enumerate(results) if result['confidence'] >= self.threshold}
+        escalate = [i for i in range(len(texts)) if i not in local]
+        self.local += len(local)
+        self.escalated += len(escalate)
+        return local, escalate
+
+    def tune(self, texts: Sequence[str], labels: Sequence[str],
+             target_accuracy: float = 0.95) -> Dict[str, Any]:
+        """以 API 標註調整門檻，回傳調整結果"""
+        report = tune_threshold(self.classifier, texts, labels, target_accuracy)
+        self.threshold = report['threshold']
+        return report
+
+    @property
+    def escalation_rate(self) -> float:
+        total = self.local + self.escalated
+        return self.escalated / total if total else 0.0
+
+    def report(self) -> Dict[str, Any]:
+        return {'local': self.local, 'escalated': self.escalated,
+                'escalation_rate': self.escalation_rate, 'threshold': self.threshold}
+
+    def summary(self) -> str:
+        return (f"🧮 本地分類 {self.local} 筆，升級至 API {self.escalated} 筆 "
+                f"(升級率 {self.escalation_rate:.1%}，門檻 {self.threshold:.2f})")
@@ -1,8 +1,31 @@
-from openai import OpenAI
-import json
 import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
 from dotenv import load_dotenv
 
+# 共用 AI_02 的速率限制等元件
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AI_02'))
+from checkpoint import ProgressJournal, input_fingerprint
+from client_pool import get_client, get_client_provider
+from dedup import plan_dedup
+from hedging import get_default_hedge_budget, hedged_call
+from latency_tracker import get_default_latency_tracker, latency_key
+from prompt_template import PromptTemplate
+from rate_limiter import get_default_limiter
+from reorder_buffer import ReorderBuffer
+from response_cache import get_default_cache, make_cache_key
+from retry_policy import RetryPolicy
+from structured_output import (
+    StructuredOutputError, compile_validator, decode_json, json_schema_format,
+    parse_structured, reask_messages
+)
+from token_utils import chunk_by_token_budget, count_messages_tokens
+from usage_tracker import get_default_usage_tracker
+
+from local_sentiment import SentimentCascade
+
 # 載入環境變數
 load_dotenv()
 
@@ -13,62 +36,367 @@ if not api_key:
     print("請參考 README.md 設定您的 API Key")
     exit(1)
 
-# 初始化 OpenAI 客戶端
-try:
-    client = OpenAI(api_key=api_key)
-    print("✅ OpenAI 客戶端初始化成功")
-except Exception as e:
-    print(f"❌ OpenAI 客戶端初始化失敗: {e}")
-    exit(1)
+MODEL = "gpt-4o-mini"
+TEMPERATURE = 0.1  # 降低隨機性，提高一致性
+# 固定的指令放在系統訊息，文本放在最後，服務端的前綴快取才能命中
+SENTIMENT_INSTRUCTIONS = """分類使用者提供的文本的情感。
+
+只回傳 JSON 格式: {"sentiment": "正面|負面|中性", "confidence": 0.0-1.0}"""
+SENTIMENT_BATCH_INSTRUCTIONS = """分類使用者提供的每一段文本的情感，每段文本以 [編號] 開頭。
+
+只回傳 JSON，依編號每段文本一個結果: {"results": [{"id": 0, "sentiment": "正面|負面|中性", "confidence": 0.0-1.0}]}"""
+SENTIMENT_BATCH_REASK_PROMPT = """以下編號的結果缺漏或格式不符：
+{errors}
+
+請只針對這些編號重新回傳結果（JSON 格式同上），不要重複其他編號。"""
+# 預扣給回應的 token 數，實際用量回來後再校正
+EXPECTED_COMPLETION_TOKENS = 30
+# 回應不符合 schema 時附上錯誤訊息重新詢問的次數
+MAX_REASKS = 1
+# 429 / 5xx / 逾時的退避重試設定
+RETRY_POLICY = RetryPolicy.from_env()
+
+SENTIMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sentiment": {"type": "string", "enum": ["正面", "負面", "中性"]},
+        "confidence": {"type": "number"}
+    },
+    "required": ["sentiment", "confidence"],
+    "additionalProperties": False
+}
+SENTIMENT_BATCH_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "id": {"type": "integer"},
+        **SENTIMENT_SCHEMA["properties"]
+    },
+    "required": ["id", "sentiment", "confidence"],
+    "additionalProperties": False
+}
+SENTIMENT_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {"results": {"type": "array", "items": SENTIMENT_BATCH_ITEM_SCHEMA}},
+    "required": ["results"],
+    "additionalProperties": False
+}
+SENTIMENT_RESPONSE_FORMAT = json_schema_format("sentiment", SENTIMENT_SCHEMA)
+SENTIMENT_BATCH_RESPONSE_FORMAT = json_schema_format("sentiment_batch", SENTIMENT_BATCH_SCHEMA)
+validate_sentiment = compile_validator(SENTIMENT_SCHEMA)
+validate_batch_item = compile_validator(SENTIMENT_BATCH_ITEM_SCHEMA)
+
+SENTIMENT_PROMPT = PromptTemplate("sentiment", SENTIMENT_INSTRUCTIONS, "文本: {text}",
+                                  response_format=SENTIMENT_RESPONSE_FORMAT)
+SENTIMENT_BATCH_PROMPT = PromptTemplate("sentiment_batch", SENTIMENT_BATCH_INSTRUCTIONS, "{documents}",
+                                        response_format=SENTIMENT_BATCH_RESPONSE_FORMAT)
+
+def _send(messages, prompt, latency_key):
+    """送出一次請求並記錄延遲；延遲樣本足夠時以 p95 的倍數作為逾時"""
+    latency = get_default_latency_tracker()
+    options = prompt.request_options()
+    timeout = latency.timeout(latency_key)
+    if timeout is not None:
+        options['timeout'] = timeout
+    
+    # 客戶端來自程序共用的連線池，第一次使用時才建立；重試由 RETRY_POLICY 處理
+    started = time.monotonic()
+    raw_response = get_client(api_key, max_retries=0).chat.completions.with_raw_response.create(
+        model=MODEL,
+        messages=messages,
+        temperature=TEMPERATURE,
+        **options
+    )
+    latency.record(latency_key, time.monotonic() - started)
+    return raw_response
 
-def classify_sentiment(texts):
+def create_completion(messages, completion_tokens=EXPECTED_COMPLETION_TOKENS, prompt=SENTIMENT_PROMPT):
     """
-    分類文本的情感
+    在速率限制下送出結構化輸出的 chat completion 請求（messages 需由 prompt 模板建立）
     
-    Args:
-        texts (list): 要分類的文本列表
+    超過近期 p95 延遲仍未回應時在對沖預算內再送一次相同請求，取先回應者；
+    429、5xx 與逾時以帶抖動的指數退避重試，重試用盡或其他錯誤直接拋出
+    """
+    limiter = get_default_limiter()
+    prompt_tokens = count_messages_tokens(messages, MODEL)
+    estimated_tokens = prompt_tokens + completion_tokens
+    key = latency_key(MODEL, prompt.name, prompt_tokens)
+    hedge_delay = get_default_latency_tracker().hedge_delay(key)
+    
+    def hedge():
+        # 對沖請求同樣佔用速率限制額度
+        limiter.acquire(estimated_tokens)
+        return _send(messages, prompt, key)
+    
+    def attempt():
+        limiter.acquire(estimated_tokens)
+        return hedged_call(lambda: _send(messages, prompt, key), hedge_delay,
+                           get_default_hedge_budget(), estimated_tokens, hedge)
+    
+    raw_response = RETRY_POLICY.call(attempt)
+    
+    # 依回應標頭與實際用量校正限制器，並記錄提示詞 / 前綴快取 / 回應 token 數
+    limiter.update_from_headers(raw_response.headers)
+    response = raw_response.parse()
+    usage = getattr(response, 'usage', None)
+    limiter.record_usage(estimated_tokens, usage.total_tokens if usage else None)
+    get_default_usage_tracker().record(prompt.name, prompt_tokens, usage)
+    return response
+
+def _sentiment_cache_key(text):
+    return make_cache_key(text, MODEL, SENTIMENT_PROMPT.identity, TEMPERATURE)
+
+def classify_single(text):
+    """
+    以單一請求分類一段文本的情感
+    
+    回應不符合 schema 時附上錯誤訊息重新詢問（最多 MAX_REASKS 次），暫時性 API 錯誤
+    由 create_completion 退避重試；仍失敗時只回傳 error 欄位（不填入假的情感），
+    進度日誌會記為失敗以便重試
+    """
+    messages = SENTIMENT_PROMPT.messages(text=text)
+    try:
+        for attempt in range(MAX_REASKS + 1):
+            content = create_completion(messages).choices[0].message.content
+            try:
+                result = parse_structured(content, validate_sentiment)
+                break
+            except StructuredOutputError as e:
+                if attempt == MAX_REASKS:
+                    raise
+                messages = reask_messages(messages, content, e)
+        
+        get_default_cache().set(_sentiment_cache_key(text), result)
+        return result
         
+    except StructuredOutputError as e:
+        print(f"回應格式錯誤: {e}")
+        return {"error": f"回應格式錯誤: {e}"}
+    except Exception as e:
+        print(f"處理文本 '{text}' 時發生錯誤: {e}")
+        return {"error": str(e)}
+
+def _parse_batch_items(content, expected):
+    """
+    解析批次回應，回傳 ({編號: 結果}, {編號: 錯誤訊息})
+    
+    expected 為需要結果的編號；缺漏或格式錯誤的編號列在錯誤中
+    """
+    expected = set(expected)
+    try:
+        items = decode_json(content).get('results')
+    except (StructuredOutputError, AttributeError) as e:
+        return {}, {index: f"回應無法解析: {e}" for index in expected}
+    if not isinstance(items, list):
+        return {}, {index: "回應缺少 results 陣列" for index in expected}
+    
+    parsed, failures = {}, {}
+    for item in items:
+        index = item.get('id') if isinstance(item, dict) else None
+        if not isinstance(index, int) or index not in expected:
+            continue
+        try:
+            validate_batch_item(item)
+        except StructuredOutputError as e:
+            failures[index] = str(e)
+            continue
+        parsed[index] = {"sentiment": item["sentiment"], "confidence": item["confidence"]}
+        failures.pop(index, None)
+    for index in expected - parsed.keys() - failures.keys():
+        failures[index] = "缺少此編號的結果"
+    return parsed, failures
+
+def classify_batch(texts):
+    """
+    以一次請求分類多段文本
+    
+    缺漏或格式錯誤的編號附上錯誤訊息在同一對話中重新詢問，只要求回傳這些編號
+    
     Returns:
-        list: 包含情感分析結果的列表
+        dict: 編號 -> 結果，只包含驗證通過的項目
     """
+    documents = "\n".join(f"[{i}] {text}" for i, text in enumerate(texts))
+    messages = SENTIMENT_BATCH_PROMPT.messages(documents=documents)
+    parsed = {}
+    try:
+        content = create_completion(messages, EXPECTED_COMPLETION_TOKENS * len(texts),
+                                    SENTIMENT_BATCH_PROMPT).choices[0].message.content
+        parsed, failures = _parse_batch_items(content, range(len(texts)))
+        for _ in range(MAX_REASKS):
+            if not failures:
+                break
+            errors = "\n".join(f"[{index}] {error}" for index, error in sorted(failures.items()))
+            messages = messages + [
+                {"role": "assistant", "content": content or ''},
+                {"role": "user", "content": SENTIMENT_BATCH_REASK_PROMPT.format(errors=errors)}
+            ]
+            content = create_completion(messages, EXPECTED_COMPLETION_TOKENS * len(failures),
+                                        SENTIMENT_BATCH_PROMPT).choices[0].message.content
+            retried, failures = _parse_batch_items(content, failures)
+            parsed.update(retried)
+    except Exception as e:
+        # 已驗證通過的項目仍保留，其餘由呼叫端改用單筆請求
+        print(f"批次分類時發生錯誤: {e}")
+    return parsed
+
+def _classify_group(group_texts):
+    """分類一組文本，回傳與輸入對應的結果列表（批次回應缺漏或格式錯誤的項目改用單筆請求）"""
+    parsed = classify_batch(group_texts) if len(group_texts) > 1 else {}
     results = []
+    for position, text in enumerate(group_texts):
+        if position in parsed:
+            result = parsed[position]
+            get_default_cache().set(_sentiment_cache_key(text), result)
+        else:
+            result = classify_single(text)
+        results.append(result)
+    return results
+
+def iter_classify_sentiment(texts, batched=True, max_batch_tokens=1500, max_texts_per_request=50,
+                            journal_path=None, dedup=None, cascade=None, ordered=False,
+                            max_concurrency=4, reorder_window=None):
+    """
+    分類文本的情感，每段文本一有結果就產出 (索引, 結果)
     
-    for text in texts:
+    進度日誌、快取與本地分類的結果立即產出；送往 API 的請求最多 max_concurrency 個
+    同時在途，ordered=False 時依完成順序產出，第一個 API 結果只需等一次往返；
+    ordered=True 時經重排緩衝區依輸入順序產出，請求最多只領先尚未產出的位置
+    reorder_window 個才送出（預設為 max_concurrency 個請求最多涵蓋位置數的 4 倍），
+    暫存的亂序結果因此有上限。其餘參數同 classify_sentiment
+    
+    Yields:
+        tuple: (文本索引, 情感分析結果)
+    """
+    results = [None] * len(texts)
+    cache = get_default_cache()
+    journal = ProgressJournal(journal_path) if journal_path else None
+    if journal is not None:
+        # 日誌以文本索引為鍵，綁定各文本的內容鍵，輸入改變時拒絕續跑
+        journal.bind_input(input_fingerprint(_sentiment_cache_key(text) for text in texts))
+    # 預設視窗為 max_concurrency 個請求最多涵蓋位置數的 4 倍
+    group_size = max_texts_per_request if batched else 1
+    buffer = ReorderBuffer(reorder_window or 4 * max_concurrency * group_size) if ordered else None
+    
+    def release(i):
+        if buffer is None:
+            yield i, results[i]
+        else:
+            yield from buffer.push(i, results[i])
+    
+    # 日誌記錄累積後批次寫入，結束（含提前結束）時寫入剩餘的記錄
+    with journal.batch() if journal is not None else nullcontext():
+        if journal is not None:
+            for i, result in sorted(journal.get_results(range(len(texts))).items()):
+                results[i] = result
+                yield from release(i)
+    
+        pending = []
+        for i, text in enumerate(texts):
+            if results[i] is not None:
+                continue
+            cached = cache.get(_sentiment_cache_key(text))
+            if cached is not None:
+                results[i] = cached
+                yield from release(i)
+            else:
+                pending.append(i)
+    
+        if cascade is not None and pending:
+            local, escalate = cascade.split([texts[i] for i in pending])
+            for position, result in sorted(local.items()):
+                i = pending[position]
+                results[i] = result
+                if journal is not None:
+                    journal.record_success(i, result)
+                yield from release(i)
+            pending = [pending[position] for position in escalate]
+            print(cascade.summary())
+    
+        duplicates = {}
+        if dedup and pending:
+            plan = plan_dedup([texts[i] for i in pending], dedup)
+            duplicates = {pending[rep]: [pending[p] for p in positions]
+                          for rep, positions in plan.duplicates().items()}
+            pending = [pending[p] for p in plan.representatives]
+            print(plan.summary())
+    
+        if batched:
+            groups = chunk_by_token_budget([texts[i] for i in pending], max_batch_tokens,
+                                           max_texts_per_request, model=MODEL)
+        else:
+            groups = [[j] for j in range(len(pending))]
+        groups = [[pending[j] for j in group] for group in groups]
+        
+        # 連線池至少要能容納所有在途請求
+        get_client_provider().ensure_capacity(max_concurrency)
+        pool = ThreadPoolExecutor(max_workers=max_concurrency)
+        in_flight = {}
+        next_group = 0
+        
+        def launch():
+            # 在途請求未滿且組內最小位置進入視窗才送出；該位置之前的結果都已產出或在途
+            nonlocal next_group
+            while (next_group < len(groups) and len(in_flight) < max_concurrency
+                   and (buffer is None or buffer.admits(groups[next_group][0]))):
+                indices = groups[next_group]
+                in_flight[pool.submit(_classify_group, [texts[i] for i in indices])] = indices
+                next_group += 1
+        
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",  # 修正模型名稱
-                messages=[{
-                    "role": "user",
-                    "content": f"""分類以下文本的情感。
-
-只回傳 JSON 格式: {{"sentiment": "正面|負面|中性", "confidence": 0.0-1.0}}
-
-文本: {text}"""
-                }],
-                temperature=0.1  # 降低隨機性，提高一致性
-            )
-            
-            # 修正回應內容的取得方式
-            content = response.choices[0].message.content
-            result = json.loads(content)
-            results.append(result)
-            
-        except json.JSONDecodeError as e:
-            print(f"JSON 解析錯誤: {e}")
-            # 如果 JSON 解析失敗，提供預設結果
-            results.append({
-                "sentiment": "neutral",
-                "confidence": 0.5,
-                "error": "JSON 解析失敗"
-            })
-        except Exception as e:
-            print(f"處理文本 '{text}' 時發生錯誤: {e}")
-            results.append({
-                "sentiment": "neutral", 
-                "confidence": 0.0,
-                "error": str(e)
-            })
+            launch()
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                released = []
+                for future in done:
+                    indices = in_flight.pop(future)
+                    for i, result in zip(indices, future.result()):
+                        results[i] = result
+                        # 重複文本沿用代表文本的結果
+                        for j in duplicates.get(i, []):
+                            results[j] = dict(result)
+                        
+                        for j in [i] + duplicates.get(i, []):
+                            if journal is not None:
+                                if 'error' in results[j]:
+                                    journal.record_failure(j, results[j]['error'])
+                                else:
+                                    journal.record_success(j, results[j])
+                            released.extend(release(j))
+                # 先送出新請求再交給消費端，消費端處理時請求仍在進行
+                launch()
+                yield from released
+        finally:
+            # 提前結束時取消排隊中的請求，並等待在途的請求（最多 max_concurrency 個）結束
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def classify_sentiment(texts, batched=True, max_batch_tokens=1500, max_texts_per_request=50,
+                       journal_path=None, dedup=None, cascade=None, max_concurrency=4):
+    """
+    分類文本的情感
     
+    Args:
+        texts (list): 要分類的文本列表
+        batched (bool): 是否將多段文本合併成一次請求
+        max_batch_tokens (int): 每次批次請求的文本 token 上限
+        max_texts_per_request (int): 每次批次請求的文本數上限
+        journal_path (str): 進度日誌路徑；指定時以文本索引記錄進度，
+            重跑時跳過已完成的項目，只重試失敗或缺少的項目；
+            日誌綁定輸入內容，文本增刪、修改或重新排序後續跑會拋出 ValueError
+        dedup (str): 'exact' 或 'near' 時重複文本只送出一個代表，
+            結果複製給群內其他文本
+        cascade (SentimentCascade): 指定時先以本地分類器處理，
+            只有可信度低於門檻的文本才送往 API
+        max_concurrency (int): 同時在途的 API 請求數上限
+        
+    Returns:
+        list: 包含情感分析結果的列表，順序與輸入相同
+        （需要邊處理邊取得結果時改用 iter_classify_sentiment）
+    """
+    results = [None] * len(texts)
+    for i, result in iter_classify_sentiment(texts, batched, max_batch_tokens, max_texts_per_request,
+                                             journal_path, dedup, cascade,
+                                             max_concurrency=max_concurrency):
+        results[i] = result
     return results
 
 def load_texts_from_file(filename):
@@ -92,8 +420,31 @@ def load_texts_from_file(filename):
         print(f"讀取檔案時發生錯誤: {e}")
         return []
 
+def tune_cascade(cascade, texts, target_accuracy=0.95):
+    """
+    以快取中的 API 標註調整本地分類器的門檻
+    
+    只使用快取中成功分類的文本；沒有任何標註時維持原門檻
+    """
+    cache = get_default_cache()
+    labeled = []
+    for text in texts:
+        cached = cache.get(_sentiment_cache_key(text))
+        if cached is not None and 'error' not in cached:
+            labeled.append((text, cached['sentiment']))
+    if not labeled:
+        print("⚠️ 快取中沒有 API 標註，維持原門檻")
+        return None
+    
+    report = cascade.tune([text for text, _ in labeled], [label for _, label in labeled],
+                          target_accuracy)
+    accuracy = f"{report['accuracy']:.1%}" if report['accuracy'] is not None else '未達標'
+    print(f"🎯 以 {report['samples']} 筆 API 標註調整門檻: {report['threshold']:.2f} "
+          f"(本地涵蓋率 {report['coverage']:.1%}，準確率 {accuracy})")
+    return report
+
 def main():
-    """主程式執行區塊"""
+    """主程式執行區塊（加上 --tune 參數時先以快取中的 API 標註調整本地分類門檻）"""
     # 從 demo.txt 讀取文本
     texts = load_texts_from_file("demo.txt")
     
@@ -101,12 +452,17 @@ def main():
         print("沒有找到有效的文本，使用預設範例...")
         texts = ["太棒了！", "很失望", "還不錯"]
     
+    cascade = SentimentCascade()
+    if '--tune' in sys.argv:
+        tune_cascade(cascade, texts)
+    
     print(f"開始情感分析... (共 {len(texts)} 個文本)")
-    classifications = classify_sentiment(texts)
+    classifications = [None] * len(texts)
     
-    # 顯示結果
-    for i, (text, result) in enumerate(zip(texts, classifications)):
-        print(f"\n文本 {i+1}: {text}")
+    # 依輸入順序逐筆顯示結果，不必等全部文本完成
+    for i, result in iter_classify_sentiment(texts, dedup='exact', cascade=cascade, ordered=True):
+        classifications[i] = result
+        print(f"\n文本 {i+1}: {texts[i]}")
         print(f"情感: {result.get('sentiment', 'unknown')}")
         print(f"信心度: {result.get('confidence', 0):.2f}")
         if 'error' in result:
@@ -121,6 +477,15 @@ def main():
     print(f"\n=== 統計結果 ===")
     for sentiment, count in sentiment_counts.items():
         print(f"{sentiment}: {count} 個")
+    
+    cache_stats = get_default_cache().stats()
+    print(f"\n快取命中 {cache_stats['hits']} 次，未命中 {cache_stats['misses']} 次 "
+          f"(命中率 {cache_stats['hit_rate']:.1%})")
+    print(get_default_usage_tracker().summary())
+    latency = get_default_latency_tracker()
+    if latency.keys():
+        print(latency.summary())
+        print(get_default_hedge_budget().summary())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
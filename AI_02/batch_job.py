@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OpenAI Batch API 離線批次任務
+將實體識別請求寫成 JSONL（依 Batch API 的筆數與檔案大小上限切成多個批次）、
+提交批次、輪詢完成後依 custom_id 合併回與 batch_process_texts 相同結構的
+DataFrame；批次 id 記錄在任務狀態檔中以便續跑；附本地假端點可離線測試
+"""
+
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List
+
+import pandas as pd
+
+from client_pool import get_client
+from ner_simple import (
+    NER_PROMPT, SimpleNER, build_error_row, build_ner_messages, build_result_row,
+    parse_entities_response
+)
+from response_cache import ResponseCache, get_default_cache, make_cache_key
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+# Batch API 每個輸入檔的上限：50,000 個請求、200 MB
+MAX_BATCH_REQUESTS = 50_000
+MAX_BATCH_FILE_BYTES = 200 * 1024 * 1024
+
+def _custom_id(text_id: int) -> str:
+    return f"text-{text_id}"
+
+def build_batch_requests(texts: List[str], text_ids: List[int] = None) -> List[Dict[str, Any]]:
+    """建立 Batch API 的請求列"""
+    text_ids = text_ids if text_ids is not None else list(range(len(texts)))
+    return [
+        {
+            "custom_id": _custom_id(text_id),
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {
+                "model": SimpleNER.model,
+                "messages": build_ner_messages(text),
+                "temperature": SimpleNER.temperature,
+                **NER_PROMPT.request_options()
+            }
+        }
+        for text_id, text in zip(text_ids, texts)
+    ]
+
+def write_batch_files(requests: List[Dict[str, Any]], path_prefix: str,
+                      max_requests: int = MAX_BATCH_REQUESTS,
+                      max_bytes: int = MAX_BATCH_FILE_BYTES) -> List[Dict[str, Any]]:
+    """
+    將請求依筆數與檔案大小上限切成多個 JSONL 檔，回傳各檔的 {input_path, requests}
+
+    檔名為 path_prefix-000.jsonl、path_prefix-001.jsonl ...
+    """
+    parts = []
+    f, count, size = None, 0, 0
+    try:
+        for request in requests:
+            line = (json.dumps(request, ensure_ascii=False) + '\n').encode('utf-8')
+            if len(line) > max_bytes:
+                raise ValueError(f"請求 {request['custom_id']} 超過單一批次檔案大小上限")
+            if f is None or count >= max_requests or size + len(line) > max_bytes:
+                if f is not None:
+                    f.close()
+                    parts[-1]['requests'] = count
+                path = f"{path_prefix}-{len(parts):03d}.jsonl"
+                parts.append({'input_path': path, 'requests': 0, 'batch_id': None})
+                f, count, size = open(path, 'wb'), 0, 0
+            f.write(line)
+            count += 1
+            size += len(line)
+    finally:
+        if f is not None:
+            f.close()
+            parts[-1]['requests'] = count
+    return parts
+
+def load_job_state(path: str) -> Dict[str, Any]:
+    """讀取任務狀態檔，不存在時回傳 None"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_job_state(path: str, state: Dict[str, Any]):
+    """以暫存檔 + 改名寫入任務狀態，中斷時不會留下不完整的檔案"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def _job_fingerprint(texts: List[str], pending: List[int]) -> str:
+    """待送出文本與提示詞的指紋，相同輸入重跑時對應到同一個任務狀態檔"""
+    digest = hashlib.sha256(NER_PROMPT.identity.encode('utf-8'))
+    for i in pending:
+        digest.update(f"{i}\t{texts[i]}\n".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def submit_batch(client, path: str):
+    """上傳 JSONL 並建立批次任務"""
+    with open(path, 'rb') as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    return client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h"
+    )
+
+def wait_for_batch(client, batch_id: str, poll_interval: float = 30.0, timeout: float = None):
+    """輪詢批次任務直到結束"""
+    started = time.monotonic()
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        counts = getattr(batch, 'request_counts', None)
+        if counts is not None:
+            print(f"  狀態: {batch.status} ({counts.completed}/{counts.total} 完成, {counts.failed} 失敗)")
+        else:
+            print(f"  狀態: {batch.status}")
+
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        if timeout is not None and time.monotonic() - started > timeout:
+            raise TimeoutError(f"批次任務 {batch_id} 等待逾時")
+        time.sleep(poll_interval)
+
+def download_batch_output(client, batch) -> Dict[str, Dict[str, Any]]:
+    """下載批次輸出與錯誤檔，回傳 custom_id -> 輸出列"""
+    outputs = {}
+    for file_id in (batch.output_file_id, getattr(batch, 'error_file_id', None)):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if line.strip():
+                record = json.loads(line)
+                outputs[record['custom_id']] = record
+    return outputs
+
+def _entities_from_output(record: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """從單一輸出列取出實體；請求失敗時拋出例外"""
+    if record.get('error'):
+        raise RuntimeError(record['error'].get('message', str(record['error'])))
+    response = record['response']
+    if response['status_code'] != 200:
+        raise RuntimeError(f"HTTP {response['status_code']}")
+    content = response['body']['choices'][0]['message']['content']
+    return parse_entities_response(content)
+
+def merge_batch_results(texts: List[str], outputs: Dict[str, Dict[str, Any]],
+                        cached: Dict[int, List[Dict[str, Any]]] = None) -> pd.DataFrame:
+    """將批次輸出合併成 batch_process_texts 的結果結構"""
+    cached = cached or {}
+    rows = []
+    for i, text in enumerate(texts):
+        if i in cached:
+            rows.append(build_result_row(i, text, cached[i]))
+            continue
+        record = outputs.get(_custom_id(i))
+        if record is None:
+            rows.append(build_error_row(i, text, "批次輸出中缺少此文本"))
+            continue
+        try:
+            rows.append(build_result_row(i, text, _entities_from_output(record)))
+        except Exception as e:
+            rows.append(build_error_row(i, text, e))
+    return pd.DataFrame(rows)
+
+def run_batch_job(texts: List[str], client=None, work_dir: str = "batch_jobs",
+                  poll_interval: float = 30.0, timeout: float = None,
+                  cache: ResponseCache = None, use_cache: bool = True,
+                  max_requests_per_batch: int = MAX_BATCH_REQUESTS,
+                  max_batch_bytes: int = MAX_BATCH_FILE_BYTES) -> pd.DataFrame:
+    """
+    以 Batch API 執行實體識別並回傳結果 DataFrame
+
+    已在快取中的文本不會送出；成功解析的結果會寫回快取。
+    請求超過單一批次的上限時切成多個批次一起提交，各批次 id 記錄在
+    work_dir 的任務狀態檔中：以相同輸入重跑時沿用已提交的批次，不會重複送出；
+    全部批次結束並合併後刪除狀態檔
+    """
+    if client is None:
+        client = get_client()
+    cache = (cache or get_default_cache()) if use_cache else None
+
+    def cache_key(text):
+        return make_cache_key(text, SimpleNER.model, NER_PROMPT.identity, SimpleNER.temperature)
+
+    cached = {}
+    if cache is not None:
+        for i, text in enumerate(texts):
+            entities = cache.get(cache_key(text))
+            if entities is not None:
+                cached[i] = entities
+
+    pending = [i for i in range(len(texts)) if i not in cached]
+    print(f"\n📦 Batch API 處理 {len(texts)} 個文本（{len(cached)} 個命中快取，{len(pending)} 個送出）")
+    print("=" * 50)
+
+    outputs = {}
+    state_path = None
+    if pending:
+        os.makedirs(work_dir, exist_ok=True)
+        job_id = _job_fingerprint(texts, pending)
+        state_path = os.path.join(work_dir, f"ner_batch_{job_id}.state.json")
+        state = load_job_state(state_path)
+        if state is None:
+            parts = write_batch_files(build_batch_requests([texts[i] for i in pending], pending),
+                                      os.path.join(work_dir, f"ner_batch_{job_id}"),
+                                      max_requests_per_batch, max_batch_bytes)
+            state = {'job_id': job_id, 'parts': parts}
+            save_job_state(state_path, state)
+        else:
+            submitted = sum(1 for part in state['parts'] if part['batch_id'])
+            print(f"  ⏩ 續跑任務 {job_id}：{submitted}/{len(state['parts'])} 個批次已提交")
+
+        # 先提交所有批次再一起等待；每提交一個就更新狀態檔
+        for part in state['parts']:
+            if part['batch_id'] is None:
+                part['batch_id'] = submit_batch(client, part['input_path']).id
+                save_job_state(state_path, state)
+                print(f"  已提交批次任務: {part['batch_id']}（{part['requests']} 個請求）")
+
+        for part in state['parts']:
+            batch = wait_for_batch(client, part['batch_id'], poll_interval, timeout)
+            if batch.status != 'completed':
+                print(f"  ⚠️ 批次任務 {batch.id} 結束狀態: {batch.status}")
+            if getattr(batch, 'output_file_id', None) or getattr(batch, 'error_file_id', None):
+                outputs.update(download_batch_output(client, batch))
+
+    df = merge_batch_results(texts, outputs, cached)
+
+    if cache is not None:
+        for i in pending:
+            row = df.iloc[i]
+            if row['processed']:
+                cache.set(cache_key(texts[i]), json.loads(row['entities']))
+    if state_path is not None:
+        os.remove(state_path)
+
+    return df
+
+# ---------------------------------------------------------------------------
+# 本地假 Batch 端點：模擬 files / batches API，可在無網路時測試完整流程
+# ---------------------------------------------------------------------------
+
+class FakeBatchClient:
+    """
+    模擬 OpenAI files 與 batches API 的本地客戶端
+
+    responder 接收請求 body 並回傳 assistant 訊息內容；
+    批次在被查詢 polls_until_complete 次後才會完成
+    """
+
+    def __init__(self, responder: Callable[[Dict[str, Any]], str] = None,
+                 polls_until_complete: int = 2):
+        self.responder = responder or (lambda body: json.dumps({"entities": []}))
+        self.polls_until_complete = polls_until_complete
+        self._files: Dict[str, str] = {}
+        self._batches: Dict[str, Dict[str, Any]] = {}
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+
+    def _store(self, text: str) -> str:
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        self._files[file_id] = text
+        return file_id
+
+    def _create_file(self, file, purpose: str):
+        data = file.read()
+        text = data.decode('utf-8') if isinstance(data, bytes) else data
+        return SimpleNamespace(id=self._store(text), purpose=purpose)
+
+    def _file_content(self, file_id: str):
+        return SimpleNamespace(text=self._files[file_id])
+
+    def _create_batch(self, input_file_id: str, endpoint: str, completion_window: str):
+        batch_id = f"batch-{uuid.uuid4().hex[:12]}"
+        self._batches[batch_id] = {'input_file_id': input_file_id, 'polls': 0,
+                                   'output_file_id': None, 'error_file_id': None}
+        return self._retrieve_batch(batch_id, count_poll=False)
+
+    def _run(self, batch: Dict[str, Any]):
+        output, errors = io.StringIO(), io.StringIO()
+        for line in self._files[batch['input_file_id']].splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            try:
+                content = self.responder(request['body'])
+                record = {
+                    "custom_id": request['custom_id'],
+                    "response": {"status_code": 200, "body": {
+                        "choices": [{"message": {"role": "assistant", "content": content}}]
+                    }},
+                    "error": None
+                }
+                output.write(json.dumps(record, ensure_ascii=False) + '\n')
+            except Exception as e:
+                record = {"custom_id": request['custom_id'], "response": None,
+                          "error": {"message": str(e)}}
+                errors.write(json.dumps(record, ensure_ascii=False) + '\n')
+        batch['output_file_id'] = self._store(output.getvalue())
+        if errors.getvalue():
+            batch['error_file_id'] = self._store(errors.getvalue())
+
+    def _retrieve_batch(self, batch_id: str, count_poll: bool = True):
+        batch = self._batches[batch_id]
+        total = len([l for l in self._files[batch['input_file_id']].splitlines() if l.strip()])
+        if count_poll:
+            batch['polls'] += 1
+        done = batch['polls'] >= self.polls_until_complete
+        if done and batch['output_file_id'] is None:
+            self._run(batch)
+        failed = 0
+        if batch['error_file_id']:
+            failed = len(self._files[batch['error_file_id']].splitlines())
+        return SimpleNamespace(
+            id=batch_id,
+            status='completed' if done else 'in_progress',
+            output_file_id=batch['output_file_id'],
+            error_file_id=batch['error_file_id'],
+            request_counts=SimpleNamespace(total=total, completed=total - failed if done else 0,
+                                           failed=failed)
+        )
+
+def main():
+    """主程式：加上 --fake 參數時使用本地假端點"""
+    texts = [
+        "台灣半導體龍頭台積電將在台南投資1000億元",
+        "張經理，我們下週三在台北市信義區會面",
+        "陳小華畢業於台灣大學，現任Google工程師",
+        "甲方：台灣科技公司，合約金額200萬元",
+        "患者王小明，診斷高血壓，處方Amlodipine"
+    ]
+
+    if '--fake' in sys.argv:
+        df = run_batch_job(texts, client=FakeBatchClient(), poll_interval=0, use_cache=False)
+    else:
+        df = run_batch_job(texts)
+
+    df.to_csv('ner_labeled_data.csv', index=False, encoding='utf-8')
+    print(f"\n✅ 結果已保存至 'ner_labeled_data.csv'（成功 {int(df['processed'].sum())}/{len(df)}）")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+長時間任務的進度日誌
+以 SQLite 記錄每個 text_id 的狀態與結果，中斷後重跑時可跳過已完成的項目；
+大量寫入時以 batch() 累積記錄，再以 executemany 在同一個交易中寫入；
+以位置作為 text_id 時可用 bind_input() 綁定輸入指紋，避免輸入改變後沿用錯位的結果
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+# 每次 IN (...) 查詢的 id 數（低於舊版 SQLite 的 999 個參數上限）
+LOOKUP_CHUNK = 900
+
+_INSERT_SQL = ('INSERT OR REPLACE INTO progress (text_id, status, result, error, updated_at) '
+               'VALUES (?, ?, ?, ?, ?)')
+
+def input_fingerprint(keys: Iterable[str]) -> str:
+    """依序雜湊各項目的內容鍵，產生整份輸入的指紋"""
+    digest = hashlib.sha256()
+    for key in keys:
+        digest.update(key.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+class ProgressJournal:
+    """
+    text_id -> 狀態/結果 的持久化進度日誌（執行緒安全）
+
+    batch() 期間的記錄先放在記憶體，每 flush_size 筆或 flush_interval 秒寫入一次；
+    中斷時最多遺失尚未寫入的記錄，重跑時這些項目會重新處理
+    """
+
+    def __init__(self, path: str, flush_size: int = 1000, flush_interval: float = 2.0):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending: List[Tuple] = []
+        self._batch_depth = 0
+        self._last_flush = time.monotonic()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS progress (
+                text_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS journal_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def bind_input(self, fingerprint: str):
+        """
+        綁定輸入指紋
+
+        新日誌記下指紋；既有日誌的指紋不同時拋出 ValueError，
+        避免輸入增刪或重新排序後以相同位置沿用其他文本的結果
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM journal_meta WHERE key = 'input_fingerprint'"
+            ).fetchone()
+            if row is None:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT INTO journal_meta (key, value) VALUES ('input_fingerprint', ?)",
+                        (fingerprint,)
+                    )
+            elif row[0] != fingerprint:
+                raise ValueError(f"進度日誌 {self.path} 屬於不同的輸入，請刪除後重跑或改用其他路徑")
+
+    def _flush_locked(self):
+        """在同一個交易中寫入累積的記錄（呼叫端需持有鎖）"""
+        if self._pending:
+            with self._conn:
+                self._conn.executemany(_INSERT_SQL, self._pending)
+            self._pending = []
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        """立即寫入累積的記錄"""
+        with self._lock:
+            self._flush_locked()
+
+    @contextmanager
+    def batch(self):
+        """期間的記錄累積後批次寫入，離開時寫入剩餘的記錄（可巢狀使用）"""
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._flush_locked()
+
+    def _ids_with_status(self, status: str) -> Set[int]:
+        with self._lock:
+            self._flush_locked()
+            rows = self._conn.execute('SELECT text_id FROM progress WHERE status = ?', (status,))
+            return {row[0] for row in rows}
+
+    def completed_ids(self) -> Set[int]:
+        """已成功完成的 text_id"""
+        return self._ids_with_status(STATUS_DONE)
+
+    def failed_ids(self) -> Set[int]:
+        """曾經失敗且尚未成功的 text_id"""
+        return self._ids_with_status(STATUS_FAILED)
+
+    def get_result(self, text_id: int) -> Optional[Any]:
+        """取得已完成項目的結果"""
+        with self._lock:
+            self._flush_locked()
+            row = self._conn.execute(
+                'SELECT result FROM progress WHERE text_id = ? AND status = ?',
+                (text_id, STATUS_DONE)
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def get_results(self, text_ids: Iterable[int]) -> Dict[int, Any]:
+        """批次取得已完成項目的結果（每 LOOKUP_CHUNK 個 id 一次查詢）"""
+        ids = [int(text_id) for text_id in text_ids]
+        results = {}
+        with self._lock:
+            self._flush_locked()
+            for start in range(0, len(ids), LOOKUP_CHUNK):
+                chunk = ids[start:start + LOOKUP_CHUNK]
+                rows = self._conn.execute(
+                    f"SELECT text_id, result FROM progress "
+                    f"WHERE status = ? AND text_id IN ({','.join('?' * len(chunk))})",
+                    (STATUS_DONE, *chunk)
+                )
+                results.update((text_id, json.loads(result)) for text_id, result in rows
+                               if result is not None)
+        return results
+
+    def _record(self, text_id: int, status: str, result: Any = None, error: str = None):
+        row = (int(text_id), status,
+               json.dumps(result, ensure_ascii=False) if result is not None else None,
+               error, time.time())
+        with self._lock:
+            self._pending.append(row)
+            # 不在 batch() 中時立即寫入；batch() 中依筆數或時間間隔寫入
+            if (self._batch_depth == 0 or len(self._pending) >= self.flush_size
+                    or time.monotonic() - self._last_flush >= self.flush_interval):
+                self._flush_locked()
+
+    def record_success(self, text_id: int, result: Any):
+        """記錄成功完成的項目"""
+        self._record(text_id, STATUS_DONE, result=result)
+
+    def record_failure(self, text_id: int, error: str):
+        """記錄失敗的項目"""
+        self._record(text_id, STATUS_FAILED, error=error)
+
+    def summary(self) -> Dict[str, int]:
+        """各狀態的項目數"""
+        with self._lock:
+            self._flush_locked()
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM progress GROUP BY status')
+            return dict(rows.fetchall())
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            self._conn.close()
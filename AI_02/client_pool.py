@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共用的 OpenAI 客戶端
+整個程序共用同一組 HTTP 連線池（可設定連線數、keep-alive、HTTP/2 與逾時），
+避免每次建立客戶端都重新握手 TLS、連線池從零開始
+"""
+
+import asyncio
+import os
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支援需要 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+class ClientConfig:
+    """連線池與逾時設定"""
+
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 100,
+                 keepalive_expiry: float = 60.0, http2: bool = True,
+                 timeout: float = 60.0, connect_timeout: float = 5.0, max_retries: int = 2):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        # 未安裝 h2 時自動退回 HTTP/1.1
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+
+    @classmethod
+    def from_env(cls) -> 'ClientConfig':
+        """從環境變數讀取設定（OPENAI_MAX_CONNECTIONS、OPENAI_HTTP2 等）"""
+        max_connections = int(os.getenv('OPENAI_MAX_CONNECTIONS', '100'))
+        return cls(
+            max_connections=max_connections,
+            max_keepalive_connections=int(os.getenv('OPENAI_MAX_KEEPALIVE', str(max_connections))),
+            keepalive_expiry=float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', '60')),
+            http2=os.getenv('OPENAI_HTTP2', '1').lower() not in ('0', 'false', 'no'),
+            timeout=float(os.getenv('OPENAI_TIMEOUT', '60')),
+            connect_timeout=float(os.getenv('OPENAI_CONNECT_TIMEOUT', '5')),
+            max_retries=int(os.getenv('OPENAI_MAX_RETRIES', '2'))
+        )
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_keepalive_connections,
+                            keepalive_expiry=self.keepalive_expiry)
+
+    def httpx_timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.timeout, connect=self.connect_timeout)
+
+class ClientProvider:
+    """
+    依 (API Key, 組織) 快取 OpenAI 客戶端（執行緒安全）
+
+    同步客戶端整個程序共用；非同步客戶端的連線綁定事件迴圈，
+    因此每個事件迴圈各有一個，迴圈結束後自動釋放
+    """
+
+    def __init__(self, config: ClientConfig = None):
+        self.config = config or ClientConfig.from_env()
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple, OpenAI] = {}
+        self._async_clients: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+
+    def get_client(self, api_key: str = None, organization: str = None,
+                   max_retries: int = None) -> OpenAI:
+        """
+        取得共用的同步客戶端
+
+        指定 max_retries 時回傳共用同一連線池、但 SDK 內建重試次數不同的客戶端
+        （由呼叫端自行處理重試時傳入 0）
+        """
+        key = (api_key or os.getenv('OPENAI_API_KEY'), organization)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = OpenAI(
+                    api_key=key[0],
+                    organization=organization,
+                    max_retries=self.config.max_retries,
+                    http_client=httpx.Client(limits=self.config.limits(),
+                                             timeout=self.config.httpx_timeout(),
+                                             http2=self.config.http2)
+                )
+                self._clients[key] = client
+            return self._with_retries(self._clients, key, client, max_retries)
+
+    def get_async_client(self, api_key: str = None, organization: str = None,
+                         max_retries: int = None) -> AsyncOpenAI:
+        """取得目前事件迴圈共用的非同步客戶端（需在事件迴圈中呼叫）"""
+        key = (api_key or os.getenv('OPENAI_API_KEY'), organization)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(key)
+            if client is None:
+                client = AsyncOpenAI(
+                    api_key=key[0],
+                    organization=organization,
+                    max_retries=self.config.max_retries,
+                    http_client=httpx.AsyncClient(limits=self.config.limits(),
+                                                  timeout=self.config.httpx_timeout(),
+                                                  http2=self.config.http2)
+                )
+                clients[key] = client
+            return self._with_retries(clients, key, client, max_retries)
+
+    def _with_retries(self, clients: Dict, key: Tuple[str, Optional[str]], client,
+                      max_retries: Optional[int]):
+        """同一客戶端的不同重試次數版本（共用連線池，快取在 clients 中）"""
+        if max_retries is None or max_retries == self.config.max_retries:
+            return client
+        variant_key = key + (max_retries,)
+        variant = clients.get(variant_key)
+        if variant is None:
+            variant = clients[variant_key] = client.with_options(max_retries=max_retries)
+        return variant
+
+    def ensure_capacity(self, in_flight: int):
+        """
+        確保連線池足以支撐 in_flight 個同時進行的請求
+
+        連線數不足時放大設定並讓之後取得的客戶端使用新的連線池；
+        舊客戶端可能仍有請求在途，不主動關閉，交由垃圾回收釋放
+        """
+        with self._lock:
+            if in_flight <= self.config.max_connections:
+                return
+            self.config.max_connections = in_flight
+            self.config.max_keepalive_connections = max(self.config.max_keepalive_connections, in_flight)
+            self._clients = {}
+            self._async_clients = weakref.WeakKeyDictionary()
+
+    def close(self):
+        """關閉同步客戶端的連線池"""
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        # 不同重試次數的版本共用連線池，只需關閉原始客戶端
+        for key, client in clients.items():
+            if len(key) == 2:
+                client.close()
+
+_default_provider: Optional[ClientProvider] = None
+_default_lock = threading.Lock()
+
+def get_client_provider() -> ClientProvider:
+    """取得程序內共用的客戶端提供者"""
+    global _default_provider
+    with _default_lock:
+        if _default_provider is None:
+            _default_provider = ClientProvider()
+        return _default_provider
+
+def get_client(api_key: str = None, organization: str = None, max_retries: int = None) -> OpenAI:
+    """取得程序內共用的同步 OpenAI 客戶端"""
+    return get_client_provider().get_client(api_key, organization, max_retries)
+
+def get_async_client(api_key: str = None, organization: str = None,
+                     max_retries: int = None) -> AsyncOpenAI:
+    """取得目前事件迴圈共用的非同步 OpenAI 客戶端"""
+    return get_client_provider().get_async_client(api_key, organization, max_retries)
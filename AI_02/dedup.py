@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+送出請求前的文本去重
+正規化後以雜湊合併完全重複的文本，並可用 MinHash/LSH 將近似重複的文本分群；
+每群只送出一個代表文本，結果再分送回群內每個原始文本
+"""
+
+import hashlib
+import zlib
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+from response_cache import normalize_text
+
+DEDUP_EXACT = 'exact'
+DEDUP_NEAR = 'near'
+DEFAULT_NEAR_THRESHOLD = 0.9
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+def dedup_key(text: str) -> str:
+    """完全重複判斷用的鍵（NFKC 正規化並合併空白後取雜湊）"""
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+class MinHasher:
+    """以字元 n-gram 計算 MinHash 簽章"""
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        k = self.shingle_size
+        shingles = {text[i:i + k] for i in range(max(1, len(text) - k + 1))}
+        hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        permuted = (hashes[:, None] * self._a + self._b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0)
+
+def _lsh_bands(threshold: float, num_perm: int):
+    """選擇 (band 數, 每 band 列數)，使 LSH 的門檻 (1/b)^(1/r) 最接近且不高於 threshold"""
+    options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    below = [option for option in options if (1 / option[0]) ** (1 / option[1]) <= threshold]
+    return max(below or options, key=lambda option: (1 / option[0]) ** (1 / option[1]))
+
+class _UnionFind:
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, x: int) -> int:
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x: int, y: int):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            # 以位置較前者為代表
+            self.parent[max(x, y)] = min(x, y)
+
+class DedupPlan:
+    """
+    去重結果
+
+    assignment[i] 為第 i 個文本的代表文本位置（代表文本指向自己）
+    """
+
+    def __init__(self, assignment: List[int], exact_duplicates: int = 0, near_duplicates: int = 0):
+        self.assignment = assignment
+        self.exact_duplicates = exact_duplicates
+        self.near_duplicates = near_duplicates
+
+    @property
+    def representatives(self) -> List[int]:
+        """需要實際送出的文本位置"""
+        return [i for i, rep in enumerate(self.assignment) if rep == i]
+
+    def duplicates(self) -> Dict[int, List[int]]:
+        """代表文本位置 -> 其餘重複文本的位置"""
+        groups: Dict[int, List[int]] = {}
+        for i, rep in enumerate(self.assignment):
+            if rep != i:
+                groups.setdefault(rep, []).append(i)
+        return groups
+
+    @property
+    def saved(self) -> int:
+        return len(self.assignment) - len(self.representatives)
+
+    def report(self) -> Dict[str, int]:
+        return {
+            'texts': len(self.assignment),
+            'requests': len(self.representatives),
+            'exact_duplicates': self.exact_duplicates,
+            'near_duplicates': self.near_duplicates,
+            'saved': self.saved
+        }
+
+    def summary(self) -> str:
+        rate = self.saved / len(self.assignment) if self.assignment else 0.0
+        return (f"🧹 去重: {len(self.assignment)} 個文本 → {len(self.representatives)} 個代表文本 "
+                f"(完全重複 {self.exact_duplicates}，近似重複 {self.near_duplicates}，"
+                f"節省 {self.saved} 次呼叫，{rate:.1%})")
+
+def plan_dedup(texts: Sequence[str], mode: str = DEDUP_EXACT,
+               threshold: float = DEFAULT_NEAR_THRESHOLD, num_perm: int = 128,
+               shingle_size: int = 5) -> DedupPlan:
+    """
+    建立去重計畫
+
+    mode 為 'exact' 時只合併正規化後相同的文本；'near' 時另以 MinHash/LSH
+    找出估計 Jaccard 相似度 >= threshold 的文本並分到同一群
+    """
+    if mode not in (DEDUP_EXACT, DEDUP_NEAR):
+        raise ValueError(f"未知的去重模式: {mode}")
+
+    assignment = list(range(len(texts)))
+    first_seen: Dict[str, int] = {}
+    exact_duplicates = 0
+    for i, text in enumerate(texts):
+        key = dedup_key(text)
+        if key in first_seen:
+            assignment[i] = first_seen[key]
+            exact_duplicates += 1
+        else:
+            first_seen[key] = i
+
+    near_duplicates = 0
+    if mode == DEDUP_NEAR:
+        unique = [i for i, rep in enumerate(assignment) if rep == i]
+        clusters = _near_duplicate_clusters([normalize_text(texts[i]) for i in unique], threshold,
+                                            num_perm, shingle_size)
+        for position, cluster_rep in enumerate(clusters):
+            if cluster_rep != position:
+                near_duplicates += 1
+        representative = {unique[p]: unique[rep] for p, rep in enumerate(clusters)}
+        assignment = [representative[rep] for rep in assignment]
+
+    return DedupPlan(assignment, exact_duplicates, near_duplicates)
+
+def _near_duplicate_clusters(texts: List[str], threshold: float, num_perm: int,
+                             shingle_size: int) -> List[int]:
+    """以 LSH 找候選配對、再以簽章相似度確認，回傳每個位置所屬群的代表位置"""
+    if len(texts) < 2:
+        return list(range(len(texts)))
+
+    hasher = MinHasher(num_perm, shingle_size)
+    signatures = np.vstack([hasher.signature(text) for text in texts])
+    bands, rows = _lsh_bands(threshold, num_perm)
+    union_find = _UnionFind(len(texts))
+
+    for band in range(bands):
+        buckets: Dict[bytes, List[int]] = {}
+        block = signatures[:, band * rows:(band + 1) * rows]
+        for i in range(len(texts)):
+            buckets.setdefault(block[i].tobytes(), []).append(i)
+        for members in buckets.values():
+            for other in members[1:]:
+                if union_find.find(other) == union_find.find(members[0]):
+                    continue
+                similarity = float(np.mean(signatures[members[0]] == signatures[other]))
+                if similarity >= threshold:
+                    union_find.union(members[0], other)
+
+    return [union_find.find(i) for i in range(len(texts))]
+
+def entities_for_duplicate(entities: List[Dict[str, Any]], text: str) -> List[Dict[str, Any]]:
+    """代表文本的實體分送給重複文本時，只保留確實出現在該文本中的實體"""
+    normalized = normalize_text(text)
+    return [entity for entity in entities
+            if isinstance(entity, dict) and normalize_text(str(entity.get('text', ''))) in normalized]
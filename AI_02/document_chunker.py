@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+長文件切段與實體合併
+依句子邊界與 token 預算將長文件切成有重疊的段落，各段分別識別後
+以字元位置合併實體，並去除重疊區重複識別的實體
+"""
+
+import re
+from typing import Any, Dict, List, Sequence, Tuple
+
+from token_utils import count_tokens
+
+# 句子結尾（含其後的右括號/引號）、換行、英文句點後的空白
+_SENTENCE_END = re.compile(r'[。！？!?；;]+[」』”’）)]*|\n+|(?<=\.)\s+')
+# 句子仍超過預算時改以子句標點切分
+_CLAUSE_END = re.compile(r'[，,、：:]+')
+
+Span = Tuple[int, int]
+
+def _boundary_spans(text: str, start: int, end: int, pattern) -> List[Span]:
+    """以 pattern 的結尾位置切分 text[start:end]，分隔符號留在前一段"""
+    spans, position = [], start
+    for match in pattern.finditer(text, start, end):
+        if match.end() > position:
+            spans.append((position, match.end()))
+            position = match.end()
+    if position < end:
+        spans.append((position, end))
+    return spans
+
+def _hard_split(text: str, start: int, end: int, max_tokens: int, model: str = None) -> List[Span]:
+    """
+    沒有標點可用時依 token 數硬切
+
+    每段先倍增長度找出超過預算的上界，再二分搜尋不超過預算的最長前綴，
+    計數的文字長度不超過段落長度的兩倍
+    """
+    spans, position = [], start
+    while position < end:
+        # 至少切出一個字元
+        low, step = position + 1, max(max_tokens, 1)
+        high = min(end, position + step)
+        while high < end and count_tokens(text[position:high], model) <= max_tokens:
+            low, step = high, step * 2
+            high = min(end, position + step)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if count_tokens(text[position:middle], model) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        spans.append((position, low))
+        position = low
+    return spans
+
+def sentence_spans(text: str, max_tokens: int, model: str = None) -> List[Span]:
+    """
+    切出句子的 (start, end) 字元位置
+
+    超過 max_tokens 的句子再依子句標點切分，仍超過時依 token 數硬切
+    """
+    spans = []
+    for start, end in _boundary_spans(text, 0, len(text), _SENTENCE_END):
+        if count_tokens(text[start:end], model) <= max_tokens:
+            spans.append((start, end))
+            continue
+        for clause_start, clause_end in _boundary_spans(text, start, end, _CLAUSE_END):
+            if count_tokens(text[clause_start:clause_end], model) <= max_tokens:
+                spans.append((clause_start, clause_end))
+            else:
+                spans.extend(_hard_split(text, clause_start, clause_end, max_tokens, model))
+    return spans
+
+def split_document(text: str, max_tokens: int, overlap_tokens: int = 0,
+                   model: str = None) -> List[Tuple[int, str]]:
+    """
+    將文件切成 token 數不超過 max_tokens 的段落，回傳 (起始字元位置, 段落文字)
+
+    token 數以 count_tokens 依 model 的編碼計算；段落只在句子邊界切開，
+    相鄰段落重疊最多 overlap_tokens 的完整句子，避免跨段的實體被切斷。
+    文件未超過預算時回傳單一段落
+    """
+    if count_tokens(text, model) <= max_tokens:
+        return [(0, text)]
+
+    spans = sentence_spans(text, max_tokens, model)
+    costs = [count_tokens(text[start:end], model) for start, end in spans]
+    chunks = []
+    first = 0
+    while first < len(spans):
+        last, total = first, costs[first]
+        while last + 1 < len(spans) and total + costs[last + 1] <= max_tokens:
+            last += 1
+            total += costs[last]
+        start, end = spans[first][0], spans[last][1]
+        chunks.append((start, text[start:end]))
+        if last + 1 >= len(spans):
+            break
+
+        # 下一段從結尾往回退，重疊不超過 overlap_tokens 的句子
+        next_first, overlap = last + 1, 0
+        while next_first - 1 > first and overlap + costs[next_first - 1] <= overlap_tokens:
+            next_first -= 1
+            overlap += costs[next_first]
+        first = next_first
+    return chunks
+
+def _confidence(entity: Dict[str, Any]) -> float:
+    try:
+        return float(entity.get('confidence', 0.0))
+    except (TypeError, ValueError):
+        return 0.0
+
+def merge_chunk_entities(chunks: Sequence[Tuple[int, str]],
+                         chunk_entities: Sequence[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    合併各段落的實體
+
+    在段落中找出實體文字的位置並換算成文件的字元位置，重疊區同一位置的實體
+    只保留可信度最高者，結果依位置排序；段落中找不到原文的實體依 (文字, 類型)
+    去重後附在最後。位置只用於合併，回傳的實體維持與未切段文本相同的欄位
+    """
+    located: Dict[Span, Dict[str, Any]] = {}
+    unlocated: Dict[Tuple[str, Any], Dict[str, Any]] = {}
+
+    for (offset, chunk), entities in zip(chunks, chunk_entities):
+        search_from: Dict[str, int] = {}
+        for entity in entities:
+            if not isinstance(entity, dict) or not entity.get('text'):
+                continue
+            surface = str(entity['text'])
+            position = chunk.find(surface, search_from.get(surface, 0))
+            if position < 0:
+                key = (surface, entity.get('label'))
+                if key not in unlocated or _confidence(entity) > _confidence(unlocated[key]):
+                    unlocated[key] = entity
+                continue
+
+            search_from[surface] = position + len(surface)
+            span = (offset + position, offset + position + len(surface))
+            existing = located.get(span)
+            if existing is None or _confidence(entity) > _confidence(existing):
+                located[span] = entity
+
+    merged = [located[span] for span in sorted(located)]
+    seen = {(entity['text'], entity.get('label')) for entity in merged}
+    merged.extend(entity for key, entity in unlocated.items() if key not in seen)
+    return merged
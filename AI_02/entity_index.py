@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+實體倒排索引
+將標註結果建成磁碟上的倒排索引：(實體文字, 類型) -> 依 text_id 排序的 postings（含可信度），
+可隨批次完成逐步附加，查詢時不需載入整份語料
+"""
+
+import sqlite3
+import threading
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from ner_io import explode_entities, iter_entity_chunks
+
+DEFAULT_INDEX_PATH = 'entity_index.sqlite3'
+
+class EntityIndex:
+    """以 SQLite 儲存的實體倒排索引（執行緒安全）"""
+
+    def __init__(self, path: str = DEFAULT_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS terms (
+                term_id INTEGER PRIMARY KEY,
+                text TEXT NOT NULL,
+                label TEXT NOT NULL,
+                doc_count INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (text, label)
+            );
+            -- 以 (term_id, text_id) 為叢集鍵，同一詞條的 postings 在磁碟上依 text_id 排序
+            CREATE TABLE IF NOT EXISTS postings (
+                term_id INTEGER NOT NULL,
+                text_id INTEGER NOT NULL,
+                confidence REAL NOT NULL,
+                PRIMARY KEY (term_id, text_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_by_text ON postings (text_id, term_id);
+            CREATE TABLE IF NOT EXISTS documents (
+                text_id INTEGER PRIMARY KEY
+            );
+        """)
+        self._conn.commit()
+
+    # ------------------------------------------------------------------
+    # 建立與附加
+    # ------------------------------------------------------------------
+
+    def add_entity_table(self, entities: pd.DataFrame, text_ids: Iterable[int] = None,
+                         replace_documents: bool = True) -> int:
+        """
+        附加一批實體表（欄位 text_id / text / label / confidence），回傳寫入的 postings 數
+
+        text_ids 為本批涵蓋的所有文件（含沒有實體者）；replace_documents=True 時
+        這些文件先前的 postings 會先移除，重跑或重試的文件不會留下舊結果。
+        同一文件多次提及同一實體時只保留最高可信度
+        """
+        if text_ids is None:
+            text_ids = entities['text_id'].unique().tolist()
+        text_ids = sorted({int(text_id) for text_id in text_ids})
+
+        postings = pd.DataFrame({'text_id': entities['text_id'].astype('int64'),
+                                 'text': entities['text'].astype(str),
+                                 'label': entities['label'].astype(str),
+                                 'confidence': entities['confidence'].astype('float64')})
+        postings = postings.groupby(['text', 'label', 'text_id'], sort=False, as_index=False)['confidence'].max()
+
+        with self._lock:
+            conn = self._conn
+            with conn:
+                affected = self._remove_documents(text_ids) if replace_documents else set()
+                conn.executemany('INSERT OR IGNORE INTO documents (text_id) VALUES (?)',
+                                 ((text_id,) for text_id in text_ids))
+
+                terms = postings[['text', 'label']].drop_duplicates()
+                conn.executemany('INSERT OR IGNORE INTO terms (text, label) VALUES (?, ?)',
+                                 terms.itertuples(index=False, name=None))
+                term_ids = self._term_ids(terms.itertuples(index=False, name=None))
+                postings['term_id'] = [term_ids[key] for key in
+                                       zip(postings['text'], postings['label'])]
+
+                conn.executemany(
+                    'INSERT INTO postings (term_id, text_id, confidence) VALUES (?, ?, ?) '
+                    'ON CONFLICT (term_id, text_id) DO UPDATE SET '
+                    'confidence = MAX(confidence, excluded.confidence)',
+                    postings[['term_id', 'text_id', 'confidence']].itertuples(index=False, name=None)
+                )
+                affected.update(term_ids.values())
+                self._refresh_doc_counts(affected)
+        return len(postings)
+
+    def add_results(self, df: pd.DataFrame) -> int:
+        """附加 batch_process_texts 的結果（只索引成功處理的文本）"""
+        processed = df[df['processed'].astype(bool)]
+        return self.add_entity_table(explode_entities(processed), processed['text_id'].tolist())
+
+    def _remove_documents(self, text_ids: Sequence[int]) -> set:
+        """移除文件的舊 postings，回傳受影響的 term_id"""
+        affected = set()
+        for start in range(0, len(text_ids), 500):
+            batch = text_ids[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = self._conn.execute(
+                f'SELECT DISTINCT term_id FROM postings WHERE text_id IN ({placeholders})', batch
+            )
+            affected.update(row[0] for row in rows)
+            self._conn.execute(f'DELETE FROM postings WHERE text_id IN ({placeholders})', batch)
+        return affected
+
+    def _term_ids(self, keys: Iterable[Tuple[str, str]]) -> dict:
+        term_ids = {}
+        for text, label in keys:
+            row = self._conn.execute('SELECT term_id FROM terms WHERE text = ? AND label = ?',
+                                     (text, label)).fetchone()
+            term_ids[(text, label)] = row[0]
+        return term_ids
+
+    def _refresh_doc_counts(self, term_ids: Iterable[int]):
+        self._conn.executemany(
+            'UPDATE terms SET doc_count = (SELECT COUNT(*) FROM postings WHERE postings.term_id = terms.term_id) '
+            'WHERE term_id = ?',
+            ((term_id,) for term_id in term_ids)
+        )
+
+    # ------------------------------------------------------------------
+    # 查詢
+    # ------------------------------------------------------------------
+
+    def lookup(self, text: str, label: str = None,
+               min_confidence: float = 0.0) -> List[Tuple[int, str, float]]:
+        """提及某實體的文件，回傳依 text_id 排序的 (text_id, label, confidence)"""
+        query = ('SELECT p.text_id, t.label, p.confidence FROM terms t '
+                 'JOIN postings p ON p.term_id = t.term_id '
+                 'WHERE t.text = ? AND p.confidence >= ?')
+        params = [text, min_confidence]
+        if label is not None:
+            query += ' AND t.label = ?'
+            params.append(label)
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY p.text_id', params).fetchall()
+        return rows
+
+    def documents_with(self, text: str, label: str = None, min_confidence: float = 0.0) -> List[int]:
+        """提及某實體的 text_id（已排序、不重複）"""
+        return sorted({text_id for text_id, _, _ in self.lookup(text, label, min_confidence)})
+
+    def documents_with_all(self, terms: Sequence[Tuple[str, Optional[str]]]) -> List[int]:
+        """同時提及所有 (實體文字, 類型) 的 text_id；類型為 None 表示不限類型"""
+        if not terms:
+            return []
+        parts, params = [], []
+        for text, label in terms:
+            part = ('SELECT p.text_id FROM terms t JOIN postings p ON p.term_id = t.term_id '
+                    'WHERE t.text = ?')
+            params.append(text)
+            if label is not None:
+                part += ' AND t.label = ?'
+                params.append(label)
+            parts.append(part)
+        with self._lock:
+            rows = self._conn.execute(' INTERSECT '.join(parts) + ' ORDER BY 1', params).fetchall()
+        return [row[0] for row in rows]
+
+    def entities_for(self, text_id: int) -> List[Tuple[str, str, float]]:
+        """某文件的所有 (實體文字, 類型, 可信度)"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT t.text, t.label, p.confidence FROM postings p '
+                'JOIN terms t ON t.term_id = p.term_id WHERE p.text_id = ? ORDER BY t.text',
+                (int(text_id),)
+            ).fetchall()
+
+    def terms(self, prefix: str = None, label: str = None, limit: int = 20) -> List[Tuple[str, str, int]]:
+        """依文件數由多到少列出詞條 (實體文字, 類型, 文件數)，可依前綴與類型過濾"""
+        query = 'SELECT text, label, doc_count FROM terms WHERE doc_count > 0'
+        params: list = []
+        if prefix:
+            query += " AND text >= ? AND text < ?"
+            params.extend([prefix, prefix + '\U0010ffff'])
+        if label is not None:
+            query += ' AND label = ?'
+            params.append(label)
+        query += ' ORDER BY doc_count DESC, text LIMIT ?'
+        params.append(limit)
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    def stats(self):
+        """索引的文件數、詞條數與 postings 數"""
+        with self._lock:
+            documents = self._conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+            terms = self._conn.execute('SELECT COUNT(*) FROM terms WHERE doc_count > 0').fetchone()[0]
+            postings = self._conn.execute('SELECT COUNT(*) FROM postings').fetchone()[0]
+        return {'documents': documents, 'terms': terms, 'postings': postings}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def build_entity_index(results_path: str, index_path: str = DEFAULT_INDEX_PATH,
+                       chunksize: int = 100_000) -> EntityIndex:
+    """
+    由結果 CSV 或欄式結果目錄分段建立（或附加）倒排索引
+
+    同一文件的實體可能跨段，因此分段時不移除舊 postings；
+    需要以重跑結果取代舊結果時請改用 EntityIndex.add_results
+    """
+    index = EntityIndex(index_path)
+    for entities in iter_entity_chunks(results_path, chunksize):
+        if not entities.empty:
+            index.add_entity_table(entities, replace_documents=False)
+    return index
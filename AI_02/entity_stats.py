@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+實體統計彙總
+對實體表做一次分組，算出各類型的數量、可信度平均/最小/最大/分位數
+與最常見實體，供所有圖表與文字報告共用
+"""
+
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_QUANTILES = (0.25, 0.5, 0.75)
+
+class TextLabelIndex:
+    """
+    實體文字 -> 各類型出現次數 的索引
+
+    在計數時一併建立，可查詢某個文字被標成哪些類型及其多數類型
+    """
+
+    def __init__(self, label_counts: pd.DataFrame):
+        # 列為實體文字、欄為類型的次數表
+        self.label_counts = label_counts
+        self.totals = label_counts.sum(axis=1)
+        self.majority = label_counts.idxmax(axis=1) if len(label_counts) else pd.Series(dtype=object)
+
+    @classmethod
+    def from_pair_counts(cls, pair_counts: pd.Series) -> 'TextLabelIndex':
+        """由以 (text, label) 為索引的次數 Series 建立索引"""
+        label_counts = pair_counts.unstack('label', fill_value=0)
+        label_counts.columns = [str(label) for label in label_counts.columns]
+        return cls(label_counts)
+
+    @classmethod
+    def from_entities(cls, entities: pd.DataFrame) -> 'TextLabelIndex':
+        """對 (text, label) 做一次分組計數建立索引"""
+        return cls.from_pair_counts(entities.groupby(['text', 'label'], observed=True, sort=False).size())
+
+    def __contains__(self, text: str) -> bool:
+        return text in self.totals.index
+
+    def labels_for(self, text: str) -> Dict[str, int]:
+        """某個實體文字在各類型的出現次數（次數多者在前）"""
+        if text not in self:
+            return {}
+        row = self.label_counts.loc[text]
+        row = row[row > 0].sort_values(ascending=False, kind='stable')
+        return {label: int(count) for label, count in row.items()}
+
+    def majority_label(self, text: str) -> Optional[str]:
+        """某個實體文字最常被標成的類型"""
+        if text not in self:
+            return None
+        return self.majority.loc[text]
+
+    def most_common(self, n: int) -> pd.Series:
+        """出現次數最多的前 n 個實體文字"""
+        return self.totals.nlargest(n, keep='first')
+
+class EntityStats:
+    """實體表的彙總結果"""
+
+    def __init__(self, total: int, confidences: np.ndarray, by_label: pd.DataFrame,
+                 confidences_by_label: Dict[str, np.ndarray], text_index: TextLabelIndex,
+                 quantiles: Sequence[float]):
+        self.total = total
+        self.confidences = confidences
+        self.by_label = by_label
+        self.confidences_by_label = confidences_by_label
+        self.text_index = text_index
+        self.quantiles = tuple(quantiles)
+
+    @property
+    def labels(self):
+        """依數量由多到少排列的實體類型"""
+        return list(self.by_label.index)
+
+    @property
+    def label_counts(self) -> pd.Series:
+        return self.by_label['count']
+
+    @property
+    def overall(self) -> Dict[str, float]:
+        """全部實體的可信度統計"""
+        if self.total == 0:
+            return {'mean': 0.0, 'min': 0.0, 'max': 0.0}
+        return {
+            'mean': float(self.confidences.mean()),
+            'min': float(self.confidences.min()),
+            'max': float(self.confidences.max())
+        }
+
+    def top(self, n: int) -> pd.Series:
+        """最常見的前 n 個實體文字"""
+        return self.text_index.most_common(n)
+
+    def histogram(self, bins: int = 20) -> Tuple[np.ndarray, np.ndarray]:
+        """全部可信度的直方圖 (counts, edges)"""
+        return np.histogram(self.confidences, bins=bins)
+
+    def box_stats(self, label: str = None) -> Dict:
+        """Axes.bxp 所需的箱線圖數值；label 為 None 時為全部實體"""
+        values = self.confidences if label is None else self.confidences_by_label[label]
+        q1, med, q3 = np.quantile(values, [0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+        box = {
+            'med': med,
+            'q1': q1,
+            'q3': q3,
+            'whislo': inside.min() if len(inside) else q1,
+            'whishi': inside.max() if len(inside) else q3,
+            'fliers': values[(values < q1 - 1.5 * iqr) | (values > q3 + 1.5 * iqr)]
+        }
+        if label is not None:
+            box['label'] = label
+        return box
+
+def quantile_column(q: float) -> str:
+    return f"q{int(round(q * 100))}"
+
+def compute_entity_stats(entities: pd.DataFrame,
+                         quantiles: Sequence[float] = DEFAULT_QUANTILES) -> EntityStats:
+    """
+    計算實體表的彙總統計（全表在記憶體中；超大結果檔見 streaming_stats）
+
+    以 groupby 的索引一次分組（雜湊分組，O(N)），
+    每個類型只切出自己的可信度陣列計算所有指標；
+    實體文字的計數與類型索引由一次 (text, label) 分組取得
+    """
+    confidences = entities['confidence'].to_numpy(dtype=np.float64)
+    rows = {}
+    confidences_by_label = {}
+
+    if len(entities):
+        group_indices = entities.groupby('label', observed=True, sort=False).indices
+        for label, indices in group_indices.items():
+            values = confidences[indices]
+            row = {
+                'count': len(values),
+                'mean': values.mean(),
+                'min': values.min(),
+                'max': values.max()
+            }
+            for q, value in zip(quantiles, np.quantile(values, quantiles)):
+                row[quantile_column(q)] = value
+            rows[str(label)] = row
+            confidences_by_label[str(label)] = values
+
+    columns = ['count', 'mean', 'min', 'max'] + [quantile_column(q) for q in quantiles]
+    by_label = pd.DataFrame.from_dict(rows, orient='index', columns=columns)
+    by_label = by_label.sort_values('count', ascending=False, kind='stable')
+    by_label['count'] = by_label['count'].astype('int64')
+
+    return EntityStats(len(entities), confidences, by_label, confidences_by_label,
+                       TextLabelIndex.from_entities(entities), quantiles)
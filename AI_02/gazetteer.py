@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地實體詞典（gazetteer）預先比對
+以 Aho-Corasick 自動機在線性時間內標出已知實體，完全涵蓋的文本不需呼叫 API，
+其餘只送出剩餘片段；詞典可由過去的高可信度結果自動擴充
+"""
+
+import os
+import unicodedata
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from entity_stats import TextLabelIndex
+
+DEFAULT_GAZETTEER_PATH = 'gazetteer.tsv'
+# 剩餘片段之間的分隔，避免相鄰片段被誤認為同一個實體
+RESIDUAL_SEPARATOR = ' … '
+
+# 只轉換 ASCII 大小寫，確保比對時字串長度不變
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+def _is_ascii_word_char(ch: str) -> bool:
+    return ch.isascii() and ch.isalnum()
+
+def _is_filler(text: str) -> bool:
+    """只含空白、標點或符號"""
+    return all(ch.isspace() or unicodedata.category(ch)[0] in 'PZS' for ch in text)
+
+class AhoCorasick:
+    """多模式字串比對自動機"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # 每個節點結尾的模式長度（含 fail 鏈上的輸出）
+        self._out: List[List[int]] = [[]]
+
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str):
+        node = 0
+        for ch in pattern:
+            next_node = self._goto[node].get(ch)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][ch] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = next_node
+        if len(pattern) not in self._out[node]:
+            self._out[node].append(len(pattern))
+
+    def _build(self):
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int]]:
+        """產生所有 (start, end) 比對位置（可重疊）"""
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for length in self._out[node]:
+                yield i - length + 1, i + 1
+
+class Gazetteer:
+    """
+    已知實體詞典：實體文字 -> 類型 / 可信度 / 觀察次數
+
+    比對採「最左、最長、不重疊」；英數字實體需位於字詞邊界，
+    長度小於 min_length 的詞條不參與比對
+    """
+
+    def __init__(self, entries: Dict[str, Dict[str, Any]] = None, min_length: int = 2):
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.min_length = min_length
+        self._automaton: Optional[AhoCorasick] = None
+        self._keys: Dict[str, str] = {}
+        for text, entry in (entries or {}).items():
+            self.add(text, entry['label'], entry.get('confidence', 1.0), entry.get('count', 1))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, text: str) -> bool:
+        return text in self.entries
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_GAZETTEER_PATH, min_length: int = 2) -> 'Gazetteer':
+        """
+        讀取詞典檔；檔案不存在時回傳空詞典
+
+        格式為 TSV：實體文字<TAB>類型[<TAB>可信度[<TAB>次數]]，# 開頭為註解
+        """
+        gazetteer = cls(min_length=min_length)
+        if not os.path.exists(path):
+            return gazetteer
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                fields = line.split('\t')
+                if len(fields) < 2:
+                    continue
+                confidence = float(fields[2]) if len(fields) > 2 and fields[2] else 1.0
+                count = int(fields[3]) if len(fields) > 3 and fields[3] else 1
+                gazetteer.add(fields[0], fields[1], confidence, count)
+        return gazetteer
+
+    def save(self, path: str = DEFAULT_GAZETTEER_PATH):
+        """寫入詞典檔（依觀察次數由多到少）"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("# text\tlabel\tconfidence\tcount\n")
+            for text, entry in sorted(self.entries.items(), key=lambda item: -item[1]['count']):
+                f.write(f"{text}\t{entry['label']}\t{entry['confidence']:.3f}\t{entry['count']}\n")
+        os.replace(tmp_path, path)
+
+    def add(self, text: str, label: str, confidence: float = 1.0, count: int = 1):
+        """新增或取代詞條"""
+        text = text.strip()
+        if not text or '\t' in text or '\n' in text:
+            return
+        self.entries[text] = {'label': label, 'confidence': float(confidence), 'count': int(count)}
+        self._automaton = None
+
+    def learn_from_table(self, entities: pd.DataFrame, min_confidence: float = 0.9,
+                         min_count: int = 2, min_label_share: float = 0.8) -> int:
+        """
+        由實體表中的高可信度結果擴充詞典，回傳新增或更新的詞條數
+
+        只收錄可信度 >= min_confidence、出現至少 min_count 次，
+        且多數類型佔比 >= min_label_share 的實體文字
+        """
+        confident = entities[entities['confidence'] >= min_confidence]
+        if confident.empty:
+            return 0
+
+        index = TextLabelIndex.from_entities(confident)
+        mean_confidence = confident.groupby(['text', 'label'], observed=True)['confidence'].mean()
+        learned = 0
+        for text, total in index.totals.items():
+            label = index.majority_label(text)
+            share = index.label_counts.at[text, label] / total
+            if total < min_count or share < min_label_share or len(str(text)) < self.min_length:
+                continue
+            existing = self.entries.get(text)
+            count = int(total) + (existing['count'] if existing and existing['label'] == label else 0)
+            self.add(str(text), label, mean_confidence.loc[(text, label)], count)
+            learned += 1
+        return learned
+
+    def without_known(self, entities: pd.DataFrame) -> pd.DataFrame:
+        """
+        剔除詞典已收錄的實體文字
+
+        詞典比對的命中都是已收錄的詞條，從結果學習前先剔除，
+        避免詞典自己的命中被再計數一次
+        """
+        return entities[~entities['text'].isin(list(self.entries))]
+
+    def learn(self, entities: List[Dict[str, Any]], **kwargs) -> int:
+        """由實體字典列表擴充詞典（參數同 learn_from_table）"""
+        table = pd.DataFrame([entity for entity in entities if isinstance(entity, dict)],
+                             columns=['text', 'label', 'confidence'])
+        table['confidence'] = pd.to_numeric(table['confidence'], errors='coerce').fillna(0.0)
+        return self.learn_from_table(table.dropna(subset=['text', 'label']), **kwargs)
+
+    def _ensure_automaton(self):
+        if self._automaton is None:
+            self._keys = {text.translate(_ASCII_LOWER): text
+                          for text in self.entries if len(text) >= self.min_length}
+            self._automaton = AhoCorasick(self._keys)
+
+    def _at_boundary(self, text: str, start: int, end: int) -> bool:
+        """英數字開頭/結尾的詞條不可與相鄰英數字相連"""
+        if _is_ascii_word_char(text[start]) and start > 0 and _is_ascii_word_char(text[start - 1]):
+            return False
+        if _is_ascii_word_char(text[end - 1]) and end < len(text) and _is_ascii_word_char(text[end]):
+            return False
+        return True
+
+    def find_spans(self, text: str) -> List[Tuple[int, int, str]]:
+        """回傳不重疊的 (start, end, 詞條) 比對結果，依位置排序"""
+        if not self.entries:
+            return []
+        self._ensure_automaton()
+        folded = text.translate(_ASCII_LOWER)
+        candidates = sorted(self._automaton.iter_matches(folded), key=lambda span: (span[0], -span[1]))
+
+        spans, position = [], 0
+        for start, end in candidates:
+            if start < position or not self._at_boundary(text, start, end):
+                continue
+            spans.append((start, end, self._keys[folded[start:end]]))
+            position = end
+        return spans
+
+    def match(self, text: str) -> List[Dict[str, Any]]:
+        """以詞典標出文本中的已知實體（格式同 API 回傳的實體）"""
+        return [self._entity(text[start:end], key) for start, end, key in self.find_spans(text)]
+
+    def _entity(self, surface: str, key: str) -> Dict[str, Any]:
+        entry = self.entries[key]
+        return {'text': surface, 'label': entry['label'], 'confidence': entry['confidence']}
+
+    def split(self, text: str) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        將文本拆成 (已知實體, 剩餘片段)
+
+        沒有比對到任何詞條時剩餘片段即原文；剩餘部分只有空白與標點時
+        視為完全涵蓋，剩餘片段為 None
+        """
+        spans = self.find_spans(text)
+        if not spans:
+            return [], text
+
+        segments, position = [], 0
+        for start, end, _ in spans:
+            segments.append(text[position:start])
+            position = end
+        segments.append(text[position:])
+
+        residual = [segment.strip() for segment in segments if not _is_filler(segment)]
+        known = [self._entity(text[start:end], key) for start, end, key in spans]
+        return known, (RESIDUAL_SEPARATOR.join(residual) if residual else None)
+
+def merge_entities(known: List[Dict[str, Any]], extracted: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """合併詞典與 API 的實體，略過 API 回傳中與詞典結果相同的 (文字, 類型)"""
+    if not known:
+        return extracted
+    seen = {(entity['text'], entity['label']) for entity in known}
+    return list(known) + [
+        entity for entity in extracted
+        if not (isinstance(entity, dict) and (entity.get('text'), entity.get('label')) in seen)
+    ]
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+對沖請求
+請求超過 p95 延遲仍未回應時再送出一個相同的請求，取先成功回應的結果，
+以少量額外花費截斷延遲長尾；額外送出的 token 數以預算上限控制
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+class HedgeBudget:
+    """
+    對沖請求的花費上限（執行緒安全）
+
+    對沖請求預估的 token 數累計不超過主要請求 token 數的 max_ratio 倍
+    """
+
+    def __init__(self, max_ratio: float = 0.05):
+        self.max_ratio = max_ratio
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.request_tokens = 0
+        self.hedges = 0
+        self.hedge_tokens = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_env(cls) -> 'HedgeBudget':
+        """從 OPENAI_HEDGE_BUDGET 環境變數（額外花費比例，0 為停用）建立"""
+        return cls(float(os.getenv('OPENAI_HEDGE_BUDGET', '0.05')))
+
+    def record_request(self, tokens: int):
+        """記錄一個主要請求"""
+        with self._lock:
+            self.requests += 1
+            self.request_tokens += tokens
+
+    def try_hedge(self, tokens: int) -> bool:
+        """預算足夠時扣除並回傳 True"""
+        with self._lock:
+            if self.hedge_tokens + tokens > self.max_ratio * self.request_tokens:
+                return False
+            self.hedges += 1
+            self.hedge_tokens += tokens
+            return True
+
+    def record_win(self):
+        """對沖請求比主要請求先成功回應"""
+        with self._lock:
+            self.hedge_wins += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'extra_spend': self.hedge_tokens / self.request_tokens if self.request_tokens else 0.0
+            }
+
+    def summary(self) -> str:
+        stats = self.stats()
+        return (f"🪁 對沖請求: {stats['hedges']} 次（{stats['hedge_wins']} 次較快），"
+                f"額外花費 {stats['extra_spend']:.1%} / 上限 {self.max_ratio:.0%}")
+
+# 同步對沖請求共用的執行緒池，第一次使用時才建立
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=int(os.getenv('OPENAI_HEDGE_THREADS', '32')),
+                                           thread_name_prefix='hedge')
+        return _executor
+
+def hedged_call(call: Callable[[], Any], delay: Optional[float], budget: HedgeBudget,
+                tokens: int, hedge: Callable[[], Any] = None) -> Any:
+    """
+    送出請求，超過 delay 秒仍未回應且預算足夠時以 hedge（預設同 call）再送一次
+
+    回傳先成功的結果；兩者都失敗時拋出先發生的錯誤。
+    同步請求無法中途取消，較慢的一方完成後結果直接捨棄
+    """
+    budget.record_request(tokens)
+    if delay is None:
+        return call()
+
+    executor = _get_executor()
+    primary = executor.submit(call)
+    done, _ = wait([primary], timeout=delay)
+    if done or not budget.try_hedge(tokens):
+        return primary.result()
+
+    futures = [primary, executor.submit(hedge or call)]
+    pending, error = set(futures), None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is futures[1]:
+                    budget.record_win()
+                for other in pending:
+                    other.cancel()
+                return future.result()
+            error = error or future.exception()
+    raise error
+
+async def hedged_call_async(call: Callable[[], Awaitable[Any]], delay: Optional[float],
+                            budget: HedgeBudget, tokens: int,
+                            hedge: Callable[[], Awaitable[Any]] = None) -> Any:
+    """非同步版本的 hedged_call；較慢的一方會被取消"""
+    budget.record_request(tokens)
+    if delay is None:
+        return await call()
+
+    tasks = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or not budget.try_hedge(tokens):
+            return await tasks[0]
+
+        tasks.append(asyncio.ensure_future((hedge or call)()))
+        pending, error = set(tasks), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is tasks[1]:
+                        budget.record_win()
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+_default_budget: Optional[HedgeBudget] = None
+_default_lock = threading.Lock()
+
+def get_default_hedge_budget() -> HedgeBudget:
+    """取得程序內共用的對沖預算"""
+    global _default_budget
+    with _default_lock:
+        if _default_budget is None:
+            _default_budget = HedgeBudget.from_env()
+        return _default_budget
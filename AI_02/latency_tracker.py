@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+請求延遲統計
+依模型、提示詞模板與提示詞大小分級保留最近的請求延遲，計算滾動的 p50 / p95，
+作為對沖請求的觸發時間與每次請求的自適應逾時
+"""
+
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+import numpy as np
+
+# 提示詞大小分級的下限（token）
+MIN_SIZE_BUCKET = 256
+
+def latency_key(model: str, prompt_name: str, prompt_tokens: int) -> str:
+    """
+    延遲統計的鍵
+
+    提示詞 token 數以 2 的次方向上分級（最小 MIN_SIZE_BUCKET），
+    長段落與短文本的延遲分開統計，各自得到相稱的逾時與對沖時間
+    """
+    bucket = MIN_SIZE_BUCKET
+    while bucket < prompt_tokens:
+        bucket *= 2
+    return f"{model}/{prompt_name}/<={bucket}"
+
+class LatencyTracker:
+    """
+    滾動延遲統計（執行緒安全）
+
+    每個鍵只保留最近 window 筆成功請求的延遲；樣本數未達 min_samples 前
+    不提供對沖時間與逾時，沿用客戶端的預設逾時
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20,
+                 timeout_multiplier: float = 4.0, min_timeout: float = 5.0,
+                 max_timeout: float = 60.0):
+        self.window = window
+        self.min_samples = min_samples
+        self.timeout_multiplier = timeout_multiplier
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, key: str, seconds: float):
+        """記錄一次成功請求的延遲（秒）"""
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, key: str, q: float) -> Optional[float]:
+        """第 q 百分位延遲；樣本數不足時回傳 None"""
+        with self._lock:
+            samples = list(self._samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return float(np.percentile(samples, q))
+
+    def p50(self, key: str) -> Optional[float]:
+        return self.percentile(key, 50)
+
+    def p95(self, key: str) -> Optional[float]:
+        return self.percentile(key, 95)
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        """超過此秒數仍未回應時送出對沖請求（即 p95）"""
+        return self.p95(key)
+
+    def timeout(self, key: str) -> Optional[float]:
+        """自適應逾時：p95 的 timeout_multiplier 倍，限制在 [min_timeout, max_timeout]"""
+        p95 = self.p95(key)
+        if p95 is None:
+            return None
+        return min(self.max_timeout, max(self.min_timeout, p95 * self.timeout_multiplier))
+
+    def stats(self, key: str) -> Dict[str, Any]:
+        with self._lock:
+            samples = list(self._samples.get(key, ()))
+        if not samples:
+            return {'samples': 0, 'p50': None, 'p95': None}
+        p50, p95 = np.percentile(samples, [50, 95])
+        return {'samples': len(samples), 'p50': float(p50), 'p95': float(p95)}
+
+    def keys(self):
+        with self._lock:
+            return sorted(self._samples)
+
+    def summary(self) -> str:
+        lines = ["⏱️ 請求延遲:"]
+        for key in self.keys():
+            stats = self.stats(key)
+            lines.append(f"  {key}: {stats['samples']} 筆，p50 {stats['p50']:.2f} 秒，"
+                         f"p95 {stats['p95']:.2f} 秒")
+        return "\n".join(lines)
+
+_default_tracker: Optional[LatencyTracker] = None
+_default_lock = threading.Lock()
+
+def get_default_latency_tracker() -> LatencyTracker:
+    """取得程序內共用的延遲統計"""
+    global _default_tracker
+    with _default_lock:
+        if _default_tracker is None:
+            _default_tracker = LatencyTracker()
+        return _default_tracker
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NER 資料輸入輸出工具
+以生成器逐筆讀取 JSONL / CSV / TXT（可 gzip 壓縮）文本，
+並將結果分段附加寫入輸出檔，記憶體用量不隨語料大小成長
+"""
+
+import csv
+import gzip
+import json
+import os
+import zlib
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# batch_process_texts 輸出的欄位順序
+RESULT_COLUMNS = ['text_id', 'text', 'entities', 'entity_count', 'processed', 'error']
+
+def _open_text(path: str, mode: str = 'rt'):
+    """依副檔名開啟一般或 gzip 文字檔"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8', newline='')
+    return open(path, mode.replace('t', ''), encoding='utf-8', newline='')
+
+def _base_extension(path: str) -> str:
+    base = path[:-3] if path.endswith('.gz') else path
+    return os.path.splitext(base)[1].lower()
+
+def iter_texts(path: str, text_field: str = 'text', id_field: str = 'text_id') -> Iterator[Tuple[int, str]]:
+    """
+    逐筆讀取文本，產生 (text_id, text)
+
+    支援 .jsonl / .csv / .txt 及其 .gz 壓縮版本；
+    來源沒有 id 欄位時以資料順序作為 text_id
+    """
+    extension = _base_extension(path)
+    with _open_text(path) as f:
+        if extension in ('.jsonl', '.ndjson'):
+            records = (json.loads(line) for line in f if line.strip())
+        elif extension == '.csv':
+            records = csv.DictReader(f)
+        else:
+            records = ({text_field: line.strip()} for line in f if line.strip())
+
+        for i, record in enumerate(records):
+            text = record.get(text_field)
+            if not text:
+                continue
+            text_id = record.get(id_field)
+            yield (int(text_id) if text_id not in (None, '') else i), text
+
+def shard_of(text_id: int, num_shards: int) -> int:
+    """text_id 所屬的分片（以 crc32 雜湊，跨行程與重跑皆穩定）"""
+    return zlib.crc32(str(int(text_id)).encode('ascii')) % num_shards
+
+def iter_shard(items: Iterable[Tuple[int, str]], shard_index: int,
+               num_shards: int) -> Iterator[Tuple[int, str]]:
+    """只保留屬於指定分片的 (text_id, text)"""
+    for text_id, text in items:
+        if shard_of(text_id, num_shards) == shard_index:
+            yield text_id, text
+
+def partition_texts(path: str, output_paths: List[str]) -> List[int]:
+    """
+    讀取一次輸入檔，依 text_id 的分片將文本寫成各分片的 JSONL 檔，回傳各分片筆數
+
+    output_paths[i] 為第 i 個分片的輸出檔；先寫暫存檔再改名，中斷時不會留下不完整的分片
+    """
+    num_shards = len(output_paths)
+    counts = [0] * num_shards
+    files = [_open_text(out + '.tmp', 'wt') for out in output_paths]
+    try:
+        for text_id, text in iter_texts(path):
+            shard = shard_of(text_id, num_shards)
+            files[shard].write(json.dumps({'text_id': text_id, 'text': text}, ensure_ascii=False) + '\n')
+            counts[shard] += 1
+    finally:
+        for f in files:
+            f.close()
+    for out in output_paths:
+        os.replace(out + '.tmp', out)
+    return counts
+
+def iter_chunks(items: Iterable, size: int) -> Iterator[List]:
+    """將可迭代物件切成固定大小的列表"""
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+class ChunkedCsvWriter:
+    """分段附加寫入 CSV，每段寫完即 flush 到磁碟"""
+
+    def __init__(self, path: str, columns: List[str] = None, append: bool = False):
+        self.path = path
+        self.columns = columns or RESULT_COLUMNS
+        self.rows_written = 0
+        if not append and os.path.exists(path):
+            os.remove(path)
+
+    def write(self, df: pd.DataFrame):
+        """附加一段結果；欄位依 columns 對齊，缺少的欄位補空值"""
+        if df.empty:
+            return
+        write_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with _open_text(self.path, 'at') as f:
+            df.reindex(columns=self.columns).to_csv(f, header=write_header, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+        self.rows_written += len(df)
+
+# ---------------------------------------------------------------------------
+# 欄式輸出：文件表 + 展開的實體表（Parquet / Arrow IPC）
+# ---------------------------------------------------------------------------
+
+DOCUMENT_COLUMNS = ['text_id', 'text', 'entity_count', 'processed', 'error']
+ENTITY_COLUMNS = ['text_id', 'text', 'label', 'confidence']
+
+DOCUMENTS_FILE = 'documents'
+ENTITIES_FILE = 'entities'
+_EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+def _require_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError as e:
+        raise ImportError("欄式輸出需要 pyarrow，請執行 pip install pyarrow") from e
+
+def _entity_columns_frame(text_ids, entities: List[dict]) -> pd.DataFrame:
+    """由平坦的實體列表與對應 text_id 建立型別固定的實體表"""
+    table = pd.DataFrame.from_records(entities, columns=['text', 'label', 'confidence'])
+    table.insert(0, 'text_id', text_ids)
+    table['text'] = table['text'].fillna('')
+    table['label'] = table['label'].fillna('UNKNOWN')
+    table['confidence'] = pd.to_numeric(table['confidence'], errors='coerce').fillna(0.0)
+    return table.astype({'text_id': 'int64', 'text': 'string', 'label': 'category',
+                         'confidence': 'float64'})
+
+def build_entity_table(text_ids: Iterable[int], entity_lists: Iterable[List[dict]]) -> pd.DataFrame:
+    """由每個文本的實體列表建立展開的實體表（label 以 category 儲存）"""
+    ids, flat = [], []
+    for text_id, entities in zip(text_ids, entity_lists):
+        ids.extend([text_id] * len(entities))
+        flat.extend(entities)
+    return _entity_columns_frame(ids, flat)
+
+def _decode_entity_value(value: str) -> list:
+    """解碼單列 JSON 字串，格式錯誤或不是陣列時回傳空列表"""
+    try:
+        entities = _json_loads(value)
+    except ValueError:
+        return []
+    return entities if isinstance(entities, list) else []
+
+def _decode_entity_column(values: pd.Series) -> List[list]:
+    """
+    一次解碼整欄 JSON 字串
+
+    將各列串成單一 JSON 陣列交給解碼器一次處理；
+    若有格式錯誤的列，或某列含逗號分隔的多個值（如 '1,2'）使解碼數量
+    與列數不符，改為逐列解碼並略過錯誤列
+    """
+    if values.empty:
+        return []
+    try:
+        decoded = _json_loads('[' + ','.join(values) + ']')
+    except ValueError:
+        decoded = None
+    if decoded is None or len(decoded) != len(values):
+        return [_decode_entity_value(value) for value in values]
+    return [entities if isinstance(entities, list) else [] for entities in decoded]
+
+def explode_entities(df: pd.DataFrame) -> pd.DataFrame:
+    """將結果表（entities 欄為 JSON 字串）批次展開為實體表"""
+    column = df['entities']
+    is_text = column.map(lambda value: isinstance(value, str))
+    rows = df.loc[is_text & ~column.isin(['', '[]'])]
+    entity_lists = [[entity for entity in entities if isinstance(entity, dict)]
+                    for entities in _decode_entity_column(rows['entities'])]
+
+    lengths = np.fromiter((len(entities) for entities in entity_lists), dtype=np.int64,
+                          count=len(entity_lists))
+    text_ids = np.repeat(rows['text_id'].to_numpy(dtype=np.int64), lengths)
+    flat = [entity for entities in entity_lists for entity in entities]
+    return _entity_columns_frame(text_ids, flat)
+
+def write_columnar_results(df: pd.DataFrame, output_dir: str, fmt: str = 'parquet',
+                           entities: pd.DataFrame = None):
+    """
+    將結果寫成文件表與實體表
+
+    fmt 為 'parquet' 或 'arrow'（Arrow IPC / Feather v2）；
+    未提供 entities 時由 df 的 entities 欄展開
+    """
+    _require_pyarrow()
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    os.makedirs(output_dir, exist_ok=True)
+    documents = df.reindex(columns=DOCUMENT_COLUMNS)
+    documents = documents.astype({'text_id': 'int64', 'text': 'string', 'entity_count': 'int64',
+                                  'processed': 'bool', 'error': 'string'})
+    if entities is None:
+        entities = explode_entities(df)
+
+    for name, table in ((DOCUMENTS_FILE, documents), (ENTITIES_FILE, entities)):
+        arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+        path = os.path.join(output_dir, name + _EXTENSIONS[fmt])
+        if fmt == 'parquet':
+            pq.write_table(arrow_table, path, compression='zstd')
+        else:
+            feather.write_feather(arrow_table, path, compression='zstd')
+
+def _columnar_path(output_dir: str, name: str) -> str:
+    for extension in _EXTENSIONS.values():
+        path = os.path.join(output_dir, name + extension)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"找不到 {os.path.join(output_dir, name)}.parquet 或 .arrow")
+
+def read_columnar_table(output_dir: str, name: str, columns: List[str] = None) -> pd.DataFrame:
+    """讀取 write_columnar_results 寫出的文件表或實體表"""
+    _require_pyarrow()
+    path = _columnar_path(output_dir, name)
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_feather(path, columns=columns)
+
+def read_entity_table(output_dir: str, columns: List[str] = None) -> pd.DataFrame:
+    """讀取實體表"""
+    return read_columnar_table(output_dir, ENTITIES_FILE, columns)
+
+def read_document_table(output_dir: str, columns: List[str] = None) -> pd.DataFrame:
+    """讀取文件表"""
+    return read_columnar_table(output_dir, DOCUMENTS_FILE, columns)
+
+def latest_row_mask(path: str, chunksize: int = 100_000) -> Optional[np.ndarray]:
+    """
+    結果 CSV 中每個 text_id 最後一列的布林遮罩；沒有重複的 text_id 時回傳 None
+
+    只讀取 text_id 欄，記憶體為每列一個整數
+    """
+    ids = [chunk['text_id'].to_numpy(dtype=np.int64)
+           for chunk in pd.read_csv(path, chunksize=chunksize, usecols=['text_id'], encoding='utf-8')]
+    if not ids:
+        return None
+    ids = np.concatenate(ids)
+    # 反轉後的第一次出現即為原順序的最後一列
+    _, first_in_reversed = np.unique(ids[::-1], return_index=True)
+    if len(first_in_reversed) == len(ids):
+        return None
+    mask = np.zeros(len(ids), dtype=bool)
+    mask[len(ids) - 1 - first_in_reversed] = True
+    return mask
+
+def iter_result_chunks(path: str, chunksize: int = 100_000,
+                       usecols: List[str] = None) -> Iterator[pd.DataFrame]:
+    """
+    分段讀取結果 CSV，同一 text_id 只保留最後一列
+
+    續跑與重跑失敗文本時，新結果附加在舊的失敗列之後，舊列不會改寫；
+    彙總時一律以每個 text_id 的最後一列為準，避免同一文本重複計算
+    """
+    mask = latest_row_mask(path, chunksize)
+    offset = 0
+    for chunk in pd.read_csv(path, chunksize=chunksize, usecols=usecols, encoding='utf-8'):
+        rows = len(chunk)
+        if mask is not None:
+            chunk = chunk[mask[offset:offset + rows]]
+        offset += rows
+        yield chunk
+
+def iter_entity_chunks(path: str, chunksize: int = 100_000) -> Iterator[pd.DataFrame]:
+    """
+    分段產生實體表
+
+    path 為結果 CSV 時每次讀取 chunksize 列並展開（同一 text_id 只取最後一列）；
+    為欄式結果目錄時逐批讀取實體表
+    """
+    if not os.path.isdir(path):
+        for chunk in iter_result_chunks(path, chunksize, usecols=['text_id', 'entities']):
+            yield explode_entities(chunk)
+        return
+
+    _require_pyarrow()
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    entity_path = _columnar_path(path, ENTITIES_FILE)
+    if entity_path.endswith('.parquet'):
+        for batch in pq.ParquetFile(entity_path).iter_batches(batch_size=chunksize,
+                                                              columns=ENTITY_COLUMNS):
+            yield batch.to_pandas()
+    else:
+        with pa.memory_map(entity_path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).to_pandas()
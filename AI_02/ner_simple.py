@@ -6,11 +6,39 @@
 """
 
 import pandas as pd
-from openai import OpenAI
+import asyncio
 import json
-import time
 import os
-from typing import List, Dict, Any
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import AsyncIterator, Iterable, List, Dict, Any, Tuple
+
+from checkpoint import ProgressJournal, input_fingerprint
+from client_pool import ClientProvider, get_client_provider
+from dedup import entities_for_duplicate, plan_dedup
+from document_chunker import merge_chunk_entities, split_document
+from entity_index import EntityIndex
+from entity_stats import EntityStats, compute_entity_stats
+from gazetteer import DEFAULT_GAZETTEER_PATH, Gazetteer, merge_entities
+from hedging import HedgeBudget, get_default_hedge_budget, hedged_call, hedged_call_async
+from latency_tracker import LatencyTracker, get_default_latency_tracker, latency_key
+from ner_io import (
+    RESULT_COLUMNS, ChunkedCsvWriter, explode_entities, iter_chunks, iter_result_chunks, iter_shard,
+    iter_texts, write_columnar_results
+)
+from prompt_template import CACHEABLE_PREFIX_MIN_TOKENS, PromptTemplate
+from rate_limiter import RateLimiter, get_default_limiter
+from reorder_buffer import ReorderBuffer
+from response_cache import ResponseCache, get_default_cache, make_cache_key
+from retry_policy import RetryPolicy
+from streaming_stats import DEFAULT_CHUNKSIZE, EntityStatsAccumulator
+from structured_output import (
+    StructuredOutputError, compile_validator, decode_json, json_schema_format,
+    parse_structured, reask_messages
+)
+from token_utils import chunk_by_token_budget, count_messages_tokens
+from usage_tracker import UsageTracker, get_default_usage_tracker
 
 # 載入 .env 檔案
 def load_env_file():
@@ -27,65 +55,658 @@ def load_env_file():
 # 在程式開始時載入 .env 檔案
 load_env_file()
 
-class SimpleNER:
-    """簡化版命名實體識別"""
-    
-    def __init__(self):
-        # 從環境變數讀取 API Key
-        api_key = os.getenv('OPENAI_API_KEY')
-        if not api_key:
-            raise ValueError("請設定 OPENAI_API_KEY 環境變數")
-        
-        self.client = OpenAI(api_key=api_key)
-    
-    def extract_entities(self, text: str) -> List[Dict[str, Any]]:
-        """使用 OpenAI API 進行實體識別"""
-        try:
-            prompt = f"""
-請從以下文本中識別並提取命名實體，包括：
+# 固定的指令放在系統訊息，每次請求的開頭相同，服務端的前綴快取才能命中
+NER_INSTRUCTIONS = """
+請從使用者提供的文本中識別並提取命名實體，包括：
 - 人名（PERSON）：人物名稱
 - 地名（LOCATION）：地點、城市、國家
 - 組織（ORGANIZATION）：公司、機構
 - 日期（DATE）：時間表達式
 - 金額（MONEY）：貨幣金額
 
-文本：{text}
-
 請以 JSON 格式返回結果：
-{{
+{
     "entities": [
-        {{"text": "實體文本", "label": "實體類型", "confidence": 0.95}}
+        {"text": "實體文本", "label": "實體類型", "confidence": 0.95}
     ]
-}}
+}
 
 只返回 JSON，不要其他文字。
 """
-            
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.1
-            )
-            
-            content = response.choices[0].message.content.strip()
-            
-            # 嘗試清理回應內容，移除可能的非 JSON 部分
-            if content.startswith('```json'):
-                content = content[7:]
-            if content.endswith('```'):
-                content = content[:-3]
-            content = content.strip()
-            
-            result = json.loads(content)
-            return result.get('entities', [])
-            
-        except json.JSONDecodeError as e:
-            print(f"JSON 解析錯誤: {e}")
-            print(f"回應內容: {content[:200]}...")
+
+NER_PACKED_INSTRUCTIONS = """
+請從使用者提供的每一段文本中分別識別並提取命名實體，包括：
+- 人名（PERSON）：人物名稱
+- 地名（LOCATION）：地點、城市、國家
+- 組織（ORGANIZATION）：公司、機構
+- 日期（DATE）：時間表達式
+- 金額（MONEY）：貨幣金額
+
+每段文本以 [編號] 開頭，請對每個編號分別返回結果，即使沒有實體也要返回空列表。
+
+請以 JSON 格式返回結果：
+{
+    "results": [
+        {"id": "0", "entities": [{"text": "實體文本", "label": "實體類型", "confidence": 0.95}]}
+    ]
+}
+
+只返回 JSON，不要其他文字。
+"""
+
+NER_PACKED_REASK_PROMPT = """
+以下編號的結果缺漏或格式不符：
+{errors}
+
+請只針對這些編號重新返回結果（JSON 格式同上），不要重複其他編號。
+"""
+
+ENTITY_LABELS = ["PERSON", "LOCATION", "ORGANIZATION", "DATE", "MONEY"]
+
+# strict 模式要求所有欄位皆為必填且不允許額外欄位
+ENTITY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "text": {"type": "string"},
+        "label": {"type": "string", "enum": ENTITY_LABELS},
+        "confidence": {"type": "number"}
+    },
+    "required": ["text", "label", "confidence"],
+    "additionalProperties": False
+}
+
+NER_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {"entities": {"type": "array", "items": ENTITY_SCHEMA}},
+    "required": ["entities"],
+    "additionalProperties": False
+}
+
+NER_PACKED_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "id": {"type": "string"},
+        "entities": {"type": "array", "items": ENTITY_SCHEMA}
+    },
+    "required": ["id", "entities"],
+    "additionalProperties": False
+}
+
+NER_PACKED_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {"results": {"type": "array", "items": NER_PACKED_ITEM_SCHEMA}},
+    "required": ["results"],
+    "additionalProperties": False
+}
+
+NER_RESPONSE_FORMAT = json_schema_format("ner_entities", NER_RESPONSE_SCHEMA)
+NER_PACKED_RESPONSE_FORMAT = json_schema_format("ner_packed_entities", NER_PACKED_RESPONSE_SCHEMA)
+
+NER_PROMPT = PromptTemplate("ner", NER_INSTRUCTIONS, "文本：{text}",
+                            response_format=NER_RESPONSE_FORMAT)
+NER_PACKED_PROMPT = PromptTemplate("ner_packed", NER_PACKED_INSTRUCTIONS, "{documents}",
+                                   response_format=NER_PACKED_RESPONSE_FORMAT)
+
+validate_ner_response = compile_validator(NER_RESPONSE_SCHEMA)
+# 打包回應逐項驗證，只有格式錯誤的編號需要重新詢問
+validate_packed_item = compile_validator(NER_PACKED_ITEM_SCHEMA)
+
+def build_ner_messages(text: str) -> List[Dict[str, str]]:
+    """建立單一文本的實體識別 messages"""
+    return NER_PROMPT.messages(text=text)
+
+def parse_entities_response(content: str) -> List[Dict[str, Any]]:
+    """解析並驗證單一文本的 API 回應內容為實體列表"""
+    return parse_structured(content, validate_ner_response)['entities']
+
+PackedResult = Tuple[Dict[int, List[Dict[str, Any]]], Dict[int, str]]
+
+def parse_packed_response(content: str, expected) -> PackedResult:
+    """
+    解析打包回應，回傳 ({編號: 實體列表}, {編號: 錯誤訊息})
+
+    expected 為需要結果的編號；缺漏或格式錯誤的編號列在錯誤中
+    """
+    expected = set(expected)
+    try:
+        items = decode_json(content).get('results')
+    except (StructuredOutputError, AttributeError) as e:
+        return {}, {index: f"回應無法解析: {e}" for index in expected}
+    if not isinstance(items, list):
+        return {}, {index: "回應缺少 results 陣列" for index in expected}
+
+    parsed, failures = {}, {}
+    for item in items:
+        try:
+            index = int(item['id'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if index not in expected:
+            continue
+        try:
+            validate_packed_item(item)
+        except StructuredOutputError as e:
+            failures[index] = str(e)
+            continue
+        parsed[index] = item['entities']
+        failures.pop(index, None)
+    for index in expected - parsed.keys() - failures.keys():
+        failures[index] = "缺少此編號的結果"
+    return parsed, failures
+
+class SimpleNER:
+    """簡化版命名實體識別"""
+    
+    model = "gpt-4o-mini"
+    temperature = 0.1
+    # 預扣給回應的 token 數，實際用量回來後再校正
+    expected_completion_tokens = 300
+    # 打包模式下每段文本預扣的回應 token 數
+    packed_completion_tokens_per_text = 100
+    # 超過此 token 數的文本依句子切段、並行識別後再合併
+    max_chunk_tokens = 1500
+    chunk_overlap_tokens = 100
+    max_chunk_workers = 8
+    # 回應不符合 schema 時附上錯誤訊息重新詢問的次數
+    max_reasks = 1
+    
+    def __init__(self, rate_limiter: RateLimiter = None, cache: ResponseCache = None,
+                 use_cache: bool = True, gazetteer: Gazetteer = None,
+                 usage_tracker: UsageTracker = None, client_provider: ClientProvider = None,
+                 api_key: str = None, organization: str = None,
+                 latency_tracker: LatencyTracker = None, hedge_budget: HedgeBudget = None,
+                 retry_policy: RetryPolicy = None):
+        # 未指定時從環境變數讀取 API Key
+        api_key = api_key or os.getenv('OPENAI_API_KEY')
+        if not api_key:
+            raise ValueError("請設定 OPENAI_API_KEY 環境變數")
+        
+        # 客戶端來自程序共用的連線池，多個實例不會各自建立連線；
+        # 重試由 retry_policy 處理，關閉 SDK 內建的重試以免重複退避
+        self.api_key = api_key
+        self.organization = organization
+        self.client_provider = client_provider or get_client_provider()
+        self._client = None
+        self._async_client = None
+        self.rate_limiter = rate_limiter or get_default_limiter()
+        self.cache = (cache or get_default_cache()) if use_cache else None
+        self.usage_tracker = usage_tracker or get_default_usage_tracker()
+        # 指定詞典時先以本地比對標出已知實體，只將剩餘片段送往 API
+        self.gazetteer = gazetteer
+        # 依近期延遲決定逾時與對沖時機，暫時性錯誤以指數退避重試
+        self.latency_tracker = latency_tracker or get_default_latency_tracker()
+        self.hedge_budget = hedge_budget or get_default_hedge_budget()
+        self.retry_policy = retry_policy or RetryPolicy.from_env()
+    
+    @property
+    def client(self):
+        """
+        共用的同步客戶端
+
+        每次都向 client_provider 取得，ensure_capacity 放大連線池後立即改用新的客戶端
+        """
+        return self._client or self.client_provider.get_client(
+            self.api_key, self.organization, max_retries=0)
+    
+    @client.setter
+    def client(self, client):
+        self._client = client
+    
+    @property
+    def async_client(self):
+        """目前事件迴圈共用的非同步客戶端"""
+        return self._async_client or self.client_provider.get_async_client(
+            self.api_key, self.organization, max_retries=0)
+    
+    @async_client.setter
+    def async_client(self, client):
+        self._async_client = client
+    
+    def _build_messages(self, text: str) -> List[Dict[str, str]]:
+        """建立實體識別 messages"""
+        return build_ner_messages(text)
+    
+    def _build_packed_messages(self, texts: List[str]) -> List[Dict[str, str]]:
+        """建立多文本打包的實體識別 messages"""
+        documents = "\n".join(f"[{i}] {text}" for i, text in enumerate(texts))
+        return NER_PACKED_PROMPT.messages(documents=documents)
+    
+    def _parse_entities(self, content: str) -> List[Dict[str, Any]]:
+        """解析並驗證 API 回應內容為實體列表"""
+        return parse_entities_response(content)
+    
+    def _parse_packed_entities(self, content: str, expected) -> PackedResult:
+        """解析打包回應，回傳 ({編號: 實體列表}, {編號: 錯誤訊息})"""
+        return parse_packed_response(content, expected)
+    
+    def _packed_reask(self, messages: List[Dict[str, str]], content: str,
+                      failures: Dict[int, str]):
+        """只針對失敗編號重新詢問的 messages 與預扣回應 token 數"""
+        errors = "\n".join(f"[{index}] {error}" for index, error in sorted(failures.items()))
+        messages = messages + [
+            {"role": "assistant", "content": content or ''},
+            {"role": "user", "content": NER_PACKED_REASK_PROMPT.format(errors=errors)}
+        ]
+        return messages, self.packed_completion_tokens_per_text * len(failures)
+    
+    def _cache_key(self, text: str) -> str:
+        """實體識別結果的快取鍵"""
+        return make_cache_key(text, self.model, NER_PROMPT.identity, self.temperature)
+    
+    def _cache_get(self, text: str):
+        """查詢快取，未啟用或未命中時回傳 None"""
+        if self.cache is None:
+            return None
+        return self.cache.get(self._cache_key(text))
+    
+    def _cache_set(self, text: str, entities: List[Dict[str, Any]]):
+        """寫入快取（只快取成功解析的結果）"""
+        if self.cache is not None:
+            self.cache.set(self._cache_key(text), entities)
+    
+    def _count_prompt_tokens(self, messages: List[Dict[str, str]]) -> int:
+        """在本地計算提示詞 token 數"""
+        return count_messages_tokens(messages, self.model)
+    
+    def _record_response(self, raw_response, estimated_tokens: int, prompt_tokens: int,
+                         prompt: PromptTemplate):
+        """依回應標頭與實際用量校正速率限制器、記錄 token 用量，並回傳解析後的回應"""
+        self.rate_limiter.update_from_headers(raw_response.headers)
+        response = raw_response.parse()
+        usage = getattr(response, 'usage', None)
+        self.rate_limiter.record_usage(estimated_tokens, usage.total_tokens if usage else None)
+        self.usage_tracker.record(prompt.name, prompt_tokens, usage)
+        return response
+    
+    def _latency_key(self, prompt: PromptTemplate, prompt_tokens: int) -> str:
+        """延遲統計的鍵；打包與單筆請求依模板分開，長段落與短文本依提示詞大小分開統計"""
+        return latency_key(self.model, prompt.name, prompt_tokens)
+    
+    def _request_options(self, prompt: PromptTemplate, latency_key: str) -> Dict[str, Any]:
+        """請求參數；延遲樣本足夠時以 p95 的倍數作為逾時"""
+        options = prompt.request_options()
+        timeout = self.latency_tracker.timeout(latency_key)
+        if timeout is not None:
+            options['timeout'] = timeout
+        return options
+    
+    def _send(self, messages: List[Dict[str, str]], prompt: PromptTemplate, latency_key: str):
+        """送出一次請求並記錄延遲"""
+        started = time.monotonic()
+        raw_response = self.client.chat.completions.with_raw_response.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            **self._request_options(prompt, latency_key)
+        )
+        self.latency_tracker.record(latency_key, time.monotonic() - started)
+        return raw_response
+    
+    async def _send_async(self, messages: List[Dict[str, str]], prompt: PromptTemplate,
+                          latency_key: str):
+        """非同步版本的 _send"""
+        started = time.monotonic()
+        raw_response = await self.async_client.chat.completions.with_raw_response.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            **self._request_options(prompt, latency_key)
+        )
+        self.latency_tracker.record(latency_key, time.monotonic() - started)
+        return raw_response
+    
+    def _create_completion(self, messages: List[Dict[str, str]], completion_tokens: int = None,
+                           prompt: PromptTemplate = NER_PROMPT):
+        """
+        在速率限制下送出 chat completion 請求（messages 需由 prompt 模板建立）
+        
+        超過近期 p95 延遲仍未回應時在對沖預算內再送一次相同請求，取先回應者；
+        429、5xx 與逾時以帶抖動的指數退避重試，重試用盡或其他錯誤直接拋出
+        """
+        prompt_tokens = self._count_prompt_tokens(messages)
+        if completion_tokens is None:
+            completion_tokens = self.expected_completion_tokens
+        estimated_tokens = prompt_tokens + completion_tokens
+        latency_key = self._latency_key(prompt, prompt_tokens)
+        
+        def send():
+            return self._send(messages, prompt, latency_key)
+        
+        def hedge():
+            # 對沖請求同樣佔用速率限制額度
+            self.rate_limiter.acquire(estimated_tokens)
+            return send()
+        
+        def attempt():
+            self.rate_limiter.acquire(estimated_tokens)
+            return hedged_call(send, self.latency_tracker.hedge_delay(latency_key),
+                               self.hedge_budget, estimated_tokens, hedge)
+        
+        raw_response = self.retry_policy.call(attempt)
+        return self._record_response(raw_response, estimated_tokens, prompt_tokens, prompt)
+    
+    async def _create_completion_async(self, messages: List[Dict[str, str]],
+                                       completion_tokens: int = None,
+                                       prompt: PromptTemplate = NER_PROMPT):
+        """非同步版本的 _create_completion"""
+        prompt_tokens = self._count_prompt_tokens(messages)
+        if completion_tokens is None:
+            completion_tokens = self.expected_completion_tokens
+        estimated_tokens = prompt_tokens + completion_tokens
+        latency_key = self._latency_key(prompt, prompt_tokens)
+        
+        def send():
+            return self._send_async(messages, prompt, latency_key)
+        
+        async def hedge():
+            await self.rate_limiter.acquire_async(estimated_tokens)
+            return await send()
+        
+        async def attempt():
+            await self.rate_limiter.acquire_async(estimated_tokens)
+            return await hedged_call_async(send, self.latency_tracker.hedge_delay(latency_key),
+                                           self.hedge_budget, estimated_tokens, hedge)
+        
+        raw_response = await self.retry_policy.call_async(attempt)
+        return self._record_response(raw_response, estimated_tokens, prompt_tokens, prompt)
+    
+    def _complete_entities(self, text: str) -> List[Dict[str, Any]]:
+        """
+        送出單筆結構化請求並驗證回應
+        
+        不符合 schema 時附上錯誤訊息重新詢問（最多 max_reasks 次），仍失敗則拋出 StructuredOutputError
+        """
+        messages = self._build_messages(text)
+        for attempt in range(self.max_reasks + 1):
+            content = self._create_completion(messages).choices[0].message.content
+            try:
+                return self._parse_entities(content)
+            except StructuredOutputError as e:
+                if attempt == self.max_reasks:
+                    raise
+                messages = reask_messages(messages, content, e)
+    
+    async def _complete_entities_async(self, text: str) -> List[Dict[str, Any]]:
+        """非同步版本的 _complete_entities"""
+        messages = self._build_messages(text)
+        for attempt in range(self.max_reasks + 1):
+            response = await self._create_completion_async(messages)
+            content = response.choices[0].message.content
+            try:
+                return self._parse_entities(content)
+            except StructuredOutputError as e:
+                if attempt == self.max_reasks:
+                    raise
+                messages = reask_messages(messages, content, e)
+    
+    def _complete_packed(self, texts: List[str]) -> Dict[int, List[Dict[str, Any]]]:
+        """
+        送出打包結構化請求，回傳驗證通過的 {編號: 實體列表}
+        
+        缺漏或格式錯誤的編號附上錯誤訊息在同一對話中重新詢問，只要求回傳這些編號
+        """
+        messages, completion_tokens = self._packed_messages(texts)
+        content = self._create_completion(messages, completion_tokens,
+                                          NER_PACKED_PROMPT).choices[0].message.content
+        parsed, failures = self._parse_packed_entities(content, range(len(texts)))
+        for _ in range(self.max_reasks):
+            if not failures:
+                break
+            messages, completion_tokens = self._packed_reask(messages, content, failures)
+            try:
+                content = self._create_completion(messages, completion_tokens,
+                                                  NER_PACKED_PROMPT).choices[0].message.content
+            except Exception as e:
+                # 已驗證通過的編號仍保留，其餘由呼叫端改用單筆請求
+                print(f"API 錯誤: {e}")
+                break
+            retried, failures = self._parse_packed_entities(content, failures)
+            parsed.update(retried)
+        return parsed
+    
+    async def _complete_packed_async(self, texts: List[str]) -> Dict[int, List[Dict[str, Any]]]:
+        """非同步版本的 _complete_packed"""
+        messages, completion_tokens = self._packed_messages(texts)
+        response = await self._create_completion_async(messages, completion_tokens,
+                                                       NER_PACKED_PROMPT)
+        content = response.choices[0].message.content
+        parsed, failures = self._parse_packed_entities(content, range(len(texts)))
+        for _ in range(self.max_reasks):
+            if not failures:
+                break
+            messages, completion_tokens = self._packed_reask(messages, content, failures)
+            try:
+                response = await self._create_completion_async(messages, completion_tokens,
+                                                               NER_PACKED_PROMPT)
+            except Exception as e:
+                print(f"API 錯誤: {e}")
+                break
+            content = response.choices[0].message.content
+            retried, failures = self._parse_packed_entities(content, failures)
+            parsed.update(retried)
+        return parsed
+    
+    def _split_known(self, text: str):
+        """以詞典拆出 (已知實體, 需送往 API 的剩餘片段)；完全涵蓋時剩餘片段為 None"""
+        if self.gazetteer is None:
+            return [], text
+        return self.gazetteer.split(text)
+    
+    def extract_entities(self, text: str, raise_errors: bool = True) -> List[Dict[str, Any]]:
+        """
+        使用 OpenAI API 進行實體識別（有詞典時只送出詞典未涵蓋的部分）
+        
+        暫時性 API 錯誤會先退避重試；重試用盡、其他錯誤或回應格式錯誤時拋出，
+        不會與「沒有實體」混淆；raise_errors=False 時改為印出錯誤並回傳空列表
+        """
+        known, residual = self._split_known(text)
+        if residual is None:
+            return known
+        return merge_entities(known, self._extract_entities_api(residual, raise_errors))
+    
+    def _split_long(self, text: str):
+        """長文本切成有重疊的段落；未超過 max_chunk_tokens 時回傳 None"""
+        chunks = split_document(text, self.max_chunk_tokens, self.chunk_overlap_tokens, self.model)
+        return chunks if len(chunks) > 1 else None
+    
+    def _extract_entities_api(self, text: str, raise_errors: bool = True) -> List[Dict[str, Any]]:
+        """以 API 進行實體識別；長文本切段後並行送出，實體依字元位置合併"""
+        chunks = self._split_long(text)
+        if chunks is None:
+            return self._request_entities(text, raise_errors)
+        
+        with ThreadPoolExecutor(max_workers=min(len(chunks), self.max_chunk_workers)) as pool:
+            chunk_entities = list(pool.map(lambda chunk: self._request_entities(chunk, raise_errors),
+                                           [chunk for _, chunk in chunks]))
+        return merge_chunk_entities(chunks, chunk_entities)
+    
+    def _request_entities(self, text: str, raise_errors: bool = True) -> List[Dict[str, Any]]:
+        """查詢快取，未命中時以單筆請求進行實體識別"""
+        cached = self._cache_get(text)
+        if cached is not None:
+            return cached
+        
+        try:
+            entities = self._complete_entities(text)
+        except StructuredOutputError as e:
+            print(f"回應格式錯誤: {e}")
+            if raise_errors:
+                raise
             return []
         except Exception as e:
             print(f"API 錯誤: {e}")
+            if raise_errors:
+                raise
             return []
+        
+        self._cache_set(text, entities)
+        return entities
+    
+    async def extract_entities_async(self, text: str, raise_errors: bool = True,
+                                     semaphore: asyncio.Semaphore = None) -> List[Dict[str, Any]]:
+        """
+        使用非同步 OpenAI 客戶端進行實體識別
+        
+        API 或解析錯誤會拋出，讓批次流程記為失敗；raise_errors=False 時改為回傳空列表。
+        每個 API 請求送出前取得 semaphore（長文本的各段落也是），呼叫端傳入共用的
+        semaphore 即可限制所有在途請求；未指定時最多 max_chunk_workers 個段落同時送出
+        """
+        known, residual = self._split_known(text)
+        if residual is None:
+            return known
+        return merge_entities(known, await self._extract_entities_api_async(residual, raise_errors,
+                                                                            semaphore))
+    
+    async def _extract_entities_api_async(self, text: str, raise_errors: bool = True,
+                                          semaphore: asyncio.Semaphore = None) -> List[Dict[str, Any]]:
+        """非同步版本的 _extract_entities_api"""
+        semaphore = semaphore or asyncio.Semaphore(self.max_chunk_workers)
+        chunks = self._split_long(text)
+        if chunks is None:
+            return await self._request_entities_async(text, raise_errors, semaphore)
+        
+        chunk_entities = await asyncio.gather(
+            *(self._request_entities_async(chunk, raise_errors, semaphore) for _, chunk in chunks)
+        )
+        return merge_chunk_entities(chunks, chunk_entities)
+    
+    async def _request_entities_async(self, text: str, raise_errors: bool,
+                                      semaphore: asyncio.Semaphore) -> List[Dict[str, Any]]:
+        """非同步版本的 _request_entities（快取未命中時在 semaphore 內送出請求）"""
+        cached = self._cache_get(text)
+        if cached is not None:
+            return cached
+        
+        try:
+            async with semaphore:
+                entities = await self._complete_entities_async(text)
+        except StructuredOutputError as e:
+            print(f"回應格式錯誤: {e}")
+            if raise_errors:
+                raise
+            return []
+        except Exception as e:
+            print(f"API 錯誤: {e}")
+            if raise_errors:
+                raise
+            return []
+        
+        self._cache_set(text, entities)
+        return entities
+
+    def _packed_messages(self, texts: List[str]):
+        """打包請求的 messages 與預扣回應 token 數"""
+        messages = self._build_packed_messages(texts)
+        return messages, self.packed_completion_tokens_per_text * len(texts)
+    
+    def _merge_split_results(self, splits, api_results) -> List[List[Dict[str, Any]]]:
+        """將 API 對剩餘片段的結果併回詞典比對結果；例外物件原樣保留"""
+        results = [known for known, _ in splits]
+        api_indices = [i for i, (_, residual) in enumerate(splits) if residual is not None]
+        for i, entities in zip(api_indices, api_results):
+            results[i] = entities if isinstance(entities, Exception) else merge_entities(results[i], entities)
+        return results
+    
+    def extract_entities_packed(self, texts: List[str], max_input_tokens: int = 2000,
+                                max_texts_per_request: int = 50,
+                                raise_errors: bool = True) -> List[List[Dict[str, Any]]]:
+        """
+        將多段文本打包成一次請求進行實體識別
+        
+        依 token 預算分組，回傳與輸入順序對應的實體列表；
+        回應中缺漏或格式錯誤的文本先附上錯誤訊息重新詢問，仍失敗才改用單筆請求。
+        單筆請求的錯誤以例外物件放在對應位置回傳（raise_errors=False 時為空列表）
+        """
+        splits = [self._split_known(text) for text in texts]
+        residuals = [residual for _, residual in splits if residual is not None]
+        api_results = self._extract_entities_packed_api(residuals, max_input_tokens,
+                                                        max_texts_per_request, raise_errors)
+        return self._merge_split_results(splits, api_results)
+    
+    def _extract_entities_packed_api(self, texts: List[str], max_input_tokens: int,
+                                     max_texts_per_request: int,
+                                     raise_errors: bool) -> List[List[Dict[str, Any]]]:
+        results: List[List[Dict[str, Any]]] = [None] * len(texts)
+        pending = []
+        for i, text in enumerate(texts):
+            cached = self._cache_get(text)
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.append(i)
+        
+        groups = chunk_by_token_budget([texts[i] for i in pending], max_input_tokens,
+                                       max_texts_per_request, model=self.model)
+        for group in groups:
+            indices = [pending[j] for j in group]
+            group_texts = [texts[i] for i in indices]
+            parsed = {}
+            if len(indices) > 1:
+                try:
+                    parsed = self._complete_packed(group_texts)
+                except Exception as e:
+                    print(f"API 錯誤: {e}")
+            
+            for position, i in enumerate(indices):
+                if position in parsed:
+                    results[i] = parsed[position]
+                    self._cache_set(texts[i], results[i])
+                else:
+                    try:
+                        results[i] = self._extract_entities_api(texts[i], raise_errors)
+                    except Exception as e:
+                        results[i] = e
+        
+        return results
+    
+    async def extract_entities_packed_async(self, texts: List[str], raise_errors: bool = True,
+                                            semaphore: asyncio.Semaphore = None
+                                            ) -> List[List[Dict[str, Any]]]:
+        """
+        非同步版本：以一次打包請求處理一組文本
+        
+        呼叫端需自行依 token 預算分組；重新詢問後仍缺漏的文本會並行改用單筆請求。
+        單筆請求的錯誤以例外物件放在對應位置回傳（raise_errors=False 時為空列表）；
+        semaphore 同 extract_entities_async
+        """
+        splits = [self._split_known(text) for text in texts]
+        residuals = [residual for _, residual in splits if residual is not None]
+        api_results = await self._extract_entities_packed_api_async(residuals, raise_errors,
+                                                                    semaphore)
+        return self._merge_split_results(splits, api_results)
+    
+    async def _extract_entities_packed_api_async(self, texts: List[str], raise_errors: bool,
+                                                 semaphore: asyncio.Semaphore = None
+                                                 ) -> List[List[Dict[str, Any]]]:
+        semaphore = semaphore or asyncio.Semaphore(self.max_chunk_workers)
+        results: List[List[Dict[str, Any]]] = [self._cache_get(text) for text in texts]
+        pending = [i for i, cached in enumerate(results) if cached is None]
+        
+        parsed = {}
+        if len(pending) > 1:
+            pending_texts = [texts[i] for i in pending]
+            try:
+                async with semaphore:
+                    parsed = await self._complete_packed_async(pending_texts)
+            except Exception as e:
+                print(f"API 錯誤: {e}")
+        
+        fallback = []
+        for position, i in enumerate(pending):
+            if position in parsed:
+                results[i] = parsed[position]
+                self._cache_set(texts[i], results[i])
+            else:
+                fallback.append(i)
+        
+        fallback_results = await asyncio.gather(
+            *(self._extract_entities_api_async(texts[i], raise_errors, semaphore) for i in fallback),
+            return_exceptions=raise_errors
+        )
+        for i, entities in zip(fallback, fallback_results):
+            results[i] = entities
+        
+        return results
 
 def demonstrate_ner_applications():
     """展示 NER 在不同應用場景中的使用"""
@@ -102,8 +723,6 @@ def demonstrate_ner_applications():
     news_entities = ner.extract_entities(news_text)
     display_entities(news_entities)
     
-    time.sleep(2)  # 避免 API 限制
-    
     # 應用場景 2: 郵件分類
     print("\n📧 應用場景 2: 郵件分類")
     print("=" * 50)
@@ -114,8 +733,6 @@ def demonstrate_ner_applications():
     email_entities = ner.extract_entities(email_text)
     display_entities(email_entities)
     
-    time.sleep(2)
-    
     # 應用場景 3: 簡歷解析
     print("\n💼 應用場景 3: 簡歷解析")
     print("=" * 50)
@@ -126,8 +743,6 @@ def demonstrate_ner_applications():
     resume_entities = ner.extract_entities(resume_text)
     display_entities(resume_entities)
     
-    time.sleep(2)
-    
     # 應用場景 4: 合同分析
     print("\n📝 應用場景 4: 合同分析")
     print("=" * 50)
@@ -138,8 +753,6 @@ def demonstrate_ner_applications():
     contract_entities = ner.extract_entities(contract_text)
     display_entities(contract_entities)
     
-    time.sleep(2)
-    
     # 應用場景 5: 醫療記錄
     print("\n🏥 應用場景 5: 醫療記錄")
     print("=" * 50)
@@ -179,97 +792,418 @@ def display_entities(entities: List[Dict[str, Any]]):
             confidence = entity.get('confidence', 0)
             print(f"    - {entity['text']} (可信度: {confidence:.2f})")
 
-def batch_process_texts(texts: List[str], batch_size: int = 3) -> pd.DataFrame:
-    """批量處理文本並進行實體識別"""
-    ner = SimpleNER()
-    results = []
+def bind_journal_input(journal: ProgressJournal, ner: SimpleNER,
+                       items: Iterable[Tuple[int, str]]):
+    """
+    將進度日誌綁定到 (text_id, text) 序列的指紋
+
+    指紋涵蓋每筆的 text_id 與內容鍵（正規化文本、模型與提示詞），輸入被修改、
+    重新排序或替換後續跑時拋出 ValueError，不會把舊結果配給同一位置的其他文本
+    """
+    journal.bind_input(input_fingerprint(f"{text_id}:{ner._cache_key(text)}"
+                                         for text_id, text in items))
+
+def build_result_row(text_id: int, text: str, entities: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """建立單一文本的處理結果列"""
+    return {
+        'text_id': text_id,
+        'text': text,
+        'entities': json.dumps(entities, ensure_ascii=False),
+        'entity_count': len(entities),
+        'processed': True
+    }
+
+def build_error_row(text_id: int, text: str, error: Any) -> Dict[str, Any]:
+    """建立處理失敗的結果列"""
+    return {
+        'text_id': text_id,
+        'text': text,
+        'entities': json.dumps([], ensure_ascii=False),
+        'entity_count': 0,
+        'processed': False,
+        'error': str(error)
+    }
+
+async def iter_process_texts_async(texts: List[str], max_concurrency: int = 8,
+                                   ner: SimpleNER = None, packed: bool = False,
+                                   max_pack_tokens: int = 2000,
+                                   text_ids: List[int] = None,
+                                   journal: ProgressJournal = None,
+                                   dedup: str = None, ordered: bool = False,
+                                   reorder_window: int = None,
+                                   report: Dict[str, Any] = None
+                                   ) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """
+    以非同步方式批量處理文本，每個文本一完成就產出 (位置, 結果列)
+    
+    位置為文本在 texts 中的索引；ordered=False 時依完成順序產出，第一個請求回來
+    即可取得結果；ordered=True 時經重排緩衝區依輸入順序產出，請求最多只領先
+    尚未產出的位置 reorder_window 個才送出（預設為 max_concurrency 個請求所涵蓋
+    位置數的 4 倍），暫存的亂序結果因此有上限，消費端處理較慢時也會暫停送出新請求。
+    其餘參數同 batch_process_texts_async；指定 report 時寫入去重統計（'dedup'）；
+    提前結束迭代時取消仍在途的請求
+    """
+    ner = ner or SimpleNER()
+    # 連線池至少要能容納所有在途請求，否則請求會在連線池排隊
+    ner.client_provider.ensure_capacity(max_concurrency)
+    if text_ids is None:
+        text_ids = list(range(len(texts)))
+        if journal is not None:
+            # 以位置作為 text_id 時，日誌只對同一份輸入有效
+            bind_journal_input(journal, ner, zip(text_ids, texts))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    completed = 0
+    
+    restored: Dict[int, Dict[str, Any]] = {}
+    pending = list(range(len(texts)))
+    if journal is not None:
+        done = journal.get_results(text_ids)
+        for i, text_id in enumerate(text_ids):
+            if text_id in done:
+                restored[i] = build_result_row(text_id, texts[i], done[text_id])
+        pending = [i for i in pending if i not in restored]
+        if restored:
+            print(f"⏩ 從進度日誌恢復 {len(restored)} 個已完成的文本")
     
-    print(f"\n🔄 批量處理 {len(texts)} 個文本...")
+    requested = pending
+    duplicates: Dict[int, List[int]] = {}
+    if dedup and pending:
+        plan = plan_dedup([texts[i] for i in pending], dedup)
+        requested = [pending[p] for p in plan.representatives]
+        duplicates = {pending[rep]: [pending[p] for p in positions]
+                      for rep, positions in plan.duplicates().items()}
+        print(plan.summary())
+        if report is not None:
+            report['dedup'] = plan.report()
+    
+    # 各組依位置遞增排列，組內位置連續
+    if packed:
+        groups = [[requested[j] for j in group]
+                  for group in chunk_by_token_budget([texts[i] for i in requested], max_pack_tokens,
+                                                     model=ner.model)]
+    else:
+        groups = [[i] for i in requested]
+    
+    print(f"\n🔄 批量處理 {len(pending)} 個文本（{len(groups)} 個請求，並行數: {max_concurrency}）...")
     print("=" * 50)
     
-    for i, text in enumerate(texts):
-        print(f"處理文本 {i+1}/{len(texts)}")
-        
+    finished: asyncio.Queue = asyncio.Queue()
+    buffer = None
+    if ordered:
+        window = reorder_window or 4 * max_concurrency * max(map(len, groups), default=1)
+        buffer = ReorderBuffer(window)
+    
+    async def process(indices: List[int]):
         try:
-            entities = ner.extract_entities(text)
+            group_texts = [texts[i] for i in indices]
+            # 每個 API 請求（含長文本的各段落與打包後的單筆補救）各自取得 semaphore
+            try:
+                if packed:
+                    entity_lists = await ner.extract_entities_packed_async(
+                        group_texts, raise_errors=True, semaphore=semaphore)
+                else:
+                    entity_lists = [await ner.extract_entities_async(
+                        group_texts[0], raise_errors=True, semaphore=semaphore)]
+            except Exception as e:
+                entity_lists = [e] * len(indices)
             
-            result = {
-                'text_id': i,
-                'text': text,
-                'entities': json.dumps(entities, ensure_ascii=False),
-                'entity_count': len(entities),
-                'processed': True
-            }
-            
-            results.append(result)
-            
-            # 顯示提取的實體
+            for i, entities in zip(indices, entity_lists):
+                finish(i, entities)
+                # 重複文本沿用代表文本的結果
+                for j in duplicates.get(i, []):
+                    finish(j, entities if isinstance(entities, Exception)
+                           else entities_for_duplicate(entities, texts[j]))
+        except Exception as e:
+            # API 以外的錯誤（例如寫入日誌失敗）交由迭代端拋出
+            finished.put_nowait((None, e))
+    
+    def finish(i: int, entities):
+        nonlocal completed
+        completed += 1
+        error = entities if isinstance(entities, Exception) else None
+        print(f"處理文本 {text_ids[i]+1} 完成 ({completed}/{len(pending)})")
+        if error is not None:
+            row = build_error_row(text_ids[i], texts[i], error)
+            if journal is not None:
+                journal.record_failure(text_ids[i], str(error))
+            print(f"  處理錯誤: {error}")
+        else:
+            row = build_result_row(text_ids[i], texts[i], entities)
+            if journal is not None:
+                journal.record_success(text_ids[i], entities)
             if entities:
                 print(f"  找到 {len(entities)} 個實體:")
                 for entity in entities:
                     print(f"    - {entity['text']} ({entity['label']})")
             else:
                 print("  未找到實體")
-            
-        except Exception as e:
-            print(f"  處理錯誤: {e}")
-            results.append({
-                'text_id': i,
-                'text': text,
-                'entities': json.dumps([], ensure_ascii=False),
-                'entity_count': 0,
-                'processed': False,
-                'error': str(e)
-            })
-        
-        # 批次間暫停
-        if (i + 1) % batch_size == 0:
-            print("  暫停 2 秒...")
-            time.sleep(2)
+        finished.put_nowait((i, row))
+    
+    tasks = set()
+    next_group = 0
+    
+    def launch():
+        """
+        建立已可送出的請求任務
+
+        ordered=True 時組內最小位置進入視窗才建立任務（該位置之前的結果都已產出或在途，
+        不會互相等待），在途與排隊的任務數因此受視窗限制；否則一次建立全部任務
+        """
+        nonlocal next_group
+        while next_group < len(groups) and (buffer is None or buffer.admits(groups[next_group][0])):
+            task = asyncio.ensure_future(process(groups[next_group]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            next_group += 1
+    
+    for i, row in restored.items():
+        finished.put_nowait((i, row))
+    launch()
+    # 日誌記錄累積後批次寫入，結束（含提前結束）時寫入剩餘的記錄
+    with journal.batch() if journal is not None else nullcontext():
+        try:
+            for _ in range(len(texts)):
+                i, row = await finished.get()
+                if i is None:
+                    raise row
+                if buffer is None:
+                    yield i, row
+                    continue
+                released = buffer.push(i, row)
+                if released:
+                    # 視窗前移後先送出新進入視窗的請求，再交給消費端
+                    launch()
+                for item in released:
+                    yield item
+        finally:
+            remaining = list(tasks)
+            for task in remaining:
+                task.cancel()
+            await asyncio.gather(*remaining, return_exceptions=True)
+
+async def batch_process_texts_async(texts: List[str], max_concurrency: int = 8,
+                                    ner: SimpleNER = None, packed: bool = False,
+                                    max_pack_tokens: int = 2000,
+                                    text_ids: List[int] = None,
+                                    journal: ProgressJournal = None,
+                                    dedup: str = None) -> pd.DataFrame:
+    """
+    以非同步方式批量處理文本
+    
+    同時最多保持 max_concurrency 個請求在途，結果依 text_id 排序；
+    packed=True 時依 max_pack_tokens 將多段文本打包成一次請求；
+    text_ids 未指定時以輸入順序作為 text_id；
+    指定 journal 時跳過已完成的 text_id，並記錄每筆的處理結果（未指定 text_ids 時
+    日誌綁定輸入內容，輸入改變後續跑會拋出 ValueError）；
+    dedup 為 'exact' 或 'near' 時每群重複文本只送出一個代表，
+    結果分送回群內每個 text_id，節省的呼叫數記在回傳 DataFrame 的 attrs['dedup']。
+    需要邊處理邊取得結果時改用 iter_process_texts_async
+    """
+    results: List[Dict[str, Any]] = [None] * len(texts)
+    report: Dict[str, Any] = {}
+    async for i, row in iter_process_texts_async(texts, max_concurrency, ner, packed=packed,
+                                                 max_pack_tokens=max_pack_tokens,
+                                                 text_ids=text_ids, journal=journal,
+                                                 dedup=dedup, report=report):
+        results[i] = row
+    
+    df = pd.DataFrame(results)
+    if 'dedup' in report:
+        df.attrs['dedup'] = report['dedup']
+    return df
+
+def batch_process_texts(texts: List[str], max_concurrency: int = 8, packed: bool = False,
+                        max_pack_tokens: int = 2000, journal_path: str = None,
+                        gazetteer: Gazetteer = None, dedup: str = None) -> pd.DataFrame:
+    """
+    批量處理文本並進行實體識別
+    
+    指定 journal_path 可在中斷後續跑；指定 gazetteer 時先以本地詞典比對；
+    dedup 為 'exact' 或 'near' 時重複文本只送出一次
+    """
+    journal = ProgressJournal(journal_path) if journal_path else None
+    return asyncio.run(batch_process_texts_async(
+        texts, max_concurrency, SimpleNER(gazetteer=gazetteer), packed=packed,
+        max_pack_tokens=max_pack_tokens, journal=journal, dedup=dedup
+    ))
+
+async def stream_process_texts_async(input_path: str, output_path: str, chunk_size: int = 500,
+                                     max_concurrency: int = 8, packed: bool = False,
+                                     max_pack_tokens: int = 2000, resume: bool = True,
+                                     gazetteer: Gazetteer = None, dedup: str = None,
+                                     index_path: str = None, shard: Tuple[int, int] = None,
+                                     ner: SimpleNER = None) -> int:
+    """
+    串流處理文本檔並分段寫入結果
+    
+    逐段讀取 input_path（JSONL / CSV / TXT，可 gzip），每段處理完立即附加到
+    output_path，記憶體只保留一段的資料；回傳本次寫入的筆數。
+    進度記錄在 output_path 旁的日誌檔，resume=True 時跳過已完成的 text_id
+    並接續附加（輸入與日誌記錄的不符時拋出 ValueError，需以 resume=False 重跑）；先前失敗的文本會重試，新結果附加在舊列之後（不改寫舊列，
+    分析與視覺化一律以每個 text_id 的最後一列為準，見 ner_io.iter_result_chunks）；
+    dedup 只在每一段內合併重複文本；指定 index_path 時每段結果同時附加到實體倒排索引；
+    shard 為 (分片編號, 分片數) 時只處理 text_id 屬於該分片的文本
+    """
+    ner = ner or SimpleNER(gazetteer=gazetteer)
+    journal_path = output_path + '.journal.sqlite3'
+    if not resume and os.path.exists(journal_path):
+        os.remove(journal_path)
+    journal = ProgressJournal(journal_path)
+    # 先掃描一次輸入確認與日誌相符，輸入檔被修改時不沿用舊結果
+    texts = iter_texts(input_path)
+    if shard is not None:
+        texts = iter_shard(texts, *shard)
+    bind_journal_input(journal, ner, texts)
+    completed_ids = journal.completed_ids()
+    writer = ChunkedCsvWriter(output_path, append=resume)
+    index = EntityIndex(index_path) if index_path else None
+    
+    texts = iter_texts(input_path)
+    if shard is not None:
+        texts = iter_shard(texts, *shard)
+    for chunk in iter_chunks(texts, chunk_size):
+        chunk = [(text_id, text) for text_id, text in chunk if text_id not in completed_ids]
+        if not chunk:
+            continue
+        text_ids = [text_id for text_id, _ in chunk]
+        texts = [text for _, text in chunk]
+        df = await batch_process_texts_async(texts, max_concurrency, ner, packed=packed,
+                                             max_pack_tokens=max_pack_tokens, text_ids=text_ids,
+                                             dedup=dedup)
+        writer.write(df)
+        if index is not None:
+            index.add_results(df)
+        # 結果落盤後才記入日誌（同一個交易寫入整段），避免中斷時日誌領先輸出檔
+        with journal.batch():
+            for row in df.to_dict('records'):
+                if row['processed']:
+                    journal.record_success(row['text_id'], json.loads(row['entities']))
+                else:
+                    journal.record_failure(row['text_id'], str(row.get('error')))
+        print(f"💾 已寫入 {writer.rows_written} 筆結果至 '{output_path}'")
     
-    return pd.DataFrame(results)
+    print(f"📒 進度日誌: {journal.summary()}")
+    if index is not None:
+        print(f"🗂️ 實體索引: {index.stats()}")
+    return writer.rows_written
 
-def analyze_results(df: pd.DataFrame):
-    """分析處理結果"""
+def stream_process_texts(input_path: str, output_path: str = 'ner_labeled_data.csv',
+                         chunk_size: int = 500, max_concurrency: int = 8, packed: bool = False,
+                         max_pack_tokens: int = 2000, resume: bool = True,
+                         gazetteer: Gazetteer = None, dedup: str = None,
+                         index_path: str = None, shard: Tuple[int, int] = None,
+                         ner: SimpleNER = None) -> int:
+    """串流處理文本檔並分段寫入結果"""
+    return asyncio.run(stream_process_texts_async(
+        input_path, output_path, chunk_size, max_concurrency, packed, max_pack_tokens, resume,
+        gazetteer, dedup, index_path, shard, ner
+    ))
+
+def retry_failed_texts(results_path: str = 'ner_labeled_data.csv', max_concurrency: int = 8,
+                       output_path: str = None) -> pd.DataFrame:
+    """
+    只重跑結果檔中 processed == False 的文本
+    
+    重跑結果取代原本的失敗列（同一 text_id 有多列時以最後一列為準），
+    寫回 output_path（預設覆寫 results_path）並回傳更新後的 DataFrame
+    """
+    df = pd.read_csv(results_path, encoding='utf-8')
+    df = df.drop_duplicates(subset='text_id', keep='last').reset_index(drop=True)
+    failed = df[~df['processed'].astype(bool)]
+    
+    if failed.empty:
+        print("✅ 沒有需要重跑的失敗文本")
+        return df
+    
+    # 若有串流模式留下的進度日誌，一併更新
+    journal_path = results_path + '.journal.sqlite3'
+    journal = ProgressJournal(journal_path) if os.path.exists(journal_path) else None
+    
+    print(f"🔁 重跑 {len(failed)} 個失敗的文本")
+    retried = asyncio.run(batch_process_texts_async(
+        failed['text'].tolist(), max_concurrency, text_ids=failed['text_id'].tolist(),
+        journal=journal
+    ))
+    
+    df = (pd.concat([df[df['processed'].astype(bool)], retried], ignore_index=True)
+          .sort_values('text_id')
+          .reset_index(drop=True)
+          .reindex(columns=RESULT_COLUMNS))
+    df.to_csv(output_path or results_path, index=False, encoding='utf-8')
+    return df
+
+def analyze_results(df: pd.DataFrame, entities: pd.DataFrame = None):
+    """
+    分析處理結果
+    
+    entities 為展開的實體表（見 ner_io.build_entity_table）；
+    未提供時由 df 的 entities 欄展開
+    """
+    # 實體類型統計
+    if entities is None:
+        entities = explode_entities(df)
+    stats = compute_entity_stats(entities) if not entities.empty else None
+    
+    print_analysis(len(df), df['processed'].sum(), df['entity_count'].sum(), stats)
+
+def analyze_results_file(path: str = 'ner_labeled_data.csv', chunksize: int = DEFAULT_CHUNKSIZE):
+    """
+    分段分析結果 CSV
+    
+    每次只讀取 chunksize 列，以線上累加器彙總，適用於無法整份載入記憶體的結果檔；
+    續跑或重跑附加的列以每個 text_id 的最後一列為準
+    """
+    total_texts = processed_texts = total_entities = 0
+    accumulator = EntityStatsAccumulator()
+    for chunk in iter_result_chunks(path, chunksize,
+                                    usecols=['text_id', 'entities', 'entity_count', 'processed']):
+        total_texts += len(chunk)
+        processed_texts += int(chunk['processed'].sum())
+        total_entities += int(chunk['entity_count'].sum())
+        accumulator.update(explode_entities(chunk))
+    
+    stats = accumulator.result() if accumulator.overall.stats.count else None
+    print_analysis(total_texts, processed_texts, total_entities, stats)
+
+def print_analysis(total_texts: int, processed_texts: int, total_entities: int,
+                   stats: EntityStats = None):
+    """輸出結果分析"""
     print("\n📊 結果分析")
     print("=" * 50)
     
     # 基本統計
-    total_texts = len(df)
-    processed_texts = df['processed'].sum()
-    total_entities = df['entity_count'].sum()
-    
     print(f"總文本數: {total_texts}")
     print(f"成功處理: {processed_texts}")
     print(f"總實體數: {total_entities}")
     print(f"平均每文本實體數: {total_entities/processed_texts:.2f}" if processed_texts > 0 else "平均每文本實體數: 0")
     
-    # 實體類型統計
-    all_entities = []
-    for entities_json in df['entities']:
-        try:
-            entities = json.loads(entities_json)
-            all_entities.extend(entities)
-        except:
-            continue
-    
-    if all_entities:
-        entity_types = [entity.get('label', 'UNKNOWN') for entity in all_entities]
-        type_counts = {}
-        for entity_type in entity_types:
-            type_counts[entity_type] = type_counts.get(entity_type, 0) + 1
-        
+    if stats is not None:
         print(f"\n實體類型分布:")
-        for entity_type, count in sorted(type_counts.items(), key=lambda x: x[1], reverse=True):
+        for entity_type, count in stats.label_counts.items():
             print(f"  {entity_type}: {count}")
         
         # 可信度統計
-        confidences = [entity.get('confidence', 0) for entity in all_entities]
-        if confidences:
-            print(f"\n可信度統計:")
-            print(f"  平均可信度: {sum(confidences)/len(confidences):.2f}")
-            print(f"  最高可信度: {max(confidences):.2f}")
-            print(f"  最低可信度: {min(confidences):.2f}")
+        overall = stats.overall
+        print("\n可信度統計:")
+        print(f"  平均可信度: {overall['mean']:.2f}")
+        print(f"  最高可信度: {overall['max']:.2f}")
+        print(f"  最低可信度: {overall['min']:.2f}")
+
+def print_usage_summary(usage_tracker: UsageTracker = None):
+    """
+    列出 token 用量與前綴快取命中率，並提示前綴過短而無法快取的模板；
+    有延遲紀錄時一併列出 p50 / p95 與對沖請求的額外花費
+    """
+    usage_tracker = usage_tracker or get_default_usage_tracker()
+    print(usage_tracker.summary())
+    latency_tracker = get_default_latency_tracker()
+    if latency_tracker.keys():
+        print(latency_tracker.summary())
+        print(get_default_hedge_budget().summary())
+    for prompt in (NER_PROMPT, NER_PACKED_PROMPT):
+        if prompt.name in usage_tracker.names() and not prompt.is_cacheable(SimpleNER.model):
+            print(f"   ℹ️ {prompt.name} 的固定前綴只有 {prompt.prefix_tokens(SimpleNER.model)} tokens，"
+                  f"未達 {CACHEABLE_PREFIX_MIN_TOKENS}，服務端不會快取")
 
 def main():
     """主程式"""
@@ -293,15 +1227,40 @@ def main():
         "患者王小明，診斷高血壓，處方Amlodipine"
     ]
     
-    # 批量處理
-    results_df = batch_process_texts(test_texts)
+    # 批量處理（短文本打包成一次請求；詞典已涵蓋的實體不再送出）
+    gazetteer = Gazetteer.load(DEFAULT_GAZETTEER_PATH)
+    results_df = batch_process_texts(test_texts, packed=True, gazetteer=gazetteer, dedup='exact')
     
     # 分析結果
     analyze_results(results_df)
     
-    # 保存結果
+    # 保存結果（CSV 為舊版格式，另輸出欄式的文件表與實體表）
     results_df.to_csv('ner_labeled_data.csv', index=False, encoding='utf-8')
     print(f"\n✅ 結果已保存至 'ner_labeled_data.csv'")
+    try:
+        write_columnar_results(results_df, 'ner_labeled_data')
+        print("✅ 欄式結果已保存至 'ner_labeled_data/'（documents / entities）")
+    except ImportError as e:
+        print(f"⚠️ 略過欄式輸出: {e}")
+    
+    # 建立實體倒排索引，之後查詢實體不需重新載入結果檔
+    index = EntityIndex('ner_labeled_data.index.sqlite3')
+    index.add_results(results_df)
+    print(f"🗂️ 實體索引: {index.stats()}")
+    for text, label, doc_count in index.terms(limit=3):
+        print(f"   {text} ({label}): 文本 {index.documents_with(text, label)}")
+    
+    # 以 API 多次回報且高可信度的結果擴充詞典，下次執行可少送出已知實體；
+    # 只出現一次的實體可能是誤判，詞典自己的命中也不再計入
+    learned = gazetteer.learn_from_table(gazetteer.without_known(explode_entities(results_df)),
+                                         min_confidence=0.9, min_count=2)
+    gazetteer.save(DEFAULT_GAZETTEER_PATH)
+    print(f"📚 詞典新增/更新 {learned} 個詞條（共 {len(gazetteer)} 個）")
+    
+    cache_stats = get_default_cache().stats()
+    print(f"💾 快取命中 {cache_stats['hits']} 次，未命中 {cache_stats['misses']} 次 "
+          f"(命中率 {cache_stats['hit_rate']:.1%})")
+    print_usage_summary()
     
     print("\n🎉 NER 實作範例完成！")
 
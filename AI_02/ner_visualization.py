@@ -8,21 +8,42 @@ NER 視覺化分析工具
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+import hashlib
 import json
-from collections import Counter
+import os
+import sys
 import numpy as np
-from typing import List, Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Union
 import warnings
+
+from entity_stats import EntityStats, compute_entity_stats
+from ner_io import explode_entities, read_entity_table
+from streaming_stats import DEFAULT_CHUNKSIZE, compute_streaming_entity_stats
 warnings.filterwarnings('ignore')
 
+# 圖表方法接受實體表 DataFrame，也相容舊版的實體字典列表
+EntityData = Union[pd.DataFrame, List[Dict[str, Any]]]
+
 # 設定中文字體
 plt.rcParams['font.sans-serif'] = ['Arial Unicode MS', 'SimHei', 'DejaVu Sans']
 plt.rcParams['axes.unicode_minus'] = False
 
+# 記錄各圖表輸入彙總雜湊的檔案（位於輸出目錄下）
+CHART_MANIFEST_FILE = '.chart_manifest.json'
+
 class NERVisualizer:
-    """NER 視覺化分析器"""
+    """
+    NER 視覺化分析器
+    
+    headless=True 時使用 Agg 後端，只存檔不呼叫 plt.show()，適合伺服器排程
+    """
     
-    def __init__(self):
+    def __init__(self, headless: bool = False, dpi: int = 300):
+        self.headless = headless
+        self.dpi = dpi
+        if headless:
+            plt.switch_backend('Agg')
         self.entity_colors = {
             'PERSON': '#FF6B6B',      # 紅色 - 人名
             'LOCATION': '#4ECDC4',    # 青色 - 地名
@@ -33,56 +54,65 @@ class NERVisualizer:
         }
     
     def load_data(self, csv_file: str) -> pd.DataFrame:
-        """載入 NER 分析結果"""
+        """載入 NER 分析結果（續跑或重跑附加的列以每個 text_id 的最後一列為準）"""
         try:
             df = pd.read_csv(csv_file, encoding='utf-8')
-            return df
+            return df.drop_duplicates(subset='text_id', keep='last').reset_index(drop=True)
         except Exception as e:
             print(f"載入資料錯誤: {e}")
             return pd.DataFrame()
     
-    def parse_entities(self, df: pd.DataFrame) -> List[Dict[str, Any]]:
-        """解析實體資料"""
-        all_entities = []
-        
-        for _, row in df.iterrows():
-            if pd.notna(row['entities']) and row['entities'] != '[]':
-                try:
-                    # 嘗試解析 JSON 格式的實體
-                    if isinstance(row['entities'], str):
-                        entities = json.loads(row['entities'])
-                    else:
-                        entities = row['entities']
-                    
-                    for entity in entities:
-                        all_entities.append({
-                            'text': entity.get('text', ''),
-                            'label': entity.get('label', 'UNKNOWN'),
-                            'confidence': entity.get('confidence', 0),
-                            'text_id': row['text_id']
-                        })
-                except Exception as e:
-                    print(f"解析實體錯誤: {e}")
-                    continue
-        
-        return all_entities
+    def parse_entities(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        解析實體資料
+        
+        一次批次解碼整個 entities 欄，回傳欄位為
+        text_id / text / label / confidence 的實體表
+        """
+        return explode_entities(df)
+    
+    def _as_frame(self, entities: EntityData) -> pd.DataFrame:
+        """將實體資料統一為實體表"""
+        if isinstance(entities, pd.DataFrame):
+            return entities
+        return pd.DataFrame(list(entities), columns=['text_id', 'text', 'label', 'confidence'])
+    
+    def _stats_for(self, entities: pd.DataFrame, stats: EntityStats = None) -> EntityStats:
+        """沿用呼叫端傳入的彙總結果，沒有時才計算"""
+        return stats if stats is not None else compute_entity_stats(entities)
+    
+    def _finish(self, fig, save_path: str, title: str):
+        """排版並存檔；互動模式顯示圖表，headless 模式直接釋放"""
+        plt.tight_layout()
+        
+        if save_path:
+            fig.savefig(save_path, dpi=self.dpi, bbox_inches='tight')
+            print(f"{title}已保存至: {save_path}")
+        
+        if self.headless:
+            plt.close(fig)
+        else:
+            plt.show()
     
-    def create_entity_type_distribution(self, entities: List[Dict[str, Any]], save_path: str = None):
+    def create_entity_type_distribution(self, entities: EntityData, save_path: str = None,
+                                        stats: EntityStats = None):
         """創建實體類型分布圖"""
-        if not entities:
+        entities = self._as_frame(entities)
+        if entities.empty:
             print("沒有實體資料可視覺化")
             return
-        
+        self._draw_entity_type_distribution(self._stats_for(entities, stats), save_path)
+    
+    def _draw_entity_type_distribution(self, stats: EntityStats, save_path: str = None):
         # 統計實體類型
-        entity_types = [entity['label'] for entity in entities]
-        type_counts = Counter(entity_types)
+        type_counts = stats.label_counts
         
         # 創建圖表
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 6))
         
         # 圓餅圖
-        labels = list(type_counts.keys())
-        sizes = list(type_counts.values())
+        labels = [str(label) for label in type_counts.index]
+        sizes = type_counts.tolist()
         colors = [self.entity_colors.get(label, self.entity_colors['OTHER']) for label in labels]
         
         ax1.pie(sizes, labels=labels, colors=colors, autopct='%1.1f%%', startangle=90)
@@ -100,79 +130,62 @@ class NERVisualizer:
             ax2.text(bar.get_x() + bar.get_width()/2, bar.get_height() + 0.1,
                     str(size), ha='center', va='bottom')
         
-        plt.tight_layout()
-        
-        if save_path:
-            plt.savefig(save_path, dpi=300, bbox_inches='tight')
-            print(f"實體類型分布圖已保存至: {save_path}")
-        
-        plt.show()
+        self._finish(fig, save_path, "實體類型分布圖")
     
-    def create_confidence_distribution(self, entities: List[Dict[str, Any]], save_path: str = None):
+    def create_confidence_distribution(self, entities: EntityData, save_path: str = None,
+                                       stats: EntityStats = None):
         """創建可信度分布圖"""
-        if not entities:
+        entities = self._as_frame(entities)
+        if entities.empty:
             print("沒有實體資料可視覺化")
             return
-        
-        confidences = [entity['confidence'] for entity in entities]
+        self._draw_confidence_distribution(self._stats_for(entities, stats), save_path)
+    
+    def _draw_confidence_distribution(self, stats: EntityStats, save_path: str = None):
+        # 由彙總結果繪圖：直方圖計數與箱線圖分位數
+        counts, edges = stats.histogram(bins=20)
+        mean = stats.overall['mean']
         
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 6))
         
         # 直方圖
-        ax1.hist(confidences, bins=20, color='skyblue', alpha=0.7, edgecolor='black')
+        ax1.bar(edges[:-1], counts, width=np.diff(edges), align='edge',
+               color='skyblue', alpha=0.7, edgecolor='black')
         ax1.set_title('可信度分布 - 直方圖', fontsize=14, fontweight='bold')
         ax1.set_xlabel('可信度')
         ax1.set_ylabel('頻率')
-        ax1.axvline(np.mean(confidences), color='red', linestyle='--', 
-                   label=f'平均: {np.mean(confidences):.3f}')
+        ax1.axvline(mean, color='red', linestyle='--', 
+                   label=f'平均: {mean:.3f}')
         ax1.legend()
         
         # 箱線圖
-        ax2.boxplot(confidences, patch_artist=True, 
-                   boxprops=dict(facecolor='lightblue', alpha=0.7))
+        ax2.bxp([stats.box_stats()], patch_artist=True, 
+               boxprops=dict(facecolor='lightblue', alpha=0.7))
         ax2.set_title('可信度分布 - 箱線圖', fontsize=14, fontweight='bold')
         ax2.set_ylabel('可信度')
         ax2.grid(True, alpha=0.3)
         
-        plt.tight_layout()
-        
-        if save_path:
-            plt.savefig(save_path, dpi=300, bbox_inches='tight')
-            print(f"可信度分布圖已保存至: {save_path}")
-        
-        plt.show()
+        self._finish(fig, save_path, "可信度分布圖")
     
-    def create_entity_by_type_analysis(self, entities: List[Dict[str, Any]], save_path: str = None):
+    def create_entity_by_type_analysis(self, entities: EntityData, save_path: str = None,
+                                       stats: EntityStats = None):
         """創建各類型實體的詳細分析"""
-        if not entities:
+        entities = self._as_frame(entities)
+        if entities.empty:
             print("沒有實體資料可視覺化")
             return
-        
-        # 按類型分組
-        entity_groups = {}
-        for entity in entities:
-            label = entity['label']
-            if label not in entity_groups:
-                entity_groups[label] = []
-            entity_groups[label].append(entity)
-        
-        # 計算每個類型的統計資訊
-        stats = {}
-        for label, group in entity_groups.items():
-            confidences = [e['confidence'] for e in group]
-            stats[label] = {
-                'count': len(group),
-                'avg_confidence': np.mean(confidences),
-                'min_confidence': np.min(confidences),
-                'max_confidence': np.max(confidences)
-            }
+        self._draw_entity_by_type_analysis(self._stats_for(entities, stats), save_path)
+    
+    def _draw_entity_by_type_analysis(self, entity_stats: EntityStats, save_path: str = None):
+        # 各類型的統計資訊
+        summary = entity_stats.by_label
         
         # 創建圖表
         fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(16, 12))
         
         # 1. 各類型實體數量
-        labels = list(stats.keys())
-        counts = [stats[label]['count'] for label in labels]
+        labels = entity_stats.labels
+        counts = summary['count'].tolist()
         colors = [self.entity_colors.get(label, self.entity_colors['OTHER']) for label in labels]
         
         bars1 = ax1.bar(labels, counts, color=colors)
@@ -185,7 +198,7 @@ class NERVisualizer:
                     str(count), ha='center', va='bottom')
         
         # 2. 各類型平均可信度
-        avg_confidences = [stats[label]['avg_confidence'] for label in labels]
+        avg_confidences = summary['mean'].tolist()
         bars2 = ax2.bar(labels, avg_confidences, color=colors)
         ax2.set_title('各類型平均可信度', fontsize=14, fontweight='bold')
         ax2.set_ylabel('平均可信度')
@@ -197,14 +210,10 @@ class NERVisualizer:
                     f'{conf:.3f}', ha='center', va='bottom')
         
         # 3. 各類型可信度分布（箱線圖）
-        confidence_data = []
-        confidence_labels = []
-        for label, group in entity_groups.items():
-            confidences = [e['confidence'] for e in group]
-            confidence_data.append(confidences)
-            confidence_labels.append(label)
-        
-        box_plot = ax3.boxplot(confidence_data, labels=confidence_labels, patch_artist=True)
+        confidence_labels = labels
+        box_stats = [entity_stats.box_stats(label) for label in labels]
+        
+        box_plot = ax3.bxp(box_stats, patch_artist=True)
         for patch, label in zip(box_plot['boxes'], confidence_labels):
             patch.set_facecolor(self.entity_colors.get(label, self.entity_colors['OTHER']))
             patch.set_alpha(0.7)
@@ -219,13 +228,13 @@ class NERVisualizer:
         ax4.axis('off')
         
         table_data = []
-        for label in labels:
+        for label, row in summary.iterrows():
             table_data.append([
                 label,
-                stats[label]['count'],
-                f"{stats[label]['avg_confidence']:.3f}",
-                f"{stats[label]['min_confidence']:.3f}",
-                f"{stats[label]['max_confidence']:.3f}"
+                int(row['count']),
+                f"{row['mean']:.3f}",
+                f"{row['min']:.3f}",
+                f"{row['max']:.3f}"
             ])
         
         table = ax4.table(cellText=table_data,
@@ -245,24 +254,20 @@ class NERVisualizer:
         
         ax4.set_title('詳細統計表', fontsize=14, fontweight='bold', pad=20)
         
-        plt.tight_layout()
-        
-        if save_path:
-            plt.savefig(save_path, dpi=300, bbox_inches='tight')
-            print(f"各類型實體分析圖已保存至: {save_path}")
-        
-        plt.show()
+        self._finish(fig, save_path, "各類型實體分析圖")
     
-    def create_top_entities(self, entities: List[Dict[str, Any]], top_n: int = 10, save_path: str = None):
+    def create_top_entities(self, entities: EntityData, top_n: int = 10, save_path: str = None,
+                            stats: EntityStats = None):
         """創建最常見實體排行榜"""
-        if not entities:
+        entities = self._as_frame(entities)
+        if entities.empty:
             print("沒有實體資料可視覺化")
             return
-        
+        self._draw_top_entities(self._stats_for(entities, stats), save_path, top_n)
+    
+    def _draw_top_entities(self, stats: EntityStats, save_path: str = None, top_n: int = 10):
         # 統計最常見的實體
-        entity_texts = [entity['text'] for entity in entities]
-        text_counts = Counter(entity_texts)
-        top_entities = text_counts.most_common(top_n)
+        top_entities = list(stats.top(top_n).items())
         
         if not top_entities:
             print("沒有找到實體")
@@ -274,17 +279,9 @@ class NERVisualizer:
         texts = [item[0] for item in top_entities]
         counts = [item[1] for item in top_entities]
         
-        # 根據實體類型設定顏色
-        colors = []
-        for text in texts:
-            # 找到對應的實體類型
-            entity_type = None
-            for entity in entities:
-                if entity['text'] == text:
-                    entity_type = entity['label']
-                    break
-            color = self.entity_colors.get(entity_type, self.entity_colors['OTHER'])
-            colors.append(color)
+        # 根據實體文字的多數類型設定顏色
+        colors = [self.entity_colors.get(stats.text_index.majority_label(text), self.entity_colors['OTHER'])
+                  for text in texts]
         
         bars = ax.barh(texts, counts, color=colors, alpha=0.7)
         ax.set_title(f'最常見實體排行榜 (前 {top_n} 名)', fontsize=14, fontweight='bold')
@@ -295,74 +292,138 @@ class NERVisualizer:
             ax.text(bar.get_width() + 0.1, bar.get_y() + bar.get_height()/2,
                    str(count), ha='left', va='center')
         
-        plt.tight_layout()
-        
-        if save_path:
-            plt.savefig(save_path, dpi=300, bbox_inches='tight')
-            print(f"最常見實體排行榜已保存至: {save_path}")
-        
-        plt.show()
+        self._finish(fig, save_path, "最常見實體排行榜")
+    
+    def _chart_jobs(self, stats: EntityStats, output_dir: str) -> List[Dict[str, Any]]:
+        """完整分析的各張圖表：繪圖方法、輸出路徑與其輸入彙總的雜湊"""
+        top_n = 15
+        top = stats.top(top_n)
+        charts = [
+            ("📈 生成實體類型分布圖...", 'entity_type_distribution.png',
+             '_draw_entity_type_distribution', {}, [stats.label_counts]),
+            ("📊 生成可信度分布圖...", 'confidence_distribution.png',
+             '_draw_confidence_distribution', {},
+             list(stats.histogram(bins=20)) + [stats.overall['mean'], _box_values(stats.box_stats())]),
+            ("🔍 生成各類型詳細分析...", 'entity_by_type_analysis.png',
+             '_draw_entity_by_type_analysis', {},
+             [stats.by_label] + [_box_values(stats.box_stats(label)) for label in stats.labels]),
+            ("🏆 生成最常見實體排行榜...", 'top_entities.png',
+             '_draw_top_entities', {'top_n': top_n},
+             [top, [stats.text_index.majority_label(text) for text in top.index]])
+        ]
+        return [
+            {'message': message, 'file': file_name, 'method': method, 'kwargs': kwargs,
+             'save_path': os.path.join(output_dir, file_name),
+             'fingerprint': chart_fingerprint(inputs, method=method, dpi=self.dpi,
+                                              colors=self.entity_colors, **kwargs)}
+            for message, file_name, method, kwargs, inputs in charts
+        ]
     
-    def create_comprehensive_analysis(self, csv_file: str, output_dir: str = "ner_analysis"):
-        """創建完整的視覺化分析"""
-        import os
+    def render_charts(self, stats: EntityStats, output_dir: str, max_workers: int = None,
+                      skip_unchanged: bool = None) -> List[str]:
+        """
+        繪製完整分析的所有圖表，回傳實際重新繪製的檔案
+        
+        headless 模式下以行程池平行繪製；skip_unchanged 時比對輸出目錄中
+        記錄的輸入雜湊，輸入未變且圖檔仍在的圖表直接略過。
+        skip_unchanged 未指定時只在 headless 模式略過：互動模式每次都要顯示圖表
+        """
+        if skip_unchanged is None:
+            skip_unchanged = self.headless
+        manifest_path = os.path.join(output_dir, CHART_MANIFEST_FILE)
+        manifest = load_chart_manifest(manifest_path) if skip_unchanged else {}
+        
+        pending = []
+        for job in self._chart_jobs(stats, output_dir):
+            if manifest.get(job['file']) == job['fingerprint'] and os.path.exists(job['save_path']):
+                print(f"⏭️  {job['file']} 輸入未變更，略過")
+            else:
+                pending.append(job)
+        
+        if self.headless and len(pending) > 1:
+            workers = min(len(pending), max_workers or os.cpu_count() or 1)
+            print(f"\n🖼️  以 {workers} 個行程平行繪製 {len(pending)} 張圖表...")
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_headless_worker) as pool:
+                futures = [pool.submit(_render_chart, job['method'], stats, job['save_path'],
+                                       job['kwargs'], self.dpi) for job in pending]
+                for future in futures:
+                    future.result()
+        else:
+            for job in pending:
+                print(job['message'])
+                getattr(self, job['method'])(stats, job['save_path'], **job['kwargs'])
+        
+        for job in pending:
+            manifest[job['file']] = job['fingerprint']
+        save_chart_manifest(manifest_path, manifest)
+        return [job['save_path'] for job in pending]
+    
+    def create_comprehensive_analysis(self, csv_file: str, output_dir: str = "ner_analysis",
+                                      max_workers: int = None, skip_unchanged: bool = None,
+                                      streaming: bool = False, chunksize: int = DEFAULT_CHUNKSIZE):
+        """
+        創建完整的視覺化分析（csv_file 可為 CSV 檔或欄式結果目錄）
+        
+        streaming=True 時分段讀取結果檔並以線上累加器彙總，
+        圖表與報告只使用彙總結果，記憶體用量不隨結果檔大小成長
+        """
         
         # 創建輸出目錄
         os.makedirs(output_dir, exist_ok=True)
         
-        print("🔍 載入資料...")
-        df = self.load_data(csv_file)
-        if df.empty:
-            print("❌ 無法載入資料")
+        if streaming:
+            print(f"🔍 分段彙總資料（每段 {chunksize} 列）...")
+            stats = compute_streaming_entity_stats(csv_file, chunksize=chunksize)
+            if stats.total == 0:
+                print("❌ 沒有找到實體資料")
+                return
+            print(f"✅ 找到 {stats.total} 個實體")
+            print()
+            self.render_charts(stats, output_dir, max_workers=max_workers, skip_unchanged=skip_unchanged)
+            self._write_report(stats, f"{output_dir}/statistics_report.txt")
+            print(f"\n🎉 所有分析圖表已保存至 '{output_dir}' 目錄")
             return
         
-        print("📊 解析實體...")
-        entities = self.parse_entities(df)
-        if not entities:
+        print("🔍 載入資料...")
+        if os.path.isdir(csv_file):
+            # 欄式結果目錄：直接讀取實體表，不需逐列解析 JSON
+            entities = read_entity_table(csv_file)
+        else:
+            df = self.load_data(csv_file)
+            if df.empty:
+                print("❌ 無法載入資料")
+                return
+            
+            print("📊 解析實體...")
+            entities = self.parse_entities(df)
+        if entities.empty:
             print("❌ 沒有找到實體資料")
             return
         
         print(f"✅ 找到 {len(entities)} 個實體")
         
-        # 生成各種圖表
-        print("\n📈 生成實體類型分布圖...")
-        self.create_entity_type_distribution(entities, f"{output_dir}/entity_type_distribution.png")
-        
-        print("📊 生成可信度分布圖...")
-        self.create_confidence_distribution(entities, f"{output_dir}/confidence_distribution.png")
-        
-        print("🔍 生成各類型詳細分析...")
-        self.create_entity_by_type_analysis(entities, f"{output_dir}/entity_by_type_analysis.png")
+        # 一次彙總，所有圖表與報告共用
+        stats = compute_entity_stats(entities)
         
-        print("🏆 生成最常見實體排行榜...")
-        self.create_top_entities(entities, top_n=15, save_path=f"{output_dir}/top_entities.png")
+        # 生成各種圖表
+        print()
+        self.render_charts(stats, output_dir, max_workers=max_workers, skip_unchanged=skip_unchanged)
         
         # 生成統計報告
-        self.generate_statistics_report(entities, f"{output_dir}/statistics_report.txt")
+        self.generate_statistics_report(entities, f"{output_dir}/statistics_report.txt", stats)
         
         print(f"\n🎉 所有分析圖表已保存至 '{output_dir}' 目錄")
     
-    def generate_statistics_report(self, entities: List[Dict[str, Any]], save_path: str):
+    def generate_statistics_report(self, entities: EntityData, save_path: str,
+                                   stats: EntityStats = None):
         """生成統計報告"""
-        if not entities:
+        entities = self._as_frame(entities)
+        if entities.empty:
             return
-        
-        # 統計分析
-        entity_types = [entity['label'] for entity in entities]
-        type_counts = Counter(entity_types)
-        confidences = [entity['confidence'] for entity in entities]
-        
-        # 按類型分組統計
-        type_stats = {}
-        for label in type_counts.keys():
-            type_entities = [e for e in entities if e['label'] == label]
-            type_confidences = [e['confidence'] for e in type_entities]
-            type_stats[label] = {
-                'count': len(type_entities),
-                'avg_confidence': np.mean(type_confidences),
-                'min_confidence': np.min(type_confidences),
-                'max_confidence': np.max(type_confidences)
-            }
+        self._write_report(self._stats_for(entities, stats), save_path)
+    
+    def _write_report(self, stats: EntityStats, save_path: str):
+        overall = stats.overall
         
         # 生成報告
         report = f"""
@@ -371,28 +432,28 @@ NER 分析統計報告
 
 總體統計
 --------
-總實體數: {len(entities)}
-平均可信度: {np.mean(confidences):.3f}
-最高可信度: {np.max(confidences):.3f}
-最低可信度: {np.min(confidences):.3f}
+總實體數: {stats.total}
+平均可信度: {overall['mean']:.3f}
+最高可信度: {overall['max']:.3f}
+最低可信度: {overall['min']:.3f}
 
 各類型統計
 ----------
 """
         
-        for label, stats in type_stats.items():
+        for label, row in stats.by_label.iterrows():
             report += f"""
 {label}:
-  數量: {stats['count']}
-  平均可信度: {stats['avg_confidence']:.3f}
-  最高可信度: {stats['max_confidence']:.3f}
-  最低可信度: {stats['min_confidence']:.3f}
+  數量: {int(row['count'])}
+  平均可信度: {row['mean']:.3f}
+  最高可信度: {row['max']:.3f}
+  最低可信度: {row['min']:.3f}
 """
+            if 'q50' in row:
+                report += f"  中位數可信度: {row['q50']:.3f}\n"
         
         # 最常見實體
-        entity_texts = [entity['text'] for entity in entities]
-        text_counts = Counter(entity_texts)
-        top_entities = text_counts.most_common(10)
+        top_entities = list(stats.top(10).items())
         
         report += f"""
 
@@ -408,22 +469,73 @@ NER 分析統計報告
         
         print(f"統計報告已保存至: {save_path}")
 
+def chart_fingerprint(inputs: List[Any], **params) -> str:
+    """計算圖表輸入彙總（Series / DataFrame / 陣列 / 一般值）與繪圖參數的雜湊"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(params, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    for part in inputs:
+        if isinstance(part, pd.DataFrame):
+            digest.update(json.dumps([str(c) for c in part.columns]).encode('utf-8'))
+            digest.update(pd.util.hash_pandas_object(part, index=True).to_numpy().tobytes())
+        elif isinstance(part, pd.Series):
+            digest.update(pd.util.hash_pandas_object(part, index=True).to_numpy().tobytes())
+        elif isinstance(part, np.ndarray):
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(json.dumps(part, ensure_ascii=False, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+def _box_values(box_stats: Dict[str, Any]) -> List[float]:
+    """箱線圖數值中參與雜湊的部分"""
+    return [float(box_stats[key]) for key in ('q1', 'med', 'q3', 'whislo', 'whishi')] + \
+        [float(value) for value in box_stats['fliers']]
+
+def load_chart_manifest(path: str) -> Dict[str, str]:
+    """讀取圖表雜湊紀錄；不存在或損毀時視為空"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+def save_chart_manifest(path: str, manifest: Dict[str, str]):
+    """寫入圖表雜湊紀錄（先寫暫存檔再取代，避免中斷時留下半份檔案）"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def _init_headless_worker():
+    """行程池 worker 的初始化：改用不需顯示裝置的 Agg 後端"""
+    plt.switch_backend('Agg')
+
+def _render_chart(method: str, stats: EntityStats, save_path: str,
+                  kwargs: Dict[str, Any], dpi: int) -> str:
+    """在 worker 行程中繪製單張圖表"""
+    getattr(NERVisualizer(headless=True, dpi=dpi), method)(stats, save_path, **kwargs)
+    return save_path
+
 def main():
     """主程式"""
     print("🚀 NER 視覺化分析工具")
     print("=" * 50)
     
-    visualizer = NERVisualizer()
+    # --headless：不開視窗，平行繪圖並略過輸入未變更的圖表
+    # --streaming：分段彙總超大結果檔
+    visualizer = NERVisualizer(headless='--headless' in sys.argv)
     
-    # 檢查是否有 CSV 檔案
+    # 優先使用欄式結果目錄，其次為 CSV 檔案
     csv_file = 'ner_labeled_data.csv'
-    if not pd.io.common.file_exists(csv_file):
+    if os.path.isdir('ner_labeled_data'):
+        csv_file = 'ner_labeled_data'
+    elif not pd.io.common.file_exists(csv_file):
         print(f"❌ 找不到 {csv_file} 檔案")
         print("請先執行 NER 分析程式生成資料")
         return
     
     # 執行完整分析
-    visualizer.create_comprehensive_analysis(csv_file)
+    visualizer.create_comprehensive_analysis(csv_file, streaming='--streaming' in sys.argv)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+提示詞模板
+將提示詞拆成固定的系統指令前綴與每次變動的使用者後綴，
+讓每次請求的開頭完全相同，服務端的自動前綴快取才能命中
+"""
+
+import hashlib
+import json
+from typing import Any, Dict, List
+
+from token_utils import MESSAGE_OVERHEAD_TOKENS, count_tokens
+
+# 服務端只快取長度達此 token 數的前綴
+CACHEABLE_PREFIX_MIN_TOKENS = 1024
+
+class PromptTemplate:
+    """
+    固定前綴 + 變動後綴的提示詞模板
+
+    system 為固定的指令（不可含變數），user 為以 str.format 填入變數的後綴；
+    response_format 的 schema 同樣屬於固定前綴，與模板一起管理
+    """
+
+    def __init__(self, name: str, system: str, user: str,
+                 response_format: Dict[str, Any] = None):
+        self.name = name
+        self.system = system.strip()
+        self.user = user.strip()
+        self.response_format = response_format
+        self._prefix_tokens: Dict[str, int] = {}
+
+    def messages(self, **variables) -> List[Dict[str, str]]:
+        """建立 chat messages：固定前綴在前，變動內容在後"""
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.user.format(**variables)}
+        ]
+
+    def request_options(self) -> Dict[str, Any]:
+        """chat completion 請求的額外參數"""
+        return {"response_format": self.response_format} if self.response_format else {}
+
+    @property
+    def identity(self) -> str:
+        """模板內容（供快取鍵使用，模板或 schema 修改後舊的快取結果自動失效）"""
+        identity = self.system + "\n\n" + self.user
+        if self.response_format:
+            identity += "\n\n" + json.dumps(self.response_format, ensure_ascii=False, sort_keys=True)
+        return identity
+
+    @property
+    def fingerprint(self) -> str:
+        return hashlib.sha256(self.identity.encode('utf-8')).hexdigest()[:12]
+
+    def prefix_tokens(self, model: str = None) -> int:
+        """固定前綴的 token 數"""
+        if model not in self._prefix_tokens:
+            self._prefix_tokens[model] = count_tokens(self.system, model) + MESSAGE_OVERHEAD_TOKENS
+        return self._prefix_tokens[model]
+
+    def is_cacheable(self, model: str = None) -> bool:
+        """固定前綴是否長到足以被服務端快取"""
+        return self.prefix_tokens(model) >= CACHEABLE_PREFIX_MIN_TOKENS
+
+    def __repr__(self) -> str:
+        return f"PromptTemplate({self.name!r}, fingerprint={self.fingerprint})"
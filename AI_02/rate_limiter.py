@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OpenAI 速率限制器
+以每分鐘請求數（RPM）與每分鐘 token 數（TPM）兩個令牌桶控制送出速度，
+並依回應中的 x-ratelimit-* 標頭校正剩餘額度
+"""
+
+import asyncio
+import os
+import re
+import threading
+import time
+from typing import Mapping, Optional
+
+# 解析 "6m0s"、"1.5s"、"20ms" 這類重置時間
+_DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+
+def parse_reset_duration(value: str) -> Optional[float]:
+    """將 x-ratelimit-reset-* 標頭值轉換為秒數"""
+    if not value:
+        return None
+    matches = _DURATION_PATTERN.findall(value)
+    if not matches:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+class TokenBucket:
+    """
+    以固定速率補充的令牌桶
+
+    share 為此令牌桶分得的額度比例：多個行程共用同一把 API Key 時，
+    伺服器回報的是整把 Key 的額度，校正時需先乘上 share
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float, share: float = 1.0):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.share = share
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_second)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """取得足夠令牌前需要等待的秒數"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount: float):
+        """扣除令牌（允許透支，之後會以補充速率還清）"""
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount: float):
+        """歸還多扣的令牌；amount 為負值時代表補扣"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def sync(self, limit: Optional[float], remaining: Optional[float], reset_seconds: Optional[float]):
+        """依伺服器回報的額度（整把 Key）校正令牌桶"""
+        self._refill()
+        if limit:
+            limit *= self.share
+            self.capacity = float(limit)
+            self.refill_per_second = self.capacity / 60.0
+        if remaining is not None:
+            remaining *= self.share
+            # 伺服器的剩餘額度不含尚在途中的請求，只往下校正以保持保守
+            self.tokens = min(self.tokens, float(remaining))
+            # 重置時間代表補滿所需秒數，據此取較保守的補充速率
+            if reset_seconds and remaining < self.capacity:
+                self.refill_per_second = min(self.refill_per_second,
+                                             (self.capacity - remaining) / reset_seconds)
+
+class RateLimiter:
+    """
+    RPM / TPM 雙令牌桶速率限制器（執行緒與協程安全）
+
+    share < 1 時代表只分得 API Key 額度的一部分（requests_per_minute /
+    tokens_per_minute 應已按比例縮小），回應標頭的額度也按同一比例換算
+    """
+
+    def __init__(self, requests_per_minute: int = 500, tokens_per_minute: int = 200000,
+                 share: float = 1.0):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0, share)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0, share)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'RateLimiter':
+        """從 OPENAI_RPM / OPENAI_TPM 環境變數建立限制器"""
+        return cls(
+            requests_per_minute=int(os.getenv('OPENAI_RPM', '500')),
+            tokens_per_minute=int(os.getenv('OPENAI_TPM', '200000'))
+        )
+
+    def _try_acquire(self, estimated_tokens: int) -> float:
+        """嘗試取得額度；成功回傳 0，否則回傳建議等待秒數"""
+        with self._lock:
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+            if wait <= 0:
+                self.requests.consume(1)
+                self.tokens.consume(estimated_tokens)
+            return wait
+
+    def acquire(self, estimated_tokens: int):
+        """阻塞直到可以送出一個預估 estimated_tokens 的請求"""
+        while True:
+            wait = self._try_acquire(estimated_tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, estimated_tokens: int):
+        """非同步版本的 acquire"""
+        while True:
+            wait = self._try_acquire(estimated_tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """以實際用量校正預扣的 token 數"""
+        if actual_tokens is None:
+            return
+        with self._lock:
+            self.tokens.refund(estimated_tokens - actual_tokens)
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        """依 x-ratelimit-* 回應標頭校正兩個令牌桶"""
+        def number(name):
+            value = headers.get(name)
+            try:
+                return float(value) if value is not None else None
+            except ValueError:
+                return None
+
+        with self._lock:
+            self.requests.sync(
+                number('x-ratelimit-limit-requests'),
+                number('x-ratelimit-remaining-requests'),
+                parse_reset_duration(headers.get('x-ratelimit-reset-requests'))
+            )
+            self.tokens.sync(
+                number('x-ratelimit-limit-tokens'),
+                number('x-ratelimit-remaining-tokens'),
+                parse_reset_duration(headers.get('x-ratelimit-reset-tokens'))
+            )
+
+_default_limiter: Optional[RateLimiter] = None
+_default_lock = threading.Lock()
+
+def get_default_limiter() -> RateLimiter:
+    """取得行程共用的速率限制器（同一把 API Key 共用同一份額度）"""
+    global _default_limiter
+    with _default_lock:
+        if _default_limiter is None:
+            _default_limiter = RateLimiter.from_env()
+        return _default_limiter
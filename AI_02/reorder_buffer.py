@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+重排緩衝區
+結果以完成順序到達，依輸入位置（0, 1, 2, ...）重新排序後釋出；
+搭配 admits() 限制處理最多只能領先尚未釋出的位置 window 個，
+讓暫存的亂序結果維持在固定數量內
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+class ReorderBuffer:
+    """
+    依輸入位置釋出亂序完成的結果（非執行緒安全，由單一事件迴圈或執行緒使用）
+
+    window 為 None 時不限制領先距離
+    """
+
+    def __init__(self, window: Optional[int] = None):
+        if window is not None and window < 1:
+            raise ValueError("window 必須 >= 1")
+        self.window = window
+        self.next_index = 0
+        self._pending: Dict[int, Any] = {}
+
+    def __len__(self) -> int:
+        """目前暫存（已完成但尚未輪到釋出）的結果數"""
+        return len(self._pending)
+
+    def admits(self, index: int) -> bool:
+        """位置 index 是否在視窗內，可以開始處理"""
+        return self.window is None or index < self.next_index + self.window
+
+    def push(self, index: int, item: Any) -> List[Tuple[int, Any]]:
+        """放入位置 index 的結果，回傳因此可依序釋出的 (位置, 結果) 列表"""
+        if index < self.next_index or index in self._pending:
+            raise ValueError(f"位置 {index} 的結果重複放入")
+        self._pending[index] = item
+        released = []
+        while self.next_index in self._pending:
+            released.append((self.next_index, self._pending.pop(self.next_index)))
+            self.next_index += 1
+        return released
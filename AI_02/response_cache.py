@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM 回應快取
+以 SQLite 儲存，鍵值為「正規化文本 + 模型 + 提示詞模板 + 溫度」的雜湊，
+支援 TTL 與筆數上限淘汰，並統計命中率
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, Dict, Optional
+
+DEFAULT_CACHE_PATH = 'llm_cache.sqlite3'
+DEFAULT_TTL_SECONDS = 30 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 1_000_000
+# 多個行程共用同一個快取檔時，等待其他行程釋放寫入鎖的秒數
+DEFAULT_BUSY_TIMEOUT = 30.0
+
+# 每寫入多少筆執行一次淘汰
+_EVICT_EVERY = 1000
+# 命中時更新存取時間的最小間隔（秒）
+_TOUCH_INTERVAL = 3600
+
+def normalize_text(text: str) -> str:
+    """正規化文本：NFKC（全半形統一）並合併空白"""
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+def make_cache_key(text: str, model: str, prompt_template: str, temperature: float) -> str:
+    """產生內容定址的快取鍵"""
+    payload = json.dumps(
+        [normalize_text(text), model, prompt_template, round(float(temperature), 4)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """
+    SQLite 回應快取（執行緒安全）
+
+    以 WAL 模式開啟，讀取不會被寫入阻擋；多個行程（例如分片 worker）共用同一個
+    快取檔時，寫入衝突最多等待 busy_timeout 秒，不會立即出現 database is locked
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 max_entries: int = DEFAULT_MAX_ENTRIES, busy_timeout: float = DEFAULT_BUSY_TIMEOUT):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_accessed ON responses(accessed_at)')
+        self._conn.commit()
+
+    @classmethod
+    def from_env(cls) -> 'ResponseCache':
+        """
+        從環境變數建立快取
+
+        LLM_CACHE_PATH / LLM_CACHE_TTL / LLM_CACHE_MAX_ENTRIES / LLM_CACHE_BUSY_TIMEOUT
+        """
+        return cls(
+            path=os.getenv('LLM_CACHE_PATH', DEFAULT_CACHE_PATH),
+            ttl_seconds=float(os.getenv('LLM_CACHE_TTL', DEFAULT_TTL_SECONDS)),
+            max_entries=int(os.getenv('LLM_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+            busy_timeout=float(os.getenv('LLM_CACHE_BUSY_TIMEOUT', DEFAULT_BUSY_TIMEOUT))
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        """讀取快取；未命中或已過期時回傳 None"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, created_at, accessed_at FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            # 存取時間只需粗略精度，避免每次命中都寫入
+            if now - row[2] > _TOUCH_INTERVAL:
+                self._conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+                self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        """寫入快取"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), now, now)
+            )
+            self._conn.commit()
+            self._writes += 1
+            if self._writes % _EVICT_EVERY == 0:
+                self._evict_locked()
+
+    def evict(self):
+        """刪除過期項目，並依最近存取時間淘汰超出上限的項目"""
+        with self._lock:
+            self._evict_locked()
+
+    def _evict_locked(self):
+        self._conn.execute('DELETE FROM responses WHERE created_at < ?',
+                           (time.time() - self.ttl_seconds,))
+        count = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                'DELETE FROM responses WHERE key IN '
+                '(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)',
+                (count - self.max_entries,)
+            )
+        self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """回傳命中統計"""
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_default_cache: Optional[ResponseCache] = None
+_default_lock = threading.Lock()
+
+def get_default_cache() -> ResponseCache:
+    """取得行程共用的回應快取"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache.from_env()
+        return _default_cache
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+API 錯誤重試
+遇到 429、5xx、逾時與連線錯誤時以帶隨機抖動的指數退避重試，
+伺服器回傳 Retry-After 時至少等待該時間；其餘錯誤（如 400、401、額度用罄）直接拋出
+"""
+
+import asyncio
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from openai import APIConnectionError
+
+# 可重試的 HTTP 狀態碼（5xx 另外判斷）
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+def is_retryable(error: BaseException) -> bool:
+    """是否為暫時性錯誤（逾時、連線中斷、429、5xx）"""
+    if isinstance(error, APIConnectionError):
+        return True
+    # 帳戶額度用罄同樣回傳 429，但重試不會成功
+    if getattr(error, 'code', None) == 'insufficient_quota':
+        return False
+    status = getattr(error, 'status_code', None)
+    return isinstance(status, int) and (status in RETRYABLE_STATUS_CODES or status >= 500)
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """從錯誤回應的 retry-after-ms / retry-after 標頭取出建議等待秒數"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers['retry-after-ms']) / 1000.0
+        if headers.get('retry-after') is not None:
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        return None
+    return None
+
+class RetryPolicy:
+    """
+    帶隨機抖動的指數退避
+
+    第 n 次重試前等待 [0, min(max_delay, base_delay × 2^n)] 之間的隨機秒數
+    （full jitter），避免多個並行請求同時重試再次撞上速率限制
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 30.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def from_env(cls) -> 'RetryPolicy':
+        """從 OPENAI_RETRY_ATTEMPTS / OPENAI_RETRY_BASE_DELAY / OPENAI_RETRY_MAX_DELAY 建立"""
+        return cls(
+            max_attempts=int(os.getenv('OPENAI_RETRY_ATTEMPTS', '5')),
+            base_delay=float(os.getenv('OPENAI_RETRY_BASE_DELAY', '0.5')),
+            max_delay=float(os.getenv('OPENAI_RETRY_MAX_DELAY', '30'))
+        )
+
+    def backoff(self, attempt: int, error: BaseException = None) -> float:
+        """第 attempt 次重試（從 0 起算）前的等待秒數"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = retry_after_seconds(error) if error is not None else None
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def _next_delay(self, attempt: int, error: Exception) -> float:
+        """可重試時回傳等待秒數，否則重新拋出錯誤"""
+        if not is_retryable(error) or attempt == self.max_attempts - 1:
+            raise error
+        delay = self.backoff(attempt, error)
+        print(f"⏳ API 暫時性錯誤（{error.__class__.__name__}），{delay:.1f} 秒後重試 "
+              f"({attempt + 1}/{self.max_attempts - 1})")
+        return delay
+
+    def call(self, fn: Callable[[], Any]) -> Any:
+        """執行 fn，暫時性錯誤時退避後重試"""
+        for attempt in range(self.max_attempts):
+            try:
+                return fn()
+            except Exception as e:
+                delay = self._next_delay(attempt, e)
+            time.sleep(delay)
+
+    async def call_async(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """非同步版本的 call"""
+        for attempt in range(self.max_attempts):
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self._next_delay(attempt, e)
+            await asyncio.sleep(delay)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多行程分片執行
+主行程讀取一次語料，依 text_id 的雜湊寫成各分片的輸入檔，再交給多個 worker 行程，每個 worker 使用 API Key 池中的
+一把 Key（或組織）並只分得該 Key 的一部分額度；各分片的結果最後合併成
+與 batch_process_texts 相同格式的結果檔，吞吐量隨 Key 數 × 核心數擴展
+"""
+
+import csv
+import heapq
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+import pandas as pd
+
+from ner_io import RESULT_COLUMNS, partition_texts
+
+DEFAULT_WORK_DIR = 'shards'
+
+class ApiKeySlot:
+    """API Key 池中的一把 Key 及其額度"""
+
+    def __init__(self, api_key: str, organization: str = None,
+                 requests_per_minute: int = 500, tokens_per_minute: int = 200000,
+                 name: str = None):
+        self.api_key = api_key
+        self.organization = organization
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # 顯示用名稱，不輸出完整的 Key
+        self.name = name or f"...{api_key[-4:]}" + (f"@{organization}" if organization else '')
+
+    def __repr__(self) -> str:
+        return (f"ApiKeySlot({self.name}, rpm={self.requests_per_minute}, "
+                f"tpm={self.tokens_per_minute})")
+
+class ApiKeyPool:
+    """
+    API Key 池
+
+    worker 依序輪流分配到各把 Key；同一把 Key 分給多個 worker 時，
+    每個 worker 的速率限制器只分得該 Key 額度的相應比例
+    """
+
+    def __init__(self, slots: Sequence[ApiKeySlot]):
+        if not slots:
+            raise ValueError("API Key 池中沒有任何 Key")
+        self.slots = list(slots)
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    @classmethod
+    def load(cls, path: str) -> 'ApiKeyPool':
+        """
+        從 JSON 檔讀取 Key 池
+
+        格式為列表，每項含 api_key，可選 organization / rpm / tpm / name
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        default_rpm = int(os.getenv('OPENAI_RPM', '500'))
+        default_tpm = int(os.getenv('OPENAI_TPM', '200000'))
+        return cls([
+            ApiKeySlot(entry['api_key'], entry.get('organization'),
+                       int(entry.get('rpm', default_rpm)), int(entry.get('tpm', default_tpm)),
+                       entry.get('name'))
+            for entry in entries
+        ])
+
+    @classmethod
+    def from_env(cls) -> 'ApiKeyPool':
+        """
+        從環境變數建立 Key 池
+
+        優先讀取 OPENAI_KEY_POOL_FILE 指定的 JSON 檔，其次是以逗號分隔的
+        OPENAI_API_KEYS（每項為 key 或 key:組織），最後退回單一 OPENAI_API_KEY；
+        每把 Key 的額度預設為 OPENAI_RPM / OPENAI_TPM
+        """
+        pool_file = os.getenv('OPENAI_KEY_POOL_FILE')
+        if pool_file:
+            return cls.load(pool_file)
+
+        rpm = int(os.getenv('OPENAI_RPM', '500'))
+        tpm = int(os.getenv('OPENAI_TPM', '200000'))
+        entries = [entry.strip() for entry in os.getenv('OPENAI_API_KEYS', '').split(',') if entry.strip()]
+        if not entries and os.getenv('OPENAI_API_KEY'):
+            entries = [os.getenv('OPENAI_API_KEY')]
+
+        slots = []
+        for entry in entries:
+            api_key, _, organization = entry.partition(':')
+            slots.append(ApiKeySlot(api_key, organization or None, rpm, tpm))
+        return cls(slots)
+
+    def assign(self, num_workers: int) -> List[Dict[str, Any]]:
+        """
+        為每個 worker 分配 Key 與額度，回傳 worker 設定列表
+
+        worker i 使用第 i % len(pool) 把 Key，額度依該 Key 的 worker 數平分
+        """
+        counts = [0] * len(self.slots)
+        for worker in range(num_workers):
+            counts[worker % len(self.slots)] += 1
+
+        assignments = []
+        for worker in range(num_workers):
+            slot_index = worker % len(self.slots)
+            slot, share = self.slots[slot_index], counts[slot_index]
+            assignments.append({
+                'api_key': slot.api_key,
+                'organization': slot.organization,
+                'key_name': slot.name,
+                'requests_per_minute': max(1, slot.requests_per_minute // share),
+                'tokens_per_minute': max(1, slot.tokens_per_minute // share),
+                'share': 1.0 / share
+            })
+        return assignments
+
+def shard_output_path(work_dir: str, shard_index: int, num_shards: int) -> str:
+    return os.path.join(work_dir, f"shard-{shard_index:03d}-of-{num_shards:03d}.csv")
+
+def shard_input_path(work_dir: str, shard_index: int, num_shards: int) -> str:
+    return os.path.join(work_dir, f"shard-{shard_index:03d}-of-{num_shards:03d}.input.jsonl")
+
+def partition_input(input_path: str, input_paths: Sequence[str]) -> bool:
+    """
+    將輸入檔切成各分片的輸入檔，回傳是否重新切分
+
+    分片輸入檔都已存在且不舊於輸入檔時沿用（續跑時不必重新解析整個語料）
+    """
+    source_mtime = os.path.getmtime(input_path)
+    if all(os.path.exists(path) and os.path.getmtime(path) >= source_mtime for path in input_paths):
+        return False
+    counts = partition_texts(input_path, list(input_paths))
+    print(f"✂️ 已將 {sum(counts)} 個文本切成 {len(input_paths)} 個分片（每片 {min(counts)}～{max(counts)} 個）")
+    return True
+
+def _run_shard(input_path: str, output_path: str, shard_index: int, num_shards: int,
+               assignment: Dict[str, Any], options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    在 worker 行程中處理單一分片（以分片的進度日誌支援續跑）
+
+    input_path 為主行程切好的分片輸入檔，worker 只解析屬於自己的文本；
+    各 worker 共用同一個回應快取檔（WAL 模式，寫入衝突時等待 busy_timeout），
+    不同分片的相同文本也能命中快取
+    """
+    from gazetteer import Gazetteer
+    from ner_simple import SimpleNER, stream_process_texts
+    from rate_limiter import RateLimiter
+
+    # 回應標頭回報的是整把 Key 的額度，依分得的比例換算，避免各 worker 都以全額送出
+    limiter = RateLimiter(assignment['requests_per_minute'], assignment['tokens_per_minute'],
+                          share=assignment['share'])
+    gazetteer_path = options.get('gazetteer_path')
+    ner = SimpleNER(
+        rate_limiter=limiter,
+        gazetteer=Gazetteer.load(gazetteer_path) if gazetteer_path else None,
+        api_key=assignment['api_key'],
+        organization=assignment['organization']
+    )
+
+    started = time.monotonic()
+    written = stream_process_texts(
+        input_path, output_path,
+        chunk_size=options['chunk_size'],
+        max_concurrency=options['max_concurrency'],
+        packed=options['packed'],
+        max_pack_tokens=options['max_pack_tokens'],
+        resume=options['resume'],
+        dedup=options['dedup'],
+        ner=ner
+    )
+    return {
+        'shard': shard_index,
+        'key': assignment['key_name'],
+        'rows': written,
+        'seconds': time.monotonic() - started,
+        'usage': ner.usage_tracker.stats()
+    }
+
+def _sorted_shard_rows(path: str, sorted_path: str, chunksize: int):
+    """將分片結果依 text_id 排序並去重（重跑的文本以最後一列為準），寫成暫存檔後逐列讀出"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    df = pd.read_csv(path, encoding='utf-8', dtype={'text_id': 'int64'})
+    df = (df.drop_duplicates(subset='text_id', keep='last')
+            .sort_values('text_id')
+            .reindex(columns=RESULT_COLUMNS))
+    df.to_csv(sorted_path, index=False, encoding='utf-8', chunksize=chunksize)
+    del df
+
+    with open(sorted_path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            yield int(row[0]), row
+    os.remove(sorted_path)
+
+def merge_shard_results(shard_paths: Sequence[str], output_path: str,
+                        chunksize: int = 100_000) -> int:
+    """
+    合併各分片結果成單一結果檔（依 text_id 排序，每個 text_id 一列），回傳列數
+
+    各分片先各自排序，再以多路合併串流寫出；同時只有一個分片完整載入記憶體
+    """
+    streams = [_sorted_shard_rows(path, path + '.sorted', chunksize) for path in shard_paths]
+    tmp_path = output_path + '.tmp'
+    rows = 0
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_COLUMNS)
+        for _, row in heapq.merge(*streams, key=lambda item: item[0]):
+            writer.writerow(row)
+            rows += 1
+    os.replace(tmp_path, output_path)
+    return rows
+
+def run_sharded(input_path: str, output_path: str = 'ner_labeled_data.csv',
+                num_workers: int = None, key_pool: ApiKeyPool = None,
+                work_dir: str = DEFAULT_WORK_DIR, chunk_size: int = 500,
+                max_concurrency: int = 8, packed: bool = False, max_pack_tokens: int = 2000,
+                resume: bool = True, dedup: str = None,
+                gazetteer_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    以多個 worker 行程分片處理文本檔，完成後合併成 output_path
+
+    num_workers 未指定時為 CPU 核心數（至少與 Key 數相同）；輸入檔只在主行程解析一次，
+    切成各分片的輸入檔，與各分片的結果、進度日誌一起存放在 work_dir，
+    中斷後以相同的 worker 數重跑即可從各分片的進度續跑
+    """
+    key_pool = key_pool or ApiKeyPool.from_env()
+    num_workers = num_workers or max(os.cpu_count() or 1, len(key_pool))
+    assignments = key_pool.assign(num_workers)
+    os.makedirs(work_dir, exist_ok=True)
+    shard_paths = [shard_output_path(work_dir, i, num_workers) for i in range(num_workers)]
+    input_paths = [shard_input_path(work_dir, i, num_workers) for i in range(num_workers)]
+
+    options = {
+        'chunk_size': chunk_size, 'max_concurrency': max_concurrency, 'packed': packed,
+        'max_pack_tokens': max_pack_tokens, 'resume': resume, 'dedup': dedup,
+        'gazetteer_path': gazetteer_path
+    }
+    print(f"🚀 以 {num_workers} 個 worker、{len(key_pool)} 把 API Key 分片處理 {input_path}")
+    partition_input(input_path, input_paths)
+
+    started = time.monotonic()
+    # 使用 spawn 啟動 worker，避免 fork 複製父行程的執行緒與資料庫連線
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as pool:
+        futures = [pool.submit(_run_shard, input_paths[i], shard_paths[i], i, num_workers,
+                               assignments[i], options)
+                   for i in range(num_workers)]
+        reports = []
+        for future in futures:
+            report = future.result()
+            reports.append(report)
+            print(f"  ✅ 分片 {report['shard']} (Key {report['key']}): "
+                  f"{report['rows']} 筆，{report['seconds']:.1f} 秒")
+
+    rows = merge_shard_results(shard_paths, output_path)
+    usage = {field: sum(report['usage'][field] for report in reports)
+             for field in ('calls', 'prompt_tokens', 'cached_tokens', 'completion_tokens')}
+    summary = {
+        'workers': num_workers,
+        'keys': len(key_pool),
+        'rows': rows,
+        'written': sum(report['rows'] for report in reports),
+        'seconds': time.monotonic() - started,
+        'usage': usage
+    }
+    print(f"📦 已合併 {rows} 筆結果至 '{output_path}'（本次新處理 {summary['written']} 筆，"
+          f"{summary['seconds']:.1f} 秒，{usage['calls']} 次呼叫）")
+    return summary
+
+def main():
+    """主程式：python sharded_runner.py 輸入檔 [輸出檔] [--workers=N] [--packed]"""
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not args:
+        print("用法: python sharded_runner.py 輸入檔 [輸出檔] [--workers=N] [--packed]")
+        return
+    num_workers = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('--workers='):
+            num_workers = int(arg.split('=', 1)[1])
+    output_path = args[1] if len(args) > 1 else 'ner_labeled_data.csv'
+    run_sharded(args[0], output_path, num_workers=num_workers, packed='--packed' in sys.argv)
+
+if __name__ == "__main__":
+    main()
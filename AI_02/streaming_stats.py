@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分段串流的實體統計
+以可合併的線上累加器（數量、Welford 平均/變異數、最小/最大值、
+固定區間直方圖、分位數草圖）逐段彙總實體表，記憶體用量不隨結果檔大小成長
+"""
+
+import math
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from entity_stats import DEFAULT_QUANTILES, EntityStats, TextLabelIndex, quantile_column
+from ner_io import iter_entity_chunks
+
+DEFAULT_CHUNKSIZE = 100_000
+
+class RunningStats:
+    """Welford 線上平均/變異數與最小/最大值；兩份結果可直接合併（Chan 公式）"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _combine(self, count: int, mean: float, m2: float, low: float, high: float):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min = min(self.min, low)
+        self.max = max(self.max, high)
+
+    def update(self, values: np.ndarray):
+        """加入一批數值"""
+        if len(values) == 0:
+            return
+        mean = float(values.mean())
+        self._combine(len(values), mean, float(((values - mean) ** 2).sum()),
+                      float(values.min()), float(values.max()))
+
+    def merge(self, other: 'RunningStats'):
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+
+    @property
+    def variance(self) -> float:
+        """樣本變異數"""
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+class FixedHistogram:
+    """固定區間的直方圖，超出範圍的值歸入兩端區間"""
+
+    def __init__(self, bins: int = 20, value_range: Tuple[float, float] = (0.0, 1.0)):
+        self.edges = np.linspace(value_range[0], value_range[1], bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def update(self, values: np.ndarray):
+        clipped = np.clip(values, self.edges[0], self.edges[-1])
+        self.counts += np.histogram(clipped, bins=self.edges)[0]
+
+    def merge(self, other: 'FixedHistogram'):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("直方圖區間不同，無法合併")
+        self.counts += other.counts
+
+class QuantileSketch:
+    """
+    分位數草圖（t-digest）
+
+    以 (平均值, 權重) 的質心近似分布，質心數量上限約為 compression；
+    採 arcsin 尺度函數，兩端分位數的質心較小、誤差較低
+    """
+
+    def __init__(self, compression: int = 200):
+        self.compression = compression
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._means = np.empty(0)
+        self._weights = np.empty(0)
+        self._buffer: List[Tuple[np.ndarray, np.ndarray]] = []
+        self._buffered = 0
+
+    def _add(self, means: np.ndarray, weights: np.ndarray):
+        self._buffer.append((means, weights))
+        self._buffered += len(means)
+        if self._buffered >= 10 * self.compression:
+            self._compress()
+
+    def update(self, values: np.ndarray):
+        """加入一批數值"""
+        if len(values) == 0:
+            return
+        values = np.asarray(values, dtype=np.float64)
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._add(values, np.ones(len(values)))
+
+    def merge(self, other: 'QuantileSketch'):
+        if other.count == 0:
+            return
+        other._compress()
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._add(other._means, other._weights)
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        means = np.concatenate([self._means] + [m for m, _ in self._buffer])
+        weights = np.concatenate([self._weights] + [w for _, w in self._buffer])
+        self._buffer, self._buffered = [], 0
+
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        q = (np.cumsum(weights) - weights / 2) / weights.sum()
+        k = np.floor(self.compression * (np.arcsin(2 * q - 1) / np.pi + 0.5))
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(k)) + 1))
+
+        self._weights = np.add.reduceat(weights, starts)
+        self._means = np.add.reduceat(means * weights, starts) / self._weights
+
+    def quantile(self, qs: Sequence[float]) -> np.ndarray:
+        """估計分位數（線性內插質心，兩端以實際最小/最大值為界）"""
+        qs = np.asarray(qs, dtype=np.float64)
+        if self.count == 0:
+            return np.full(qs.shape, np.nan)
+        self._compress()
+        positions = np.cumsum(self._weights) - self._weights / 2
+        return np.interp(qs * self.count,
+                         np.concatenate(([0.0], positions, [float(self.count)])),
+                         np.concatenate(([self.min], self._means, [self.max])))
+
+class ConfidenceSummary:
+    """單一序列可信度的累加器：統計量 + 直方圖 + 分位數草圖"""
+
+    def __init__(self, bins: int = 20, compression: int = 200):
+        self.stats = RunningStats()
+        self.histogram = FixedHistogram(bins)
+        self.sketch = QuantileSketch(compression)
+
+    def update(self, values: np.ndarray):
+        self.stats.update(values)
+        self.histogram.update(values)
+        self.sketch.update(values)
+
+    def merge(self, other: 'ConfidenceSummary'):
+        self.stats.merge(other.stats)
+        self.histogram.merge(other.histogram)
+        self.sketch.merge(other.sketch)
+
+    def box_stats(self, label: str = None) -> Dict:
+        """
+        由草圖分位數產生 Axes.bxp 所需的箱線圖數值
+
+        鬚線取 1.5 IQR 並以實際最小/最大值為界；草圖不保留個別離群值
+        """
+        q1, med, q3 = self.sketch.quantile([0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        box = {
+            'med': med,
+            'q1': q1,
+            'q3': q3,
+            'whislo': max(self.stats.min, q1 - 1.5 * iqr),
+            'whishi': min(self.stats.max, q3 + 1.5 * iqr),
+            'fliers': []
+        }
+        if label is not None:
+            box['label'] = label
+        return box
+
+class StreamingEntityStats(EntityStats):
+    """由累加器摘要組成的 EntityStats，不保留原始可信度陣列"""
+
+    def __init__(self, overall: ConfidenceSummary, summaries: Dict[str, ConfidenceSummary],
+                 text_index: TextLabelIndex, quantiles: Sequence[float]):
+        rows = {}
+        for label, summary in summaries.items():
+            row = {
+                'count': summary.stats.count,
+                'mean': summary.stats.mean,
+                'min': summary.stats.min,
+                'max': summary.stats.max
+            }
+            for q, value in zip(quantiles, summary.sketch.quantile(quantiles)):
+                row[quantile_column(q)] = value
+            rows[label] = row
+
+        columns = ['count', 'mean', 'min', 'max'] + [quantile_column(q) for q in quantiles]
+        by_label = pd.DataFrame.from_dict(rows, orient='index', columns=columns)
+        by_label = by_label.sort_values('count', ascending=False, kind='stable')
+        by_label['count'] = by_label['count'].astype('int64')
+
+        super().__init__(overall.stats.count, None, by_label, {}, text_index, quantiles)
+        self.overall_summary = overall
+        self.summaries = summaries
+
+    @property
+    def overall(self) -> Dict[str, float]:
+        if self.total == 0:
+            return {'mean': 0.0, 'min': 0.0, 'max': 0.0}
+        stats = self.overall_summary.stats
+        return {'mean': stats.mean, 'min': stats.min, 'max': stats.max, 'std': stats.std}
+
+    def histogram(self, bins: int = 20) -> Tuple[np.ndarray, np.ndarray]:
+        """累加時的固定區間直方圖（bins 於建立累加器時決定）"""
+        histogram = self.overall_summary.histogram
+        return histogram.counts, histogram.edges
+
+    def box_stats(self, label: str = None) -> Dict:
+        summary = self.overall_summary if label is None else self.summaries[label]
+        return summary.box_stats(label)
+
+class EntityStatsAccumulator:
+    """
+    逐段累加實體表的統計
+
+    (text, label) 的計數最多保留 max_tracked_pairs 組；超過時只保留次數最多者，
+    因此極大量相異實體時最常見實體排行為近似值
+    """
+
+    def __init__(self, bins: int = 20, compression: int = 200, max_tracked_pairs: int = 200_000):
+        self.bins = bins
+        self.compression = compression
+        self.max_tracked_pairs = max_tracked_pairs
+        self.overall = ConfidenceSummary(bins, compression)
+        self.by_label: Dict[str, ConfidenceSummary] = {}
+        self._pair_counts: Optional[pd.Series] = None
+
+    def _summary_for(self, label: str) -> ConfidenceSummary:
+        if label not in self.by_label:
+            self.by_label[label] = ConfidenceSummary(self.bins, self.compression)
+        return self.by_label[label]
+
+    def _add_pair_counts(self, pair_counts: pd.Series):
+        if self._pair_counts is None:
+            self._pair_counts = pair_counts
+        else:
+            self._pair_counts = self._pair_counts.add(pair_counts, fill_value=0).astype('int64')
+        if len(self._pair_counts) > 2 * self.max_tracked_pairs:
+            self._pair_counts = self._pair_counts.nlargest(self.max_tracked_pairs, keep='first')
+
+    def update(self, entities: pd.DataFrame):
+        """加入一段實體表（欄位 text / label / confidence）"""
+        if entities.empty:
+            return
+        confidences = entities['confidence'].to_numpy(dtype=np.float64)
+        self.overall.update(confidences)
+        for label, indices in entities.groupby('label', observed=True, sort=False).indices.items():
+            self._summary_for(str(label)).update(confidences[indices])
+
+        pairs = pd.DataFrame({'text': entities['text'].astype(str),
+                              'label': entities['label'].astype(str)})
+        self._add_pair_counts(pairs.groupby(['text', 'label'], sort=False).size())
+
+    def merge(self, other: 'EntityStatsAccumulator'):
+        """合併另一個累加器（例如其他行程處理的分段）"""
+        self.overall.merge(other.overall)
+        for label, summary in other.by_label.items():
+            self._summary_for(label).merge(summary)
+        if other._pair_counts is not None:
+            self._add_pair_counts(other._pair_counts)
+
+    def result(self, quantiles: Sequence[float] = DEFAULT_QUANTILES) -> StreamingEntityStats:
+        pair_counts = self._pair_counts
+        if pair_counts is None:
+            pair_counts = pd.Series([], dtype='int64',
+                                    index=pd.MultiIndex.from_arrays([[], []], names=['text', 'label']))
+        return StreamingEntityStats(self.overall, self.by_label,
+                                    TextLabelIndex.from_pair_counts(pair_counts), quantiles)
+
+def accumulate_entity_stats(chunks: Iterable[pd.DataFrame], **kwargs) -> EntityStatsAccumulator:
+    """將多段實體表累加成一個累加器"""
+    accumulator = EntityStatsAccumulator(**kwargs)
+    for entities in chunks:
+        accumulator.update(entities)
+    return accumulator
+
+def compute_streaming_entity_stats(path: str, chunksize: int = DEFAULT_CHUNKSIZE,
+                                   quantiles: Sequence[float] = DEFAULT_QUANTILES,
+                                   **kwargs) -> StreamingEntityStats:
+    """
+    分段讀取結果檔（CSV 或欄式結果目錄）並計算實體統計
+
+    每次只在記憶體中保留 chunksize 列
+    """
+    return accumulate_entity_stats(iter_entity_chunks(path, chunksize), **kwargs).result(quantiles)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+結構化輸出工具
+以 JSON Schema 要求 API 回傳固定格式（response_format=json_schema），
+回應以較快的 JSON 解碼器解析並用預先編譯的驗證器檢查；
+格式錯誤時附上錯誤訊息重新詢問，而不是直接丟棄結果
+"""
+
+import json
+from typing import Any, Callable, Dict, List
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+Validator = Callable[[Any], None]
+
+REASK_PROMPT = """上一個回應不符合要求的 JSON 格式：{error}
+請修正後只回傳符合格式的 JSON，不要其他文字。"""
+
+class StructuredOutputError(ValueError):
+    """回應無法解析或不符合 schema"""
+
+def json_loads(content):
+    """解析 JSON（有安裝 orjson 時使用 orjson）"""
+    return _json_loads(content)
+
+def json_schema_format(name: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    """chat completions 的 response_format 參數（strict 模式）"""
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+def _compile_node(schema: Dict[str, Any], path: str) -> Validator:
+    """將 schema 的一個節點編譯成檢查函式（支援 strict 模式用到的關鍵字）"""
+    expected = schema.get('type')
+    enum = schema.get('enum')
+
+    if expected == 'object':
+        properties = {key: _compile_node(value, f"{path}.{key}")
+                      for key, value in schema.get('properties', {}).items()}
+        required = schema.get('required', [])
+        closed = schema.get('additionalProperties', True) is False
+
+        def check(value):
+            if not isinstance(value, dict):
+                raise StructuredOutputError(f"{path} 應為物件")
+            for key in required:
+                if key not in value:
+                    raise StructuredOutputError(f"{path} 缺少欄位 '{key}'")
+            for key, item in value.items():
+                if key in properties:
+                    properties[key](item)
+                elif closed:
+                    raise StructuredOutputError(f"{path} 含有未定義的欄位 '{key}'")
+        return check
+
+    if expected == 'array':
+        item_check = _compile_node(schema.get('items', {}), f"{path}[]")
+
+        def check(value):
+            if not isinstance(value, list):
+                raise StructuredOutputError(f"{path} 應為陣列")
+            for item in value:
+                item_check(item)
+        return check
+
+    types = {
+        'string': (str,),
+        'number': (int, float),
+        'integer': (int,),
+        'boolean': (bool,)
+    }.get(expected)
+
+    def check(value):
+        if types is not None and (not isinstance(value, types)
+                                  or (expected != 'boolean' and isinstance(value, bool))):
+            raise StructuredOutputError(f"{path} 應為 {expected}")
+        if enum is not None and value not in enum:
+            raise StructuredOutputError(f"{path} 必須是 {enum} 之一，收到 {value!r}")
+    return check
+
+def compile_validator(schema: Dict[str, Any]) -> Validator:
+    """
+    將 JSON Schema 預先編譯成驗證函式，不符合時拋出 StructuredOutputError
+
+    有安裝 fastjsonschema 時使用其產生的程式碼，否則使用內建的簡化版本
+    """
+    if fastjsonschema is not None:
+        compiled = fastjsonschema.compile(schema)
+
+        def check(value):
+            try:
+                compiled(value)
+            except fastjsonschema.JsonSchemaException as e:
+                raise StructuredOutputError(e.message) from e
+        return check
+    return _compile_node(schema, '$')
+
+def strip_code_fence(content: str) -> str:
+    """移除回應外圍可能的 ```json 區塊標記"""
+    content = content.strip()
+    if content.startswith('```json'):
+        content = content[7:]
+    elif content.startswith('```'):
+        content = content[3:]
+    if content.endswith('```'):
+        content = content[:-3]
+    return content.strip()
+
+def decode_json(content: str) -> Any:
+    """解碼回應中的 JSON；失敗時拋出 StructuredOutputError"""
+    try:
+        return json_loads(strip_code_fence(content or ''))
+    except ValueError as e:
+        raise StructuredOutputError(f"JSON 解析失敗: {e}") from e
+
+def parse_structured(content: str, validator: Validator) -> Any:
+    """解碼並驗證回應"""
+    result = decode_json(content)
+    validator(result)
+    return result
+
+def reask_messages(messages: List[Dict[str, str]], content: str,
+                   error: Exception) -> List[Dict[str, str]]:
+    """附上錯誤的回應與錯誤訊息，建立重新詢問的 messages"""
+    return messages + [
+        {"role": "assistant", "content": content or ''},
+        {"role": "user", "content": REASK_PROMPT.format(error=error)}
+    ]
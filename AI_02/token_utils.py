@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Token 估算工具
+在送出請求前計算提示詞的 token 數量（有安裝 tiktoken 時精確計算，否則粗估）
+"""
+
+import math
+import re
+import threading
+from typing import List
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 中日韓文字與全形標點大約每字 1 個 token
+_CJK_PATTERN = re.compile(r'[　-〿㐀-䶿一-鿿豈-﫿＀-￯]')
+
+# 每則訊息的固定格式開銷
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(text: str) -> int:
+    """粗估文本的 token 數量（中文每字約 1 token，其餘約 4 字元 1 token）"""
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count
+    return cjk_count + math.ceil(other_count / 4)
+
+# 模型不在 tiktoken 對照表中時使用的編碼（gpt-4o 系列）
+DEFAULT_ENCODING = 'o200k_base'
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+_encoding_unavailable = False
+
+def get_encoding(model: str = None):
+    """
+    取得模型對應的 tiktoken 編碼
+
+    未安裝 tiktoken 或編碼檔無法載入（例如離線時無法下載）時回傳 None
+    """
+    global _encoding_unavailable
+    if tiktoken is None or _encoding_unavailable:
+        return None
+    with _encodings_lock:
+        if model not in _encodings and not _encoding_unavailable:
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model) if model else None
+                except KeyError:
+                    encoding = None
+                _encodings[model] = encoding or tiktoken.get_encoding(DEFAULT_ENCODING)
+            except Exception as e:
+                print(f"⚠️ 無法載入 tiktoken 編碼，改用粗估: {e}")
+                _encoding_unavailable = True
+        return _encodings.get(model)
+
+def count_tokens(text: str, model: str = None) -> int:
+    """計算文本的 token 數量（未安裝 tiktoken 時改用 estimate_tokens）"""
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_messages_tokens(messages, model: str = None) -> int:
+    """計算 chat messages 的提示詞 token 數量（含每則訊息的格式開銷）"""
+    return sum(count_tokens(message.get('content', ''), model) + MESSAGE_OVERHEAD_TOKENS
+               for message in messages)
+
+def chunk_by_token_budget(texts: List[str], max_tokens: int, max_items: int = None,
+                          per_item_overhead: int = 0, model: str = None) -> List[List[int]]:
+    """
+    依 token 預算將文本分組，回傳每組的索引列表
+    
+    以 count_tokens 計算各文本的 token 數（有 tiktoken 時依 model 的編碼精確計算）；
+    單一文本超過預算時自成一組
+    """
+    groups: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    
+    for i, text in enumerate(texts):
+        cost = count_tokens(text, model) + per_item_overhead
+        full = max_items is not None and len(current) >= max_items
+        if current and (current_tokens + cost > max_tokens or full):
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += cost
+    
+    if current:
+        groups.append(current)
+    return groups
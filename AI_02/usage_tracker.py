@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Token 用量統計
+依提示詞模板累計每次呼叫的提示詞、前綴快取命中與回應 token 數，
+用來觀察前綴快取命中率
+"""
+
+import threading
+from typing import Any, Dict, Optional
+
+_FIELDS = ('calls', 'local_prompt_tokens', 'prompt_tokens', 'cached_tokens', 'completion_tokens')
+
+def usage_counts(usage: Any) -> Dict[str, int]:
+    """從 API 回應的 usage 取出 (prompt, cached, completion) token 數"""
+    if usage is None:
+        return {'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0}
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+        'cached_tokens': getattr(details, 'cached_tokens', 0) or 0,
+        'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0
+    }
+
+class UsageTracker:
+    """依模板名稱累計 token 用量（執行緒安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: Dict[str, Dict[str, int]] = {}
+
+    def record(self, name: str, local_prompt_tokens: int, usage: Any) -> Dict[str, int]:
+        """
+        記錄一次呼叫，回傳本次的用量
+
+        local_prompt_tokens 為送出前在本地計算的提示詞 token 數；
+        回應沒有 usage 時以本地數字代替提示詞 token 數
+        """
+        counts = usage_counts(usage)
+        if usage is None:
+            counts['prompt_tokens'] = local_prompt_tokens
+        counts['local_prompt_tokens'] = local_prompt_tokens
+        counts['calls'] = 1
+        with self._lock:
+            totals = self._totals.setdefault(name, dict.fromkeys(_FIELDS, 0))
+            for field in _FIELDS:
+                totals[field] += counts[field]
+        return counts
+
+    def stats(self, name: Optional[str] = None) -> Dict[str, Any]:
+        """單一模板（或全部合計）的用量與前綴快取命中率"""
+        with self._lock:
+            if name is not None:
+                totals = dict(self._totals.get(name, dict.fromkeys(_FIELDS, 0)))
+            else:
+                totals = dict.fromkeys(_FIELDS, 0)
+                for entry in self._totals.values():
+                    for field in _FIELDS:
+                        totals[field] += entry[field]
+        prompt = totals['prompt_tokens']
+        totals['cache_hit_rate'] = totals['cached_tokens'] / prompt if prompt else 0.0
+        return totals
+
+    def names(self):
+        with self._lock:
+            return sorted(self._totals)
+
+    def summary(self) -> str:
+        lines = ["📊 Token 用量:"]
+        for name in self.names() + [None]:
+            stats = self.stats(name)
+            if not stats['calls']:
+                continue
+            lines.append(
+                f"  {name or '合計'}: {stats['calls']} 次呼叫，提示詞 {stats['prompt_tokens']:,} tokens "
+                f"(前綴快取 {stats['cached_tokens']:,}，{stats['cache_hit_rate']:.1%})，"
+                f"回應 {stats['completion_tokens']:,} tokens"
+            )
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+
+_default_tracker: Optional[UsageTracker] = None
+_default_lock = threading.Lock()
+
+def get_default_usage_tracker() -> UsageTracker:
+    """取得程序內共用的用量統計"""
+    global _default_tracker
+    with _default_lock:
+        if _default_tracker is None:
+            _default_tracker = UsageTracker()
+        return _default_tracker